@@ -13,5 +13,9 @@ app.conf.beat_schedule = {
     'process-deadlines': {
         'task': 'lims.projects.tasks.process_deadlines',
         'schedule': crontab(minute=0, hour='*/3'),
-    }
+    },
+    'prune-view-access': {
+        'task': 'lims.permissions.tasks.prune_view_access',
+        'schedule': crontab(minute=30, hour=2),
+    },
 }
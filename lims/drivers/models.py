@@ -139,20 +139,32 @@ class CopyFilePath(models.Model):
             prefix = self.driver.copy_to_prefix
         return self._interpolate_path(self.copy_to, interpolate_dict, prefix)
 
+    def paths(self, interpolate_dict):
+        """
+        Get the (from, to) locations of the file to copy
+        """
+        return (self.copy_from_path(interpolate_dict),
+                self.copy_to_path(interpolate_dict))
+
+    def data_file(self, to_location, file_loc):
+        """
+        Create an unsaved DataFile for a copied file
+        """
+        file_name = to_location.rsplit('/', 1)[1]
+        return DataFile(
+            file_name=file_name,
+            location=file_loc,
+            equipment=self.driver.equipment)
+
     def copy(self, interpolate_dict):
         # Don't forget you need to create a datastore item
         # to ensure the file isn't lost
-        from_location = self.copy_from_path(interpolate_dict)
-        to_location = self.copy_to_path(interpolate_dict)
+        from_location, to_location = self.paths(interpolate_dict)
         try:
             file_loc = shutil.copy2(from_location, to_location)
         except IOError as e:
             return False
         else:
-            file_name = to_location.rsplit('/', 1)[1]
-            ds = DataFile(
-                file_name=file_name,
-                location=file_loc,
-                equipment=self.driver.equipment)
+            ds = self.data_file(to_location, file_loc)
             ds.save()
             return ds
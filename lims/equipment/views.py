@@ -6,6 +6,7 @@ from rest_framework.exceptions import PermissionDenied
 import django_filters
 
 from lims.permissions.permissions import IsInStaffGroupOrRO
+from lims.permissions.principal import get_principal
 from lims.shared.mixins import AuditTrailViewMixin
 
 from lims.shared.mixins import StatsViewMixin
@@ -47,21 +48,21 @@ class EquipmentReservationViewSet(AuditTrailViewMixin, viewsets.ModelViewSet):
     filter_class = EquipmentReservationFilter
 
     def perform_create(self, serializer):
-        if self.request.user.groups.filter(name='staff').exists():
+        if get_principal(self.request.user).in_group('staff'):
             serializer.validated_data['is_confirmed'] = True
             serializer.validated_data['confirmed_by'] = self.request.user
         serializer.save(reserved_by=self.request.user)
 
     def perform_update(self, serializer):
         if (serializer.instance.reserved_by == self.request.user or
-                self.request.user.groups.filter(name='staff').exists()):
+                get_principal(self.request.user).in_group('staff')):
             serializer.save()
         else:
             raise PermissionDenied()
 
     def destroy(self, request, pk=None):
         if (request.user == self.get_object().reserved_by or
-                request.user.groups.filter(name='staff').exists()):
+                get_principal(request.user).in_group('staff')):
             return super(EquipmentReservationViewSet, self).destroy(request, self.get_object().id)
         else:
             return Response({'message': 'You must have permission to delete'}, status=403)
@@ -1,10 +1,13 @@
 from django.db import models
-from django.db.models.signals import post_init
+from django.db.models.signals import post_init, post_save, post_delete
 import reversion
 from django.contrib.auth.models import User
 
 from mptt.models import MPTTModel, TreeForeignKey
-from pint import UnitRegistry, UndefinedUnitError
+
+from lims.shared.signals import send_post_save
+
+from .units import conversion_table, measured
 
 
 @reversion.register()
@@ -181,6 +184,46 @@ class ItemProperty(models.Model):
         return self.name
 
 
+class ItemTransferQuerySet(models.QuerySet):
+
+    def complete(self):
+        """
+        Mark the transfers as taken and complete any with nothing left
+
+        The same as calling do_complete on each transfer but as a
+        single update. post_save is still sent for each transfer so
+        they are recorded by reversion.
+        """
+        ids = list(self.values_list('id', flat=True))
+        updated = self.model.objects.filter(id__in=ids).update(
+            has_taken=True,
+            transfer_complete=models.Case(
+                models.When(amount_available=0, then=models.Value(True)),
+                default=models.F('transfer_complete'),
+                output_field=models.BooleanField()))
+        send_post_save(self.model, self.model.objects.filter(id__in=ids))
+        return updated
+
+    def cancel(self):
+        """
+        Return anything taken by the transfers to the inventory and delete them
+
+        Amounts are returned to each item with a single update.
+        """
+        item_changes = {}
+        items = {}
+        transfers = self.filter(has_taken=False) \
+            .select_related('item__amount_measure', 'amount_measure')
+        for t in transfers:
+            item = items.setdefault(t.item_id, t.item)
+            change = t._to_item_measure(t.amount_taken)
+            item_changes[item.id] = item_changes.get(item.id, 0) + change
+            item.amount_available += change
+        if item_changes:
+            self.model._alter_item_amounts(item_changes, items.values())
+        return self.delete()
+
+
 @reversion.register()
 class ItemTransfer(models.Model):
     """
@@ -218,18 +261,23 @@ class ItemTransfer(models.Model):
     # a history entry
     transfer_complete = models.BooleanField(default=False, db_index=True)
 
+    objects = ItemTransferQuerySet.as_manager()
+
     class Meta:
         ordering = ['-date_created']
 
     def item_name(self):
         return self.item.name
 
-    def save(self, *args, **kwargs):
+    def _match_amounts(self):
         # Match some fields
         if self.pk is None:
             if self.amount_available == 0:
                 self.amount_available = self.amount_taken
             self.amount_to_take = self.amount_taken
+
+    def save(self, *args, **kwargs):
+        self._match_amounts()
         # Link to an existing ItemTransfer with the given barcode
         if self.barcode:
             try:
@@ -240,76 +288,138 @@ class ItemTransfer(models.Model):
                 self.linked_transfer = linked
         super(ItemTransfer, self).save(*args, **kwargs)
 
-    def _as_measured_value(self, amount, measure, ureg):
+    def _to_item_measure(self, amount):
         """
-        Convert if possible to a value with units
+        Convert an amount in the measure of the transfer to that of the item
         """
-        try:
-            value = amount * ureg(measure)
-        except UndefinedUnitError:
-            value = amount * ureg.count
-        return value
+        return conversion_table.convert(amount,
+                                        self.amount_measure.symbol,
+                                        self.item.amount_measure.symbol)
+
+    def _new_amount(self, existing, to_take):
+        """
+        The amount left after the transfer or None if there is not enough
+        """
+        if self.is_addition:
+            return existing + to_take
+        elif existing > to_take:
+            return existing - to_take
+        return None
 
     def check_transfer(self):
-        ureg = UnitRegistry()
-        existing = self._as_measured_value(self.item.amount_available,
-                                           self.item.amount_measure.symbol,
-                                           ureg)
-        to_take = self._as_measured_value(self.amount_taken,
-                                          self.amount_measure.symbol,
-                                          ureg)
+        existing = self.item.amount_available
+        to_take = self._to_item_measure(self.amount_taken)
         if not self.is_addition and existing < to_take:
-            missing = ((existing - to_take) * -1)
+            missing = measured(to_take - existing, self.item.amount_measure.symbol)
             return (False, missing)
         return (True, 0)
 
-    def do_transfer(self, ureg=False):
+    def do_transfer(self):
         """
         Alter the item to reflect new amount
         """
-        if not ureg:
-            ureg = UnitRegistry()
         # Check if it is taking stuff from inventory or not
         # Note: if something has been taken you cannot put it
         # back
         if not self.has_taken:
-            existing = self._as_measured_value(self.item.amount_available,
-                                               self.item.amount_measure.symbol,
-                                               ureg)
-            to_take = self._as_measured_value(self.amount_taken,
-                                              self.amount_measure.symbol,
-                                              ureg)
-            if self.is_addition:
-                new_amount = existing + to_take
-            else:
-                if existing > to_take:
-                    new_amount = existing - to_take
-                else:
-                    return False
-            self.item.amount_available = new_amount.magnitude
+            new_amount = self._new_amount(self.item.amount_available,
+                                          self._to_item_measure(self.amount_taken))
+            if new_amount is None:
+                return False
+            self.item.amount_available = new_amount
             self.item.save()
-            self.amount_available = self.amount_available - to_take.magnitude
+            self.amount_available = self.amount_available - self.amount_taken
         else:
             # We take from the transfer not the actual item since we've
             # already got it from the item
-            existing = self._as_measured_value(self.amount_available,
-                                               self.amount_measure.symbol,
-                                               ureg)
-            to_take = self._as_measured_value(self.amount_to_take,
-                                              self.amount_measure.symbol,
-                                              ureg)
-            if self.is_addition:
-                new_amount = existing + to_take
-            else:
-                if existing > to_take:
-                    new_amount = existing - to_take
-                else:
-                    return False
-            self.amount_available = new_amount.magnitude
+            new_amount = self._new_amount(self.amount_available, self.amount_to_take)
+            if new_amount is None:
+                return False
+            self.amount_available = new_amount
         self.save()
         return True
 
-    def do_complete(self, ureg=False):
+    @staticmethod
+    def _alter_item_amounts(item_changes, items):
+        """
+        Add to the amount of many items in a single update
+
+        item_changes is a dict of item ID: amount to add in the measure of
+        the item (negative to take away). items are the instances which
+        will have been altered, used to tell any listeners of the change.
+        """
+        Item.objects.filter(id__in=item_changes.keys()).update(
+            amount_available=models.Case(
+                *[models.When(id=item_id, then=models.F('amount_available') + change)
+                  for item_id, change in item_changes.items()],
+                output_field=models.FloatField()))
+        Item.objects.filter(id__in=item_changes.keys(), amount_available__gt=0,
+                            in_inventory=False).update(in_inventory=True)
+        for item in items:
+            if item.amount_available > 0:
+                item.in_inventory = True
+        send_post_save(Item, items)
+
+    @classmethod
+    def do_transfers(cls, transfers):
+        """
+        Perform and save many transfers using set based updates
+
+        The same as calling do_transfer and save on each transfer but
+        item amounts are altered in one query, new transfers are created
+        in one insert and existing transfers are updated in one query.
+        Several transfers from the same item are checked against the
+        amount left after the previous ones.
+        """
+        item_changes = {}
+        item_amounts = {}
+        for t in transfers:
+            if not t.has_taken:
+                item = t.item
+                existing = item_amounts.get(item.id, item.amount_available)
+                new_amount = t._new_amount(existing, t._to_item_measure(t.amount_taken))
+                if new_amount is None:
+                    continue
+                item_changes[item.id] = item_changes.get(item.id, 0) + new_amount - existing
+                item_amounts[item.id] = item.amount_available = new_amount
+                t.amount_available = t.amount_available - t.amount_taken
+            else:
+                new_amount = t._new_amount(t.amount_available, t.amount_to_take)
+                if new_amount is None:
+                    continue
+                t.amount_available = new_amount
+
+        if item_changes:
+            changed_items = {t.item.id: t.item for t in transfers if t.item.id in item_changes}
+            cls._alter_item_amounts(item_changes, changed_items.values())
+
+        new_transfers = [t for t in transfers if t.pk is None]
+        existing_transfers = [t for t in transfers if t.pk is not None]
+        if new_transfers:
+            # Link to an existing ItemTransfer with the given barcode
+            barcodes = set(t.barcode for t in new_transfers if t.barcode)
+            linked = {}
+            for lt in cls.objects.filter(barcode__in=barcodes, transfer_complete=False):
+                linked.setdefault(lt.barcode, []).append(lt)
+            for t in new_transfers:
+                t._match_amounts()
+                if len(linked.get(t.barcode, [])) == 1:
+                    t.linked_transfer = linked[t.barcode][0]
+            cls.objects.bulk_create(new_transfers)
+            send_post_save(cls, new_transfers, created=True)
+        if existing_transfers:
+            def by_transfer(field):
+                return models.Case(*[models.When(id=t.id, then=models.Value(getattr(t, field)))
+                                     for t in existing_transfers],
+                                   output_field=cls._meta.get_field(field))
+            cls.objects.filter(id__in=[t.id for t in existing_transfers]).update(
+                amount_available=by_transfer('amount_available'),
+                amount_to_take=by_transfer('amount_to_take'),
+                run_identifier=by_transfer('run_identifier'))
+            send_post_save(cls, existing_transfers)
+        return transfers
+
+    def do_complete(self):
         """
         Check if there is anything left available, if not complete.
         """
@@ -332,3 +442,12 @@ def initItemTransfer(**kwargs):
         instance.amount_available = instance.amount_taken
         instance.amount_to_take = instance.amount_taken
 post_init.connect(initItemTransfer, ItemTransfer)
+
+
+def refreshConversionTable(**kwargs):
+    """
+    Rebuild measure conversions when a measure is changed
+    """
+    conversion_table.refresh()
+post_save.connect(refreshConversionTable, AmountMeasure)
+post_delete.connect(refreshConversionTable, AmountMeasure)
@@ -3,6 +3,8 @@ from lims.shared.loggedintestcase import LoggedInTestCase
 from lims.filetemplate.models import FileTemplate, FileTemplateField
 from rest_framework import status
 from .models import Location, ItemType, AmountMeasure, Set, Item, Tag
+from .units import conversion_table
+from pint import DimensionalityError
 from django.contrib.auth.models import Permission, Group
 from django.core.files.uploadedfile import SimpleUploadedFile
 from .views import ViewPermissionsMixin
@@ -404,6 +406,18 @@ class AmountMeasureTestCase(LoggedInTestCase):
     def test_amountmeasure_str(self):
         self.assertEqual(self._millilitre.__str__(), "Millilitres (ml)")
 
+    def test_conversion_table(self):
+        AmountMeasure.objects.get_or_create(name="Litres", symbol="l")
+        AmountMeasure.objects.get_or_create(name="Item", symbol="item")
+        self.assertAlmostEqual(conversion_table.factor("l", "ml"), 1000)
+        self.assertAlmostEqual(conversion_table.convert(250, "ml", "l"), 0.25)
+        self.assertEqual(conversion_table.factor("item", "item"), 1)
+        with self.assertRaises(DimensionalityError):
+            conversion_table.factor("ml", "g")
+        # A measure added after the table is built is still converted
+        AmountMeasure.objects.create(name="Microlitres", symbol="ul")
+        self.assertAlmostEqual(conversion_table.factor("ml", "ul"), 1000)
+
 
 class SetTestCase(LoggedInTestCase):
     def setUp(self):
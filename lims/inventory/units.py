@@ -0,0 +1,108 @@
+import threading
+
+from pint import UnitRegistry, UndefinedUnitError, DimensionalityError
+
+# Creating a registry is slow (it parses all unit definitions) so a single
+# registry is shared by the whole process and only created when first used.
+_registry = None
+_registry_lock = threading.Lock()
+
+
+def get_registry():
+    """
+    Get the unit registry shared by the process
+    """
+    global _registry
+    if _registry is None:
+        with _registry_lock:
+            if _registry is None:
+                _registry = UnitRegistry()
+    return _registry
+
+
+def measured(amount, symbol):
+    """
+    Convert if possible to a value with units
+
+    Symbols pint does not know about (e.g. item) are treated as a count.
+    """
+    ureg = get_registry()
+    try:
+        value = amount * ureg(symbol)
+    except UndefinedUnitError:
+        value = amount * ureg.count
+    return value
+
+
+class ConversionTable(object):
+    """
+    Conversion factors between the symbols of all AmountMeasures
+
+    Built once from the shared registry so converting an amount is a
+    single float multiply rather than a pint Quantity operation. Symbols
+    not in the table, e.g. a measure added since it was built, are
+    worked out when first asked for.
+    """
+
+    def __init__(self):
+        self._factors = None
+        self._lock = threading.Lock()
+
+    def _unit(self, symbol):
+        value = measured(1.0, symbol)
+        return (value.magnitude, value.units)
+
+    def _factor(self, from_symbol, to_symbol):
+        from_magnitude, from_unit = self._unit(from_symbol)
+        to_magnitude, to_unit = self._unit(to_symbol)
+        ureg = get_registry()
+        converted = ureg.Quantity(from_magnitude, from_unit).to(to_unit).magnitude
+        return converted / to_magnitude
+
+    def _build(self):
+        # Avoid a circular import as the models use the table
+        from .models import AmountMeasure
+        symbols = list(AmountMeasure.objects.values_list('symbol', flat=True))
+        factors = {}
+        for from_symbol in symbols:
+            for to_symbol in symbols:
+                try:
+                    factors[(from_symbol, to_symbol)] = self._factor(from_symbol, to_symbol)
+                except DimensionalityError:
+                    pass
+        return factors
+
+    def factor(self, from_symbol, to_symbol):
+        """
+        Get the number to multiply an amount by to convert between measures
+
+        Raises DimensionalityError if the measures cannot be converted.
+        """
+        if from_symbol == to_symbol:
+            return 1.0
+        with self._lock:
+            if self._factors is None:
+                self._factors = self._build()
+            factors = self._factors
+        try:
+            return factors[(from_symbol, to_symbol)]
+        except KeyError:
+            result = self._factor(from_symbol, to_symbol)
+            factors[(from_symbol, to_symbol)] = result
+            return result
+
+    def convert(self, amount, from_symbol, to_symbol):
+        """
+        Convert an amount from one measure to another
+        """
+        return amount * self.factor(from_symbol, to_symbol)
+
+    def refresh(self):
+        """
+        Rebuild the table when next used, e.g. after a measure changes
+        """
+        with self._lock:
+            self._factors = None
+
+
+conversion_table = ConversionTable()
@@ -3,8 +3,6 @@ import json
 
 from django.core.exceptions import ObjectDoesNotExist
 
-from pint import UnitRegistry
-
 import django_filters
 
 from rest_framework import viewsets
@@ -29,11 +27,6 @@ from .serializers import (AmountMeasureSerializer, ItemTypeSerializer, LocationS
 from .providers import InventoryItemPluginProvider
 
 
-# Define as module level due to issues with file locking
-# when calling a function requiring it multiple times
-ureg = UnitRegistry()
-
-
 class LeveledMixin(AuditTrailViewMixin):
     """
     Provide a display value for a heirarchy of elements
@@ -181,6 +174,7 @@ class InventoryViewSet(LeveledMixin, StatsViewMixin, ViewPermissionsMixin, views
             items_to_import = filetemplate.read(f, as_list=True)
             saved = []
             rejected = []
+            imported = []
             if items_to_import:
                 for item_data in items_to_import:
                     item_data['assign_groups'] = json.loads(permissions)
@@ -195,10 +189,10 @@ class InventoryViewSet(LeveledMixin, StatsViewMixin, ViewPermissionsMixin, views
                     item = DetailedItemSerializer(data=item_data)
                     if item.is_valid():
                         saved.append(item_data)
-                        item, parsed_permissions = self.clean_serializer_of_permissions(item)
+                        item, _ = self.clean_serializer_of_permissions(item)
                         item.validated_data['added_by'] = request.user
                         instance = item.save()
-                        self.assign_permissions(instance, parsed_permissions)
+                        imported.append(instance)
                         if 'product' in item_data:
                             try:
                                 prod = item_data['product']
@@ -210,6 +204,8 @@ class InventoryViewSet(LeveledMixin, StatsViewMixin, ViewPermissionsMixin, views
                     else:
                         item_data['errors'] = item.errors
                         rejected.append(item_data)
+                # Every item is given the same permissions
+                self.bulk_assign_permissions(imported, json.loads(permissions))
             else:
                 return Response({'message': 'File is format is incorrect'}, status=400)
             response_data = {
@@ -299,7 +295,7 @@ class InventoryViewSet(LeveledMixin, StatsViewMixin, ViewPermissionsMixin, views
             transfer_status = tfr.check_transfer()
             if transfer_status[0] is True:
                 tfr.save()
-                tfr.do_transfer(ureg)
+                tfr.do_transfer()
             else:
                 return Response(
                     {'message': 'Inventory item {} ({}) is short of amount by {}'.format(
@@ -320,7 +316,7 @@ class InventoryViewSet(LeveledMixin, StatsViewMixin, ViewPermissionsMixin, views
             except ObjectDoesNotExist:
                 return Response({'message': 'No item transfer exists with that ID'}, status=404)
             tfr.is_addition = True
-            tfr.do_transfer(ureg)
+            tfr.do_transfer()
             tfr.delete()
             return Response({'message': 'Transfer cancelled'})
         return Response({'message': 'You must provide a transfer ID'}, status=400)
@@ -0,0 +1,21 @@
+from rest_framework_jwt.authentication import JSONWebTokenAuthentication
+
+from .principal import get_principal
+
+
+class PrincipalJSONWebTokenAuthentication(JSONWebTokenAuthentication):
+    """
+    Authenticate with a JWT and resolve the principal for the request
+
+    Lets the principal be shared between requests with the same token
+    when PRINCIPAL_CACHE_TIMEOUT is set.
+    """
+
+    def authenticate(self, request):
+        result = super(PrincipalJSONWebTokenAuthentication, self).authenticate(request)
+        if result is not None:
+            user, token = result
+            if isinstance(token, bytes):
+                token = token.decode('utf-8')
+            get_principal(user, token)
+        return result
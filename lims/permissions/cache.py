@@ -0,0 +1,121 @@
+import logging
+
+from django.conf import settings
+from django.contrib.contenttypes.models import ContentType
+from django.db.models import Q
+
+from guardian.models import GroupObjectPermission
+
+from lims.shared.cache import CacheUnavailable, get_store
+
+
+logger = logging.getLogger(__name__)
+
+
+class PermissionCache(object):
+    """
+    A shared cache of the group permissions on each object
+
+    Holds {group ID: [codenames]} for an object. Entries are dropped by
+    ViewPermissionsMixin whenever it changes an object's permissions
+    and hits and misses are counted so the effect can be checked.
+    """
+    HITS = 'objperms:hits'
+    MISSES = 'objperms:misses'
+
+    def __init__(self):
+        self._store = None
+
+    @property
+    def store(self):
+        if self._store is None:
+            self._store = get_store(getattr(settings, 'PERMISSION_CACHE_URL', None))
+        return self._store
+
+    def _key(self, ct_id, object_pk):
+        return 'objperms:{}:{}'.format(ct_id, object_pk)
+
+    def _keys(self, objects):
+        keys = {}
+        for obj in objects:
+            ct = ContentType.objects.get_for_model(obj)
+            keys[self._key(ct.id, obj.pk)] = (ct, str(obj.pk))
+        return keys
+
+    def get_many(self, objects):
+        """
+        Get {object key: {group ID: [codenames]}} for objects
+
+        Objects not already cached are loaded in one query, as are all
+        of them if the cache cannot be reached.
+        """
+        # Imported here as permissions imports this module
+        from .permissions import get_permission_codename
+        keys = self._keys(objects)
+        try:
+            found = self.store.get_many(list(keys.keys()))
+        except CacheUnavailable as e:
+            logger.warning('Permission cache unavailable: %s', e)
+            return self._load(keys, get_permission_codename)
+        missing = [key for key in keys if key not in found]
+        try:
+            if missing:
+                loaded = self._load({key: keys[key] for key in missing},
+                                    get_permission_codename)
+                found.update(loaded)
+                self.store.set_many(loaded, getattr(settings, 'PERMISSION_CACHE_TIMEOUT', 3600))
+            counts = {self.HITS: len(keys) - len(missing), self.MISSES: len(missing)}
+            self.store.incr_many({key: count for key, count in counts.items() if count})
+        except CacheUnavailable as e:
+            logger.warning('Permission cache unavailable: %s', e)
+        return found
+
+    def _load(self, keys, get_permission_codename):
+        """
+        Load {object key: {group ID: [codenames]}} from the database
+        """
+        query = Q()
+        for ct, object_pk in keys.values():
+            query |= Q(content_type=ct, object_pk=object_pk)
+        loaded = {key: {} for key in keys}
+        group_perms = GroupObjectPermission.objects.filter(query) \
+            .values_list('content_type_id', 'object_pk', 'group_id', 'permission_id')
+        for ct_id, object_pk, group_id, permission_id in group_perms:
+            # JSON object keys are always strings
+            loaded[self._key(ct_id, object_pk)].setdefault(str(group_id), []).append(
+                get_permission_codename(permission_id))
+        return loaded
+
+    def key_for(self, obj):
+        return self._key(ContentType.objects.get_for_model(obj).id, obj.pk)
+
+    def get(self, obj):
+        """
+        Get {group ID: [codenames]} for an object
+        """
+        return self.get_many([obj])[self.key_for(obj)]
+
+    def invalidate(self, objects):
+        """
+        Drop the cached permissions of objects whose permissions changed
+
+        If the cache cannot be reached the change is still made, the old
+        permissions may then be served until they time out.
+        """
+        try:
+            self.store.delete_many(list(self._keys(objects).keys()))
+        except CacheUnavailable as e:
+            logger.warning('Permission cache unavailable: %s', e)
+
+    def stats(self):
+        return {
+            'hits': self.store.get_counter(self.HITS),
+            'misses': self.store.get_counter(self.MISSES),
+        }
+
+    def reset_stats(self):
+        self.store.reset_counter(self.HITS)
+        self.store.reset_counter(self.MISSES)
+
+
+permission_cache = PermissionCache()
@@ -0,0 +1,74 @@
+from django.conf import settings
+from django.db.models import Q
+
+from .models import ViewAccess
+
+
+def parent_field(model):
+    """
+    The foreign key a model inherits permissions through, if any
+
+    Models opt in by naming the field in inherit_permissions_from. It
+    only has an effect when PERMISSION_INHERITANCE is on, otherwise
+    permissions are copied to children when they are created.
+    """
+    if not getattr(settings, 'PERMISSION_INHERITANCE', False):
+        return None
+    return getattr(model, 'inherit_permissions_from', None)
+
+
+def permission_parent(obj):
+    """
+    The object whose permissions obj inherits
+
+    Where the parent does not inherit in turn only its primary key is
+    needed so it is not loaded.
+    """
+    name = parent_field(type(obj))
+    if name is None:
+        return None
+    field = obj._meta.get_field(name)
+    parent_id = getattr(obj, field.attname)
+    if parent_id is None:
+        return None
+    if parent_field(field.related_model) is not None:
+        return getattr(obj, name)
+    return field.related_model(pk=parent_id)
+
+
+def permission_sources(obj):
+    """
+    The object followed by every object it inherits permissions from
+    """
+    sources = [obj]
+    parent = permission_parent(obj)
+    while parent is not None:
+        sources.append(parent)
+        parent = permission_parent(parent)
+    return sources
+
+
+def inherited_codename(codename, model_name):
+    """
+    Translate a parent's permission to the child e.g. view_project to view_product
+    """
+    return '{}_{}'.format(codename.split('_')[0], model_name)
+
+
+def visible_filter(model, group_ids):
+    """
+    A Q for the objects of a model any of the groups can view
+
+    Includes objects the groups can view through a parent.
+    """
+    query = Q(pk__in=ViewAccess.objects.visible_to(model, group_ids))
+    name = parent_field(model)
+    if name is not None:
+        parent_model = model._meta.get_field(name).related_model
+        if parent_field(parent_model) is None:
+            parents = ViewAccess.objects.visible_to(parent_model, group_ids)
+        else:
+            parents = parent_model.objects.filter(
+                visible_filter(parent_model, group_ids)).values('pk')
+        query |= Q(**{'{}__in'.format(name): parents})
+    return query
@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.3 on 2018-03-20 10:12
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def build_view_access(apps, schema_editor):
+    GroupObjectPermission = apps.get_model('guardian', 'GroupObjectPermission')
+    ViewAccess = apps.get_model('permissions', 'ViewAccess')
+    view_perms = GroupObjectPermission.objects.filter(permission__codename__startswith='view_') \
+        .values_list('content_type_id', 'content_type__model', 'permission__codename',
+                     'object_pk', 'group_id')
+    access = set()
+    for ct_id, model, codename, object_pk, group_id in view_perms:
+        if codename == 'view_{}'.format(model):
+            try:
+                access.add((ct_id, int(object_pk), group_id))
+            except ValueError:
+                pass
+    ViewAccess.objects.bulk_create([ViewAccess(content_type_id=ct_id, object_id=object_id,
+                                               group_id=group_id)
+                                    for ct_id, object_id, group_id in access],
+                                   batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+        ('auth', '0008_alter_user_username_max_length'),
+        ('contenttypes', '0002_remove_content_type_name'),
+        ('guardian', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ViewAccess',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('object_id', models.PositiveIntegerField()),
+                ('content_type', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='contenttypes.ContentType')),
+                ('group', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='auth.Group')),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='viewaccess',
+            unique_together=set([('content_type', 'group', 'object_id')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='viewaccess',
+            index_together=set([('content_type', 'object_id')]),
+        ),
+        migrations.RunPython(build_view_access, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,80 @@
+from django.contrib.auth.models import Group
+from django.contrib.contenttypes.models import ContentType
+from django.db import models
+from django.db.models import Q
+
+from guardian.models import GroupObjectPermission
+
+
+class ViewAccessManager(models.Manager):
+
+    def sync(self, objects):
+        """
+        Rebuild the view access of objects from their group permissions
+        """
+        by_content_type = {}
+        for obj in objects:
+            ct = ContentType.objects.get_for_model(obj)
+            by_content_type.setdefault(ct, set()).add(obj.pk)
+        if not by_content_type:
+            return
+        permission_query = Q()
+        access_query = Q()
+        for ct, pks in by_content_type.items():
+            permission_query |= Q(content_type=ct, object_pk__in=[str(pk) for pk in pks],
+                                  permission__codename='view_{}'.format(ct.model))
+            access_query |= Q(content_type=ct, object_id__in=pks)
+        allowed = set(GroupObjectPermission.objects.filter(permission_query)
+                      .values_list('content_type_id', 'object_pk', 'group_id'))
+        self.filter(access_query).delete()
+        self.bulk_create([ViewAccess(content_type_id=ct_id, object_id=int(object_pk),
+                                     group_id=group_id)
+                          for ct_id, object_pk, group_id in allowed])
+
+    def prune(self):
+        """
+        Remove the view access of objects that no longer exist
+
+        Access is normally removed as objects are deleted, this is run
+        daily to catch any deleted without sending post_delete. Returns
+        the number removed.
+        """
+        removed = 0
+        ct_ids = self.order_by().values_list('content_type_id', flat=True).distinct()
+        for ct_id in list(ct_ids):
+            rows = self.filter(content_type_id=ct_id)
+            model = ContentType.objects.get_for_id(ct_id).model_class()
+            if model is not None:
+                rows = rows.exclude(object_id__in=model._base_manager.values('pk'))
+            removed += rows.delete()[0]
+        return removed
+
+    def visible_to(self, model, group_ids):
+        """
+        IDs of the objects of a model that any of the groups can view
+        """
+        return self.filter(content_type=ContentType.objects.get_for_model(model),
+                           group_id__in=group_ids).values('object_id')
+
+
+class ViewAccess(models.Model):
+    """
+    Which groups can view each permission controlled object
+
+    A copy of the view_ group object permissions so that lists can be
+    filtered with an indexed lookup rather than guardian's subquery over
+    text object pks. Kept up to date when permissions are changed
+    through ViewPermissionsMixin and when objects are deleted.
+    """
+    content_type = models.ForeignKey(ContentType, on_delete=models.CASCADE)
+    object_id = models.PositiveIntegerField()
+    group = models.ForeignKey(Group, on_delete=models.CASCADE)
+
+    objects = ViewAccessManager()
+
+    class Meta:
+        unique_together = (('content_type', 'group', 'object_id'),)
+        index_together = (('content_type', 'object_id'),)
+
+    def __str__(self):
+        return '{} {} {}'.format(self.content_type, self.object_id, self.group_id)
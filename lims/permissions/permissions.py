@@ -1,8 +1,11 @@
-from django.contrib.auth.models import Group
-from django.db.models import Model
+from django.contrib.auth.models import Group, Permission
+from django.contrib.contenttypes.models import ContentType
+from django.db.models import Manager, Model, Q
+from django.db import transaction
+from django.http import Http404
 
-from guardian.shortcuts import (get_groups_with_perms, assign_perm, remove_perm,
-                                get_perms)
+from guardian.models import GroupObjectPermission
+from guardian.shortcuts import get_perms
 
 from rest_framework import serializers
 from rest_framework import permissions
@@ -10,21 +13,61 @@ from rest_framework import filters
 from rest_framework.response import Response
 from rest_framework.decorators import detail_route
 
+from .cache import permission_cache
+from .inheritance import inherited_codename, permission_sources, visible_filter
+from .models import ViewAccess
+from .principal import get_principal
+from .receivers import deferred_view_access
 from .signals import permissions_removed, permissions_changed
 
 
+# Permissions only change when migrations are run so the permissions
+# of each content type are kept for the life of the process.
+_permission_ids = {}
+_permission_codenames = {}
+
+
+def get_permission_ids(content_types):
+    """
+    Get {(content type ID, codename): permission ID} for content types
+
+    Content types not seen before are loaded together in one query.
+    """
+    missing = [ct for ct in content_types if ct.id not in _permission_ids]
+    if missing:
+        for ct in missing:
+            _permission_ids[ct.id] = {}
+        permissions = Permission.objects.filter(content_type__in=missing) \
+            .values_list('content_type_id', 'codename', 'id')
+        for ct_id, codename, permission_id in permissions:
+            _permission_ids[ct_id][codename] = permission_id
+            _permission_codenames[permission_id] = codename
+    return {(ct.id, codename): permission_id for ct in content_types
+            for codename, permission_id in _permission_ids[ct.id].items()}
+
+
+def get_permission_codename(permission_id):
+    """
+    Get the codename of a permission by ID
+    """
+    if permission_id not in _permission_codenames:
+        _permission_codenames[permission_id] = Permission.objects \
+            .values_list('codename', flat=True).get(id=permission_id)
+    return _permission_codenames[permission_id]
+
+
 class IsSuperUser(permissions.BasePermission):
     """
     Limit all access to superuser only
     """
     def has_permission(self, request, view):
-        return request.user.is_superuser
+        return get_principal(request.user).is_superuser
 
 
 class IsThisUser(permissions.BasePermission):
 
     def has_object_permission(self, request, view, obj):
-        return obj == request.user or request.user.is_staff
+        return obj == request.user or get_principal(request.user).is_staff
 
 
 class IsAddressOwner(permissions.BasePermission):
@@ -39,7 +82,7 @@ class IsAddressOwner(permissions.BasePermission):
 
     def has_object_permission(self, request, view, obj):
         if request.user and request.user.is_authenticated():
-            has_group = request.user.groups.filter(name='admin').exists()
+            has_group = get_principal(request.user).is_admin
             if obj.user == request.user or has_group:
                 return True
         return False
@@ -51,7 +94,7 @@ class IsAddressOwnerFilter(filters.BaseFilterBackend):
     """
 
     def filter_queryset(self, request, queryset, view):
-        has_group = request.user.groups.filter(name='admin').exists()
+        has_group = get_principal(request.user).is_admin
         if has_group:
             return queryset
         else:
@@ -66,7 +109,7 @@ class IsInGroupOrRO(permissions.BasePermission):
 
     def has_permission(self, request, view):
         if request.user and request.user.is_authenticated():
-            has_group = request.user.groups.filter(name=self.group_name).exists()
+            has_group = get_principal(request.user).in_group(self.group_name)
             if request.method in permissions.SAFE_METHODS or has_group:
                 return True
         return False
@@ -94,31 +137,36 @@ class IsInAdminGroupOrTheUser(permissions.BasePermission):
     def has_permission(self, request, view):
         if request.user and request.user.is_authenticated():
             # Only admin users can post
-            if request.method == 'POST' and not request.user.groups.filter(name='admin').exists():
+            if request.method == 'POST' and not get_principal(request.user).is_admin:
                 return False
             return True
         return False
 
     def has_object_permission(self, request, view, obj):
         if request.user and request.user.is_authenticated():
-            has_group = request.user.groups.filter(name='admin').exists()
+            has_group = get_principal(request.user).is_admin
             if obj.id == request.user.id or has_group:
                 return True
         return False
 
 
-class ExtendedObjectPermissionsFilter(filters.DjangoObjectPermissionsFilter):
+class ExtendedObjectPermissionsFilter(filters.BaseFilterBackend):
     """
     Allow admin group users full access to all items
+
+    Other users only see objects one of their groups can view, either
+    directly or through a parent, looked up in the ViewAccess index.
     """
 
     def filter_queryset(self, request, queryset, view):
         # If we're the admin group allow access otherwise test
         # for the correct permissions.
-        if request.user.groups.filter(name='admin').exists():
+        principal = get_principal(request.user)
+        if principal.is_admin or (principal.is_superuser and principal.is_active):
             return queryset
-        return super(ExtendedObjectPermissionsFilter, self).filter_queryset(
-                request, queryset, view)
+        if not principal.is_active:
+            return queryset.none()
+        return queryset.filter(visible_filter(queryset.model, principal.group_ids))
 
 
 class ExtendedObjectPermissions(permissions.DjangoObjectPermissions):
@@ -140,7 +188,7 @@ class ExtendedObjectPermissions(permissions.DjangoObjectPermissions):
     def has_permission(self, request, view):
         # If we're the admin group allow access otherwise test
         # for the correct permissions.
-        if request.user.groups.filter(name='admin').exists():
+        if get_principal(request.user).is_admin:
             return True
         return super(ExtendedObjectPermissions, self).has_permission(
                 request, view)
@@ -148,10 +196,83 @@ class ExtendedObjectPermissions(permissions.DjangoObjectPermissions):
     def has_object_permission(self, request, view, obj):
         # If we're the admin group allow access otherwise test
         # for the correct permissions.
-        if request.user.groups.filter(name='admin').exists():
+        principal = get_principal(request.user)
+        if principal.is_admin:
             return True
-        return super(ExtendedObjectPermissions, self).has_object_permission(
-                request, view, obj)
+        # As DjangoObjectPermissions but using the principal so that
+        # object permissions are only looked up once per request.
+        if hasattr(view, 'get_queryset'):
+            model_cls = view.get_queryset().model
+        else:
+            model_cls = view.queryset.model
+        perms = self.get_required_object_permissions(request.method, model_cls)
+        if not principal.has_perms(perms, obj):
+            # Do not reveal objects the user cannot read
+            if request.method in permissions.SAFE_METHODS:
+                raise Http404
+            read_perms = self.get_required_object_permissions('GET', model_cls)
+            if not principal.has_perms(read_perms, obj):
+                raise Http404
+            return False
+        return True
+
+
+def load_group_permissions(objects):
+    """
+    Get the group permissions of many objects in one query
+
+    Returns {(content type ID, object pk): {group name: [codenames]}} in
+    the same format as get_groups_with_perms(obj, attach_perms=True).
+    Permissions inherited from parents are included.
+    """
+    objects = [(obj, permission_sources(obj)) for obj in objects if isinstance(obj, Model)]
+    by_content_type = {}
+    for obj, sources in objects:
+        for source in sources:
+            ct = ContentType.objects.get_for_model(source)
+            by_content_type.setdefault(ct, set()).add(str(source.pk))
+    direct = {(ct.id, pk): {} for ct, pks in by_content_type.items() for pk in pks}
+    if by_content_type:
+        get_permission_ids(by_content_type.keys())
+        query = Q()
+        for ct, pks in by_content_type.items():
+            query |= Q(content_type=ct, object_pk__in=pks)
+        group_perms = GroupObjectPermission.objects.filter(query) \
+            .values_list('content_type_id', 'object_pk', 'group__name', 'permission_id')
+        for ct_id, object_pk, group_name, permission_id in group_perms:
+            direct[(ct_id, object_pk)].setdefault(group_name, []).append(
+                get_permission_codename(permission_id))
+
+    loaded = {}
+    for obj, sources in objects:
+        model_name = obj._meta.model_name
+        perms = {}
+        for source in sources:
+            ct = ContentType.objects.get_for_model(source)
+            for group_name, codenames in direct[(ct.id, str(source.pk))].items():
+                group_perms = perms.setdefault(group_name, [])
+                for codename in codenames:
+                    codename = inherited_codename(codename, model_name)
+                    if codename not in group_perms:
+                        group_perms.append(codename)
+        loaded[(ContentType.objects.get_for_model(obj).id, str(obj.pk))] = perms
+    return loaded
+
+
+class PermissionsListSerializer(serializers.ListSerializer):
+    """
+    Loads the group permissions of every object in the list at once
+
+    Saves the child serializer a query per object when listing.
+    """
+
+    def to_representation(self, data):
+        objects = list(data.all() if isinstance(data, Manager) else data)
+        self.child._group_permissions = load_group_permissions(objects)
+        try:
+            return super(PermissionsListSerializer, self).to_representation(objects)
+        finally:
+            self.child._group_permissions = None
 
 
 class SerializerPermissionsMixin(serializers.Serializer):
@@ -168,15 +289,34 @@ class SerializerPermissionsMixin(serializers.Serializer):
     assign_groups = serializers.DictField(allow_null=True,
                                           write_only=True)
 
+    @classmethod
+    def many_init(cls, *args, **kwargs):
+        """
+        As Serializer.many_init but defaulting to PermissionsListSerializer
+        """
+        allow_empty = kwargs.pop('allow_empty', None)
+        child_serializer = cls(*args, **kwargs)
+        list_kwargs = {'child': child_serializer}
+        if allow_empty is not None:
+            list_kwargs['allow_empty'] = allow_empty
+        list_kwargs.update({key: value for key, value in kwargs.items()
+                            if key in serializers.LIST_SERIALIZER_KWARGS})
+        meta = getattr(cls, 'Meta', None)
+        list_serializer_class = getattr(meta, 'list_serializer_class',
+                                        PermissionsListSerializer)
+        return list_serializer_class(*args, **list_kwargs)
+
     def get_permissions(self, obj):
         # These are used for display/editing and are not
         # used to actually limit anything, that is done
         # in the view
-        perms = {}
         if isinstance(obj, Model):
-            for grp, p in get_groups_with_perms(obj, attach_perms=True).items():
-                perms[grp.name] = p
-        return perms
+            key = (ContentType.objects.get_for_model(obj).id, str(obj.pk))
+            loaded = getattr(self, '_group_permissions', None)
+            if loaded is None or key not in loaded:
+                loaded = load_group_permissions([obj])
+            return loaded[key]
+        return {}
 
 
 class SerializerReadOnlyPermissionsMixin(SerializerPermissionsMixin):
@@ -225,9 +365,10 @@ class ViewPermissionsMixin():
         """
         Remove permissions from instance for group
         """
-        model_name = instance._meta.model_name
-        for perm in self.PERM_TEMPLATE:
-            remove_perm(perm.format(model_name), group, instance)
+        objects = self._objects_by_content_type([instance])
+        self._group_object_permissions(objects, [group.id]).delete()
+        ViewAccess.objects.sync([instance])
+        self._invalidate_cached_permissions([instance])
         return True
 
     def assign_permissions(self, instance, permissions):
@@ -236,46 +377,123 @@ class ViewPermissionsMixin():
 
         Can be used to change permissions from rw/r and vice versa
         """
-        model_name = instance._meta.model_name
-        for group, perm in permissions.items():
-            try:
-                grp = Group.objects.get(name=group)
-            except Group.DoesNotExist:
-                return False
-            current_permission = self.current_permissions(grp, instance)
-            if perm == 'rw':
-                # Give read and write permissions
-                # Iterate through templates and build the
-                # permission codename based on model name
-                for pt in self.PERM_TEMPLATE:
-                    assign_perm(pt.format(model_name), grp, instance)
-            elif perm == 'r':
-                # Only give read permissions
-                if current_permission == 'rw':
-                    self.remove_group_permissions(instance, grp)
-                assign_perm('view_%s' % model_name, grp, instance)
-            else:
-                raise serializers.ValidationError({'message': 'Permission must by r or rw'})
-        permissions_changed.send(sender=instance.__class__,
-                                 id=instance.id,
-                                 permissions=permissions)
-        return True
+        return self.bulk_assign_permissions([instance], permissions)
 
     def unassign_permissions(self, instance, groups):
         """
         Remove entire groups from accessing a given object
         """
-        model_name = instance._meta.model_name
-        for g in groups:
-            try:
-                group = Group.objects.get(name=g)
-            except Group.DoesNotExist:
+        return self.bulk_unassign_permissions([instance], groups)
+
+    def _invalidate_cached_permissions(self, instances):
+        """
+        Drop cached permissions now and again once the change is committed
+
+        The second stops a request that read the old permissions before
+        the commit from leaving them in the cache.
+        """
+        instances = list(instances)
+        permission_cache.invalidate(instances)
+        transaction.on_commit(lambda: permission_cache.invalidate(instances))
+
+    def _objects_by_content_type(self, instances):
+        """
+        Group instances as {content type: set of object pks}
+        """
+        objects = {}
+        for instance in instances:
+            ct = ContentType.objects.get_for_model(instance)
+            objects.setdefault(ct, set()).add(str(instance.pk))
+        return objects
+
+    def _group_object_permissions(self, objects, group_ids):
+        """
+        The group object permissions from PERM_TEMPLATE on objects for groups
+        """
+        permission_ids = get_permission_ids(objects.keys())
+        query = Q()
+        for ct, pks in objects.items():
+            perms = [permission_ids[(ct.id, pt.format(ct.model))] for pt in self.PERM_TEMPLATE]
+            query |= Q(content_type=ct, object_pk__in=pks, permission_id__in=perms)
+        return GroupObjectPermission.objects.filter(query, group_id__in=group_ids)
+
+    def bulk_assign_permissions(self, instances, permissions):
+        """
+        Assign the same permissions to many groups on many objects
+
+        Works out every permission to add or remove up front then
+        writes them with a single insert and a single delete.
+        """
+        if any(perm not in ('r', 'rw') for perm in permissions.values()):
+            raise serializers.ValidationError({'message': 'Permission must by r or rw'})
+        instances = list(instances)
+        objects = self._objects_by_content_type(instances)
+        if permissions and objects:
+            groups = dict(Group.objects.filter(name__in=permissions.keys())
+                          .values_list('name', 'id'))
+            if len(groups) != len(permissions):
                 return False
-            for perm in self.PERM_TEMPLATE:
-                remove_perm(perm.format(model_name), group, instance)
-        permissions_removed.send(sender=instance.__class__,
-                                 id=instance.id,
-                                 groups=groups)
+            permission_ids = get_permission_ids(objects.keys())
+            # (group ID, permission ID, content type ID, object pk): ID
+            existing = {row[:4]: row[4] for row in
+                        self._group_object_permissions(objects, groups.values()).values_list(
+                            'group_id', 'permission_id', 'content_type_id', 'object_pk', 'id')}
+
+            to_create = {}
+            to_delete = set()
+            for ct, pks in objects.items():
+                all_perms = [permission_ids[(ct.id, pt.format(ct.model))]
+                             for pt in self.PERM_TEMPLATE]
+                change_perm = permission_ids[(ct.id, 'change_{}'.format(ct.model))]
+                view_perm = permission_ids[(ct.id, 'view_{}'.format(ct.model))]
+                for name, perm in permissions.items():
+                    group_id = groups[name]
+                    for pk in pks:
+                        if perm == 'rw':
+                            wanted = all_perms
+                        else:
+                            wanted = [view_perm]
+                            # Downgrade from rw to read only
+                            if (group_id, change_perm, ct.id, pk) in existing:
+                                to_delete.update(existing.get((group_id, p, ct.id, pk))
+                                                 for p in all_perms if p != view_perm)
+                        for p in wanted:
+                            key = (group_id, p, ct.id, pk)
+                            if key not in existing:
+                                to_create[key] = GroupObjectPermission(group_id=group_id,
+                                                                       permission_id=p,
+                                                                       content_type=ct,
+                                                                       object_pk=pk)
+            to_delete.discard(None)
+            if to_delete:
+                GroupObjectPermission.objects.filter(id__in=to_delete).delete()
+            if to_create:
+                GroupObjectPermission.objects.bulk_create(to_create.values())
+            self._invalidate_cached_permissions(instances)
+        with deferred_view_access():
+            for instance in instances:
+                permissions_changed.send(sender=instance.__class__,
+                                         id=instance.pk,
+                                         permissions=permissions)
+        return True
+
+    def bulk_unassign_permissions(self, instances, groups):
+        """
+        Remove many groups from accessing many objects
+        """
+        group_ids = list(Group.objects.filter(name__in=groups).values_list('id', flat=True))
+        if len(group_ids) != len(set(groups)):
+            return False
+        instances = list(instances)
+        objects = self._objects_by_content_type(instances)
+        if objects:
+            self._group_object_permissions(objects, group_ids).delete()
+            self._invalidate_cached_permissions(instances)
+        with deferred_view_access():
+            for instance in instances:
+                permissions_removed.send(sender=instance.__class__,
+                                         id=instance.pk,
+                                         groups=groups)
         return True
 
     def clone_group_permissions(self, clone_from, clone_to):
@@ -286,13 +504,64 @@ class ViewPermissionsMixin():
         a Project to that of its child Products
         """
         # NEED TO CHECK IF MEMBER OF AT LEAST ONE GROUP BEFORE CLONE!!!!
-        permissions = get_groups_with_perms(clone_from, attach_perms=True)
-        model_name = clone_to._meta.model_name
-        for group, perms in permissions.items():
-            for p in perms:
+        self.bulk_clone_group_permissions([(clone_from, clone_to)])
+
+    def _inherits_from(self, child, parent):
+        """
+        Does child already get its permissions from parent
+        """
+        return any(source.__class__ == parent.__class__ and source.pk == parent.pk
+                   for source in permission_sources(child)[1:])
+
+    def bulk_clone_group_permissions(self, pairs):
+        """
+        Clone group permissions for many (clone_from, clone_to) pairs
+
+        The same as calling clone_group_permissions on each pair but the
+        source permissions are read with one query and the new
+        permissions written with a single insert.
+        """
+        pairs = [(clone_from, clone_to,
+                  ContentType.objects.get_for_model(clone_from),
+                  ContentType.objects.get_for_model(clone_to))
+                 for clone_from, clone_to in pairs
+                 if not self._inherits_from(clone_to, clone_from)]
+        if not pairs:
+            return
+        permission_ids = get_permission_ids(set(p[2] for p in pairs) | set(p[3] for p in pairs))
+        query = Q()
+        for clone_from, clone_to, from_ct, to_ct in pairs:
+            query |= Q(content_type=from_ct, object_pk=str(clone_from.pk))
+        source_perms = {}
+        existing = GroupObjectPermission.objects.filter(query) \
+            .values_list('content_type_id', 'object_pk', 'group_id', 'permission_id')
+        for ct_id, object_pk, group_id, permission_id in existing:
+            source_perms.setdefault((ct_id, object_pk), []).append(
+                (group_id, get_permission_codename(permission_id)))
+
+        to_create = {}
+        for clone_from, clone_to, from_ct, to_ct in pairs:
+            for group_id, codename in source_perms.get((from_ct.id, str(clone_from.pk)), []):
                 # Split permission to get operator e.g. change
-                operator = p.split('_')[0]
-                assign_perm('{}_{}'.format(operator, model_name), group, clone_to)
+                operator = codename.split('_')[0]
+                permission_id = permission_ids[(to_ct.id, '{}_{}'.format(operator, to_ct.model))]
+                key = (group_id, permission_id, str(clone_to.pk))
+                to_create[key] = GroupObjectPermission(group_id=group_id,
+                                                       permission_id=permission_id,
+                                                       content_type=to_ct,
+                                                       object_pk=str(clone_to.pk))
+        if to_create:
+            # Do not duplicate any permissions the targets already have
+            already = GroupObjectPermission.objects.filter(
+                object_pk__in=set(key[2] for key in to_create),
+                permission_id__in=set(key[1] for key in to_create)) \
+                .values_list('group_id', 'permission_id', 'object_pk')
+            for key in already:
+                to_create.pop(key, None)
+            GroupObjectPermission.objects.bulk_create(to_create.values())
+            targets = [clone_to for clone_from, clone_to, from_ct, to_ct in pairs]
+            ViewAccess.objects.sync(targets)
+            self._invalidate_cached_permissions(targets)
 
     def perform_create(self, serializer):
         """
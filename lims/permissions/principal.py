@@ -0,0 +1,120 @@
+import hashlib
+
+from django.conf import settings
+from django.contrib.contenttypes.models import ContentType
+from django.core.cache import cache
+
+from .cache import permission_cache
+from .inheritance import inherited_codename, permission_sources
+
+
+class Principal(object):
+    """
+    Who is making a request: their groups, flags and permissions
+
+    Resolved once per request so permission checks do not need to
+    query the database for group membership each time.
+    """
+
+    def __init__(self, user_id, groups, is_staff, is_superuser, is_active, model_perms):
+        self.user_id = user_id
+        # groups is a list of (group ID, name)
+        self.group_ids = frozenset(group_id for group_id, name in groups)
+        self.groups = frozenset(name for group_id, name in groups)
+        self.is_staff = is_staff
+        self.is_superuser = is_superuser
+        self.is_active = is_active
+        self.model_perms = frozenset(model_perms)
+        self._group_perms = {}
+
+    @classmethod
+    def for_user(cls, user):
+        if not user.is_authenticated():
+            return cls(None, [], False, False, False, [])
+        return cls(user.id,
+                   list(user.groups.values_list('id', 'name')),
+                   user.is_staff,
+                   user.is_superuser,
+                   user.is_active,
+                   user.get_all_permissions())
+
+    def __getstate__(self):
+        # Object permissions are only for this request
+        state = self.__dict__.copy()
+        state['_group_perms'] = {}
+        return state
+
+    @property
+    def is_admin(self):
+        return 'admin' in self.groups
+
+    def in_group(self, name):
+        return name in self.groups
+
+    def group_perms(self, obj):
+        """
+        The codenames of the permissions the user's groups have on obj
+
+        Includes those inherited from its parents. Looked up in the
+        shared permission cache once per request.
+        """
+        ct = ContentType.objects.get_for_model(obj)
+        key = (ct.id, str(obj.pk))
+        if key not in self._group_perms:
+            codenames = set()
+            sources = permission_sources(obj)
+            cached = permission_cache.get_many(sources)
+            for source in sources:
+                for group_id, perms in cached[permission_cache.key_for(source)].items():
+                    if int(group_id) in self.group_ids:
+                        codenames.update(inherited_codename(p, obj._meta.model_name)
+                                         for p in perms)
+            self._group_perms[key] = codenames
+        return self._group_perms[key]
+
+    def has_perm(self, perm, obj=None):
+        """
+        Like user.has_perm but answered from memory where possible
+
+        Object permissions come from the shared permission cache. Only
+        those given to the user's groups count, as they are all that
+        ViewPermissionsMixin manages and all that lists are filtered by.
+        """
+        if not self.is_active:
+            return False
+        if self.is_superuser:
+            return True
+        if obj is None:
+            return perm in self.model_perms
+        return perm.split('.')[-1] in self.group_perms(obj)
+
+    def has_perms(self, perms, obj=None):
+        return all(self.has_perm(perm, obj) for perm in perms)
+
+
+def _cache_key(token):
+    return 'principal:{}'.format(hashlib.sha1(token.encode('utf-8')).hexdigest())
+
+
+def get_principal(user, token=None):
+    """
+    Get the principal for a user, resolving it on first use
+
+    The principal is kept on the user object so lasts as long as the
+    request does. If a JWT is given and PRINCIPAL_CACHE_TIMEOUT is set
+    it is also shared between requests using the same token.
+    """
+    principal = getattr(user, '_principal', None)
+    if principal is not None:
+        return principal
+    timeout = getattr(settings, 'PRINCIPAL_CACHE_TIMEOUT', 0)
+    if token and timeout:
+        key = _cache_key(token)
+        principal = cache.get(key)
+        if principal is None or principal.user_id != user.id:
+            principal = Principal.for_user(user)
+            cache.set(key, principal, timeout)
+    else:
+        principal = Principal.for_user(user)
+    user._principal = principal
+    return principal
@@ -0,0 +1,68 @@
+import threading
+from contextlib import contextmanager
+
+from django.apps import apps
+from django.contrib.contenttypes.models import ContentType
+from django.db.models.signals import post_delete
+from django.dispatch import receiver
+
+from .models import ViewAccess
+from .signals import permissions_changed, permissions_removed
+
+
+_deferred = threading.local()
+
+
+@contextmanager
+def deferred_view_access():
+    """
+    Update the view access of every object changed in the block at once
+
+    Saves bulk changes from updating view access an object at a time
+    as each one sends its own signal.
+    """
+    if getattr(_deferred, 'objects', None) is not None:
+        # Already deferred by an outer block
+        yield
+        return
+    _deferred.objects = []
+    try:
+        yield
+        objects = _deferred.objects
+    finally:
+        _deferred.objects = None
+    ViewAccess.objects.sync(objects)
+
+
+@receiver(permissions_changed)
+@receiver(permissions_removed)
+def update_view_access(sender, **kwargs):
+    """
+    Keep the view access of an object in line with its permissions
+    """
+    obj = sender(pk=kwargs['id'])
+    objects = getattr(_deferred, 'objects', None)
+    if objects is not None:
+        objects.append(obj)
+    else:
+        ViewAccess.objects.sync([obj])
+
+
+def remove_view_access(sender, instance, **kwargs):
+    """
+    Remove the view access of a deleted object
+    """
+    ViewAccess.objects.filter(content_type=ContentType.objects.get_for_model(sender),
+                              object_id=instance.pk).delete()
+
+
+def _connect_remove_view_access():
+    # Only connected to models with a view permission so deletes of
+    # anything else can still be done without loading each object
+    for model in apps.get_models():
+        view_codename = 'view_{}'.format(model._meta.model_name)
+        if any(codename == view_codename for codename, name in model._meta.permissions):
+            post_delete.connect(remove_view_access, sender=model)
+
+
+_connect_remove_view_access()
@@ -0,0 +1,8 @@
+from celery import shared_task
+
+from .models import ViewAccess
+
+
+@shared_task
+def prune_view_access():
+    return ViewAccess.objects.prune()
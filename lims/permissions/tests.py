@@ -1,7 +1,16 @@
-from django.contrib.auth.models import Permission
+from django.contrib.auth.models import Group, Permission, User
 from django.contrib.contenttypes.models import ContentType
+from django.test import override_settings
+from guardian.shortcuts import assign_perm, get_perms
+from lims.inventory.models import Location
+from lims.shared.cache import RedisStore
 from lims.shared.loggedintestcase import LoggedInTestCase
-from rest_framework import status
+from rest_framework import serializers, status
+
+from .cache import permission_cache
+from .models import ViewAccess
+from .permissions import SerializerPermissionsMixin, ViewPermissionsMixin
+from .principal import get_principal
 
 
 class PermissionTestCase(LoggedInTestCase):
@@ -100,3 +109,164 @@ class PermissionTestCase(LoggedInTestCase):
         response = self._client.delete("/permissions/%d/" % self._changeEquipPermission.id)
         self.assertEqual(response.status_code, status.HTTP_405_METHOD_NOT_ALLOWED)
         self.assertIs(Permission.objects.filter(name="Can change equipment").exists(), True)
+
+
+class PrincipalTestCase(LoggedInTestCase):
+
+    def test_principal(self):
+        principal = get_principal(self._adminUser)
+        self.assertIs(principal.is_admin, True)
+        self.assertIs(principal.in_group('staff'), True)
+        self.assertIs(get_principal(self._joeBloggs).is_admin, False)
+        # Only resolved once per user
+        with self.assertNumQueries(0):
+            self.assertIs(get_principal(self._adminUser), principal)
+            get_principal(self._adminUser).is_admin
+
+    def test_object_permissions_once(self):
+        group = Group.objects.get(name='joe_group')
+        assign_perm('change_group', group, group)
+        principal = get_principal(self._joeBloggs)
+        self.assertIs(principal.has_perm('auth.change_group', group), True)
+        with self.assertNumQueries(0):
+            self.assertIs(principal.has_perm('auth.change_group', group), True)
+            self.assertIs(principal.has_perm('auth.delete_group', group), False)
+
+    def test_user_object_permissions_ignored(self):
+        # Lists only show objects shared with a user's groups so a
+        # permission given to the user directly does not allow access
+        location = Location.objects.create(name="Bench", code="B1")
+        assign_perm('view_location', self._joeBloggs, location)
+        self.assertIs(get_principal(self._joeBloggs).has_perm('inventory.view_location',
+                                                              location), False)
+
+    @override_settings(PRINCIPAL_CACHE_TIMEOUT=60)
+    def test_principal_cached_by_token(self):
+        principal = get_principal(self._janeDoe, 'a.token')
+        user = User.objects.get(pk=self._janeDoe.pk)
+        with self.assertNumQueries(0):
+            self.assertEqual(get_principal(user, 'a.token').groups, principal.groups)
+
+
+class BulkPermissionsTestCase(LoggedInTestCase):
+    def setUp(self):
+        super(BulkPermissionsTestCase, self).setUp()
+        self._locations = [Location.objects.create(name="Bench %d" % i, code="B%d" % i)
+                           for i in range(20)]
+        self._joe_group = Group.objects.get(name="joe_group")
+        self._jane_group = Group.objects.get(name="jane_group")
+
+    def test_bulk_assign_permissions(self):
+        mixin = ViewPermissionsMixin()
+        permissions = {"joe_group": "rw", "jane_group": "r"}
+        mixin.bulk_assign_permissions(self._locations[:1], permissions)
+        # Groups, existing permissions and insert then updating view access
+        with self.assertNumQueries(6):
+            mixin.bulk_assign_permissions(self._locations, permissions)
+        for location in self._locations:
+            self.assertEqual(len(get_perms(self._joe_group, location)), 4)
+            self.assertEqual(get_perms(self._jane_group, location), ["view_location"])
+        mixin.bulk_assign_permissions(self._locations, {"joe_group": "r"})
+        self.assertEqual(get_perms(self._joe_group, self._locations[5]), ["view_location"])
+        self.assertIs(mixin.bulk_assign_permissions(self._locations, {"nobody": "r"}), False)
+        mixin.bulk_unassign_permissions(self._locations, ["joe_group", "jane_group"])
+        self.assertEqual(get_perms(self._joe_group, self._locations[5]), [])
+        self.assertEqual(get_perms(self._jane_group, self._locations[5]), [])
+
+    def test_bulk_clone_group_permissions(self):
+        mixin = ViewPermissionsMixin()
+        source = self._locations[0]
+        mixin.assign_permissions(source, {"joe_group": "rw"})
+        with self.assertNumQueries(6):
+            mixin.bulk_clone_group_permissions([(source, l) for l in self._locations[1:]])
+        for location in self._locations:
+            self.assertEqual(len(get_perms(self._joe_group, location)), 4)
+
+    def test_list_permissions_loaded_together(self):
+        class LocationSerializer(SerializerPermissionsMixin, serializers.ModelSerializer):
+            class Meta:
+                model = Location
+                fields = ('id', 'name', 'permissions')
+
+        ViewPermissionsMixin().bulk_assign_permissions(self._locations[1:],
+                                                       {"joe_group": "r"})
+        with self.assertNumQueries(1):
+            data = LocationSerializer(self._locations, many=True).data
+        self.assertEqual(data[0]["permissions"], {})
+        self.assertEqual(data[1]["permissions"], {"joe_group": ["view_location"]})
+        single = LocationSerializer(self._locations[1]).data
+        self.assertEqual(single["permissions"], data[1]["permissions"])
+
+    def test_view_access_follows_permissions(self):
+        mixin = ViewPermissionsMixin()
+        mixin.bulk_assign_permissions(self._locations[:10], {"joe_group": "rw"})
+        mixin.assign_permissions(self._locations[10], {"jane_group": "r"})
+        visible = Location.objects.filter(
+            pk__in=ViewAccess.objects.visible_to(Location, [self._joe_group.id]))
+        self.assertEqual(set(visible), set(self._locations[:10]))
+        # Cloned permissions are indexed too
+        mixin.bulk_clone_group_permissions([(self._locations[0], self._locations[11])])
+        self.assertEqual(visible.count(), 11)
+        mixin.bulk_unassign_permissions(self._locations[:5], ["joe_group"])
+        self.assertEqual(set(visible), set(self._locations[5:10] + [self._locations[11]]))
+        self.assertEqual(list(ViewAccess.objects.filter(group=self._jane_group)
+                              .values_list('object_id', flat=True)), [self._locations[10].id])
+
+    def test_view_access_removed_with_object(self):
+        mixin = ViewPermissionsMixin()
+        mixin.bulk_assign_permissions(self._locations[:2], {"joe_group": "r"})
+        location = self._locations[0]
+        location_id = location.id
+        location.delete()
+        self.assertIs(ViewAccess.objects.filter(object_id=location_id).exists(), False)
+        self.assertEqual(ViewAccess.objects.filter(group=self._joe_group).count(), 1)
+        # Access left by objects deleted without post_delete is pruned
+        ViewAccess.objects.create(content_type=ContentType.objects.get_for_model(Location),
+                                  object_id=location_id, group=self._joe_group)
+        self.assertEqual(ViewAccess.objects.prune(), 1)
+        self.assertEqual(list(ViewAccess.objects.values_list('object_id', flat=True)),
+                         [self._locations[1].id])
+
+    def test_permission_cache(self):
+        mixin = ViewPermissionsMixin()
+        location = self._locations[0]
+        mixin.assign_permissions(location, {"joe_group": "r"})
+        permission_cache.reset_stats()
+        self.assertEqual(permission_cache.get(location),
+                         {str(self._joe_group.id): ["view_location"]})
+        with self.assertNumQueries(0):
+            permission_cache.get(location)
+        self.assertEqual(permission_cache.stats(), {"hits": 1, "misses": 1})
+        # Changing permissions drops the cached copy
+        mixin.assign_permissions(location, {"joe_group": "rw"})
+        self.assertEqual(len(permission_cache.get(location)[str(self._joe_group.id)]), 4)
+        mixin.unassign_permissions(location, ["joe_group"])
+        self.assertEqual(permission_cache.get(location), {})
+        self.assertEqual(permission_cache.stats(), {"hits": 1, "misses": 3})
+
+    def test_permission_cache_unavailable(self):
+        mixin = ViewPermissionsMixin()
+        location = self._locations[0]
+        # Nothing listens on port 1 so every call to Redis fails
+        store, permission_cache._store = permission_cache._store, \
+            RedisStore('redis://127.0.0.1:1/0')
+        try:
+            mixin.assign_permissions(location, {"joe_group": "r"})
+            self.assertEqual(permission_cache.get(location),
+                             {str(self._joe_group.id): ["view_location"]})
+            principal = get_principal(self._joeBloggs)
+            self.assertIs(principal.has_perm("inventory.view_location", location), True)
+            self._asAdmin()
+            response = self._client.get('/permissions/cache_stats/')
+            self.assertEqual(response.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+        finally:
+            permission_cache._store = store
+
+    def test_cache_stats(self):
+        self._asJoeBloggs()
+        response = self._client.get('/permissions/cache_stats/')
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+        self._asAdmin()
+        response = self._client.get('/permissions/cache_stats/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertIn("hits", response.data)
@@ -1,7 +1,14 @@
 from django.contrib.auth.models import Permission
 
 from rest_framework import viewsets
+from rest_framework.decorators import list_route
+from rest_framework.exceptions import PermissionDenied
+from rest_framework.response import Response
 
+from lims.shared.cache import CacheUnavailable
+
+from .cache import permission_cache
+from .principal import get_principal
 from .serializers import PermissionSerializer
 
 
@@ -9,3 +16,17 @@ class PermissionViewSet(viewsets.ReadOnlyModelViewSet):
     queryset = Permission.objects.all()
     serializer_class = PermissionSerializer
     search_fields = ('name',)
+
+    @list_route()
+    def cache_stats(self, request):
+        """
+        Hits and misses of the shared object permission cache
+
+        Admin only.
+        """
+        if not get_principal(request.user).is_admin:
+            raise PermissionDenied()
+        try:
+            return Response(permission_cache.stats())
+        except CacheUnavailable:
+            return Response({'message': 'Permission cache unavailable'}, status=503)
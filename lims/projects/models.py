@@ -170,6 +170,8 @@ class Product(models.Model):
     last_modified_on = models.DateTimeField(auto_now=True)
 
     project = models.ForeignKey(Project)
+    # Shares the project's permissions when PERMISSION_INHERITANCE is on
+    inherit_permissions_from = 'project'
 
     #
     # DEPRECIATION WARNING: THESE ARE TO BE MOVED TO PROPERTIES JSON1G
@@ -207,6 +209,8 @@ class Product(models.Model):
         return '{}-{}'.format(self.project.project_identifier, self.identifier)
 
     def on_run(self):
+        if 'runs' in getattr(self, '_prefetched_objects_cache', {}):
+            return any(r.is_active for r in self.runs.all())
         if self.runs.filter(is_active=True).count() > 0:
             return True
         return False
@@ -20,6 +20,7 @@ from lims.permissions.permissions import (IsInAdminGroupOrRO,
                                           ViewPermissionsMixin,
                                           ExtendedObjectPermissions,
                                           ExtendedObjectPermissionsFilter)
+from lims.permissions.principal import get_principal
 
 from lims.shared.mixins import StatsViewMixin, AuditTrailViewMixin
 from lims.datastore.serializers import AttachmentSerializer
@@ -201,7 +202,7 @@ class ProductViewSet(AuditTrailViewMixin, ViewPermissionsMixin, StatsViewMixin,
         # to add a product to it.
         project = serializer.validated_data['project']
         if ('change_project' in get_group_perms(self.request.user, project)
-                or self.request.user.groups.filter(name='admin').exists()):
+                or get_principal(self.request.user).is_admin):
             instance = serializer.save(created_by=self.request.user)
             self.clone_group_permissions(instance.project, instance)
         else:
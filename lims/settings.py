@@ -54,6 +54,7 @@ INSTALLED_APPS = (
     'guardian',
     'django_celery_beat',
     'lims.shared',
+    'lims.permissions',
     'lims.users',
     'lims.addressbook',
     'lims.pricebook',
@@ -179,6 +180,35 @@ CHANNEL_LAYERS = {
     },
 }
 
+# Use an in memory channel layer when testing so Redis is not required
+if TESTMODE:
+    CHANNEL_LAYERS['default'] = {
+        'BACKEND': 'asgiref.inmemory.ChannelLayer',
+        'ROUTING': 'lims.urls.channel_routing',
+    }
+
+# Shared cache of the group permissions on each object. Uses the same
+# Redis as above, or the default cache when testing.
+PERMISSION_CACHE_URL = None if TESTMODE else os.environ.get(
+    'PERMISSION_CACHE_URL', os.environ.get('REDIS_URL', 'redis://127.0.0.1:6379'))
+PERMISSION_CACHE_TIMEOUT = int(os.environ.get('PERMISSION_CACHE_TIMEOUT', 3600))
+
+# Shared cache of the fields of each task template, as above
+TASK_FIELD_CACHE_URL = None if TESTMODE else os.environ.get(
+    'TASK_FIELD_CACHE_URL', os.environ.get('REDIS_URL', 'redis://127.0.0.1:6379'))
+TASK_FIELD_CACHE_TIMEOUT = int(os.environ.get('TASK_FIELD_CACHE_TIMEOUT', 3600))
+
+# Resolve the permissions of products and task fields from their project
+# or task rather than copying the permissions to each one
+PERMISSION_INHERITANCE = literal_eval(os.environ.get('PERMISSION_INHERITANCE', 'False'))
+
+# Run celery tasks in process when testing
+CELERY_TASK_ALWAYS_EAGER = TESTMODE
+CELERY_TASK_EAGER_PROPAGATES = TESTMODE
+
+# The number of files copied from equipment at once at the end of a task
+FILE_COPY_WORKERS = int(os.environ.get('FILE_COPY_WORKERS', 4))
+
 #
 # Logging
 #
@@ -239,7 +269,7 @@ REST_FRAMEWORK = {
         'rest_framework.permissions.IsAuthenticated',
     ],
     'DEFAULT_AUTHENTICATION_CLASSES': (
-        'rest_framework_jwt.authentication.JSONWebTokenAuthentication',
+        'lims.permissions.authentication.PrincipalJSONWebTokenAuthentication',
         'rest_framework.authentication.SessionAuthentication',
     ),
     'DEFAULT_FILTER_BACKENDS': (
@@ -268,6 +298,10 @@ JWT_AUTH = {
     'JWT_EXPIRATION_DELTA': datetime.timedelta(hours=12),
 }
 
+# Seconds to share a user's groups and permissions between requests
+# made with the same token. 0 looks them up afresh for every request.
+PRINCIPAL_CACHE_TIMEOUT = int(os.environ.get('PRINCIPAL_CACHE_TIMEOUT', 0))
+
 #
 # App configuration
 #
@@ -0,0 +1,102 @@
+import json
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from django.core.cache import cache as django_cache
+from django.core.serializers.json import DjangoJSONEncoder
+
+
+class CacheUnavailable(Exception):
+    """
+    The cache could not be reached, callers should fall back to the database
+    """
+    pass
+
+
+class RedisStore(object):
+    """
+    Store cached values as JSON in Redis so they are shared by every process
+
+    Any Redis error is raised as CacheUnavailable.
+    """
+
+    def __init__(self, url):
+        import redis
+        self.client = redis.StrictRedis.from_url(url)
+        self._errors = redis.RedisError
+
+    @contextmanager
+    def _unavailable(self):
+        try:
+            yield
+        except self._errors as e:
+            raise CacheUnavailable(e)
+
+    def get_many(self, keys):
+        with self._unavailable():
+            values = self.client.mget(keys) if keys else []
+        return {key: json.loads(value.decode('utf-8'), object_pairs_hook=OrderedDict)
+                for key, value in zip(keys, values) if value is not None}
+
+    def set_many(self, values, timeout):
+        pipe = self.client.pipeline(transaction=False)
+        for key, value in values.items():
+            pipe.setex(key, timeout, json.dumps(value, cls=DjangoJSONEncoder))
+        with self._unavailable():
+            pipe.execute()
+
+    def delete_many(self, keys):
+        if keys:
+            with self._unavailable():
+                self.client.delete(*keys)
+
+    def incr_many(self, counts):
+        pipe = self.client.pipeline(transaction=False)
+        for key, count in counts.items():
+            pipe.incrby(key, count)
+        with self._unavailable():
+            pipe.execute()
+
+    def get_counter(self, key):
+        with self._unavailable():
+            return int(self.client.get(key) or 0)
+
+    def reset_counter(self, key):
+        with self._unavailable():
+            self.client.delete(key)
+
+
+class DjangoCacheStore(object):
+    """
+    Store cached values in the default Django cache
+
+    Only shared within a process so used when no Redis URL is
+    configured, e.g. when testing.
+    """
+
+    def get_many(self, keys):
+        return django_cache.get_many(keys)
+
+    def set_many(self, values, timeout):
+        django_cache.set_many(values, timeout)
+
+    def delete_many(self, keys):
+        django_cache.delete_many(keys)
+
+    def incr_many(self, counts):
+        for key, count in counts.items():
+            django_cache.add(key, 0, None)
+            django_cache.incr(key, count)
+
+    def get_counter(self, key):
+        return django_cache.get(key, 0)
+
+    def reset_counter(self, key):
+        django_cache.delete(key)
+
+
+def get_store(url):
+    """
+    Get a Redis store for url or the Django cache if it is not set
+    """
+    return RedisStore(url) if url else DjangoCacheStore()
@@ -0,0 +1,15 @@
+from rest_framework import status
+from rest_framework.exceptions import APIException
+
+
+class Conflict(APIException):
+    """
+    The request conflicts with a change made by another request
+
+    The client can reload and try again.
+    """
+    status_code = status.HTTP_409_CONFLICT
+    default_detail = 'Conflicts with another change, please reload and try again'
+
+    def __init__(self, message=None):
+        super().__init__({'message': message or self.default_detail})
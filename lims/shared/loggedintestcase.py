@@ -1,3 +1,4 @@
+from django.db import connection
 from django.test import TestCase
 from django.contrib.auth.models import User, Group
 from rest_framework.test import APIClient
@@ -52,3 +53,10 @@ class LoggedInTestCase(TestCase):
     def _asInvalid(self):
         self._client.logout()
         self._client.login(username="Non Existent", password="made_up")
+
+    # Utility function to run what would happen once the test's transaction
+    # commits, which it never does in a TestCase
+    def _runOnCommit(self):
+        callbacks, connection.run_on_commit = connection.run_on_commit, []
+        for savepoint_ids, callback in callbacks:
+            callback()
@@ -10,6 +10,8 @@ from rest_framework.decorators import list_route, detail_route
 from rest_framework.serializers import ValidationError
 from rest_framework.exceptions import PermissionDenied
 
+from lims.permissions.principal import get_principal
+
 
 class StatsViewMixin(viewsets.ViewSet):
     """
@@ -96,7 +98,7 @@ class AuditTrailViewMixin(viewsets.ViewSet):
     @detail_route(methods=['POST'])
     def revert(self, request, pk=None):
         # Admin only
-        if not self.request.user.groups.filter(name='admin').exists():
+        if not get_principal(self.request.user).is_admin:
             raise PermissionDenied()
         instance = self.get_object()
         version = request.query_params.get('version', None)  # 0-index, fail if not provided
@@ -0,0 +1,14 @@
+from django.db.models.signals import post_save
+
+
+def send_post_save(model, instances, created=False, update_fields=None):
+    """
+    Send post_save for instances written without calling save
+
+    Bulk inserts and set based updates skip save so anything listening,
+    e.g. reversion or trigger sets, would not otherwise see the change.
+    """
+    if post_save.has_listeners(model):
+        for instance in instances:
+            post_save.send(sender=model, instance=instance, created=created, raw=False,
+                           using=model.objects.db, update_fields=update_fields)
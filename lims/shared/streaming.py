@@ -0,0 +1,77 @@
+import csv
+
+from django.db.models import prefetch_related_objects
+
+
+class Echo(object):
+    """
+    A file-like object that returns what is written to it
+
+    Lets csv.writer produce a row at a time for a streaming response.
+    """
+
+    def write(self, value):
+        return value
+
+
+def flatten_row(row, prefix=''):
+    """
+    Flatten nested dicts/lists into a single level with dotted keys
+
+    Matches the header names given by the CSV renderer, e.g.
+    {'item': {'name': 'a'}} becomes {'item.name': 'a'}
+    """
+    flat = {}
+    if isinstance(row, dict):
+        items = row.items()
+    elif isinstance(row, (list, tuple)):
+        items = enumerate(row)
+    else:
+        return {prefix: row}
+    for key, value in items:
+        full_key = '{}.{}'.format(prefix, key) if prefix else str(key)
+        if isinstance(value, (dict, list, tuple)):
+            flat.update(flatten_row(value, full_key))
+        else:
+            flat[full_key] = value
+    return flat
+
+
+def csv_rows(get_rows):
+    """
+    Generate CSV text for an iterable of dicts a row at a time
+
+    get_rows is called twice to get the rows. Rows can have different
+    columns, e.g. a list that is longer in later rows, so the first
+    pass collects every column for the header, as the CSV renderer
+    does, and the second writes the rows. Neither pass holds the rows
+    in memory.
+    """
+    columns = set()
+    for row in get_rows():
+        columns.update(flatten_row(row).keys())
+    header = sorted(columns)
+    buffer = Echo()
+    writer = csv.DictWriter(buffer, header)
+    yield writer.writerow(dict(zip(header, header)))
+    for row in get_rows():
+        yield writer.writerow(flatten_row(row))
+
+
+def iterate_in_chunks(queryset, serializer_class, prefetch=(), chunk_size=500):
+    """
+    Serialize a queryset a chunk at a time using a server side cursor
+
+    Related objects in prefetch are loaded for each chunk as
+    prefetch_related has no effect when using iterator().
+    """
+    chunk = []
+    for obj in queryset.iterator():
+        chunk.append(obj)
+        if len(chunk) == chunk_size:
+            prefetch_related_objects(chunk, *prefetch)
+            yield from serializer_class(chunk, many=True).data
+            chunk = []
+    if chunk:
+        prefetch_related_objects(chunk, *prefetch)
+        yield from serializer_class(chunk, many=True).data
@@ -1,6 +1,7 @@
 from lims.shared.loggedintestcase import LoggedInTestCase
 from rest_framework import status
 from .models import Organism, Trigger, TriggerAlertStatus, TriggerSet, TriggerSubscription
+from .streaming import csv_rows
 from lims.addressbook.models import Address
 from django.db.models.signals import post_save
 import datetime
@@ -691,3 +692,17 @@ class TriggerTestCase(LoggedInTestCase):
                          TriggerAlertStatus.ACTIVE)
         self.assertEqual(TriggerAlertStatus.objects.get(id=jane_alert_status.id).status,
                          TriggerAlertStatus.ACTIVE)
+
+
+class StreamingTestCase(LoggedInTestCase):
+    def test_csv_rows_different_shapes(self):
+        rows = [
+            {"name": "a", "values": [1], "task_input": None},
+            {"name": "b", "values": [1, 2, 3], "task_input": {"name": "x", "amount": 2}},
+        ]
+        lines = "".join(csv_rows(lambda: iter(rows))).splitlines()
+        self.assertEqual(lines, [
+            "name,task_input,task_input.amount,task_input.name,values.0,values.1,values.2",
+            "a,,,,1,,",
+            "b,,2,x,1,2,3",
+        ])
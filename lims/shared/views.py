@@ -1,12 +1,12 @@
 from rest_framework import viewsets, mixins
 from rest_framework.decorators import detail_route
-from django.contrib.auth.models import Group
 from rest_framework.response import Response
 from rest_framework.filters import DjangoFilterBackend
 from rest_framework.serializers import ValidationError
 import datetime
 
 from lims.permissions.permissions import IsInAdminGroupOrRO
+from lims.permissions.principal import get_principal
 from lims.shared.mixins import AuditTrailViewMixin
 
 from .models import Organism, TriggerSet, Trigger, TriggerAlertStatus, TriggerSubscription
@@ -51,15 +51,15 @@ class TriggerSubscriptionViewSet(AuditTrailViewMixin, viewsets.ModelViewSet):
     filter_backends = (DjangoFilterBackend,)
 
     def get_queryset(self):
-        if self.request.user.is_superuser or \
-                        Group.objects.get(name="admin") in self.request.user.groups.all():
+        principal = get_principal(self.request.user)
+        if principal.is_superuser or principal.is_admin:
             return TriggerSubscription.objects.all()
         else:
             return TriggerSubscription.objects.filter(user=self.request.user)
 
     def perform_create(self, serializer):
         # Allow an admin user to set the user but otherwise can only create own subscriptions
-        if self.request.user.groups.filter(name='admin').exists() or self.request.user == \
+        if get_principal(self.request.user).is_admin or self.request.user == \
                 serializer.validated_data['user']:
             serializer.save()
         else:
@@ -73,8 +73,8 @@ class TriggerAlertStatusViewSet(mixins.RetrieveModelMixin, mixins.ListModelMixin
     filter_backends = (DjangoFilterBackend,)
 
     def get_queryset(self):
-        if self.request.user.is_superuser or \
-                        Group.objects.get(name="admin") in self.request.user.groups.all():
+        principal = get_principal(self.request.user)
+        if principal.is_superuser or principal.is_admin:
             return TriggerAlertStatus.objects.all()
         else:
             return TriggerAlertStatus.objects.filter(user=self.request.user)
@@ -85,9 +85,10 @@ class TriggerAlertStatusViewSet(mixins.RetrieveModelMixin, mixins.ListModelMixin
         alertstatus = self.get_object()
         if alertstatus is None:
             return Response(status=404)
+        principal = get_principal(self.request.user)
         if not alertstatus.user == self.request.user and \
-                not self.request.user.is_superuser and \
-                not Group.objects.get(name="admin") in self.request.user.groups.all():
+                not principal.is_superuser and \
+                not principal.is_admin:
             return Response(status=403)
         # Silence for this user only
         alertstatus.status = TriggerAlertStatus.SILENCED
@@ -101,9 +102,10 @@ class TriggerAlertStatusViewSet(mixins.RetrieveModelMixin, mixins.ListModelMixin
         alertstatus = self.get_object()
         if alertstatus is None:
             return Response(status=404)
+        principal = get_principal(self.request.user)
         if not alertstatus.user == self.request.user and \
-                not self.request.user.is_superuser and \
-                not Group.objects.get(name="admin") in self.request.user.groups.all():
+                not principal.is_superuser and \
+                not principal.is_admin:
             return Response(status=403)
         # Dismiss for all users that have not already silenced this alert
         for related_alert in alertstatus.triggeralert.statuses.all():
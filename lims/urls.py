@@ -15,6 +15,7 @@ from lims.permissions.views import PermissionViewSet
 from lims.shared.views import OrganismViewSet, TriggerAlertStatusViewSet, TriggerSetViewSet, \
     TriggerViewSet, TriggerSubscriptionViewSet
 from lims.shared.consumers import send_email
+from lims.workflows.consumers import run_connect, run_disconnect
 
 from lims.addressbook.views import AddressViewSet
 from lims.pricebook.views import PriceBookViewSet
@@ -86,5 +87,7 @@ urlpatterns = [
 ] + static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
 
 channel_routing = [
-    route('send-email', send_email)
+    route('send-email', send_email),
+    route('websocket.connect', run_connect, path=r'^/runs/(?P<run_id>\d+)/$'),
+    route('websocket.disconnect', run_disconnect, path=r'^/runs/(?P<run_id>\d+)/$'),
 ]
@@ -20,6 +20,7 @@ from lims.crm.serializers import CreateCRMAccountSerializer
 from .serializers import (UserSerializer, GroupSerializer,
                           RegisterUserSerializer, SimpleUserSerializer,)
 from lims.permissions.permissions import (IsInAdminGroupOrRO, IsInAdminGroupOrTheUser)
+from lims.permissions.principal import get_principal
 from lims.shared.mixins import AuditTrailViewMixin
 from lims.users.models import ResetCode
 
@@ -77,7 +78,7 @@ class UserViewSet(AuditTrailViewMixin, viewsets.ModelViewSet):
     filter_class = UserFilter
 
     def get_queryset(self):
-        if self.request.user.groups.filter(name='admin').exists():
+        if get_principal(self.request.user).is_admin:
             # Exclude the system specific AnonymousUser from results as deleting could cause issues
             return User.objects.exclude(username='AnonymousUser')
         else:
@@ -91,7 +92,7 @@ class UserViewSet(AuditTrailViewMixin, viewsets.ModelViewSet):
         new_password = request.data.get('new_password', None)
         if new_password:
             user = self.get_object()
-            if request.user.id == user.id or request.user.groups.filter(name='admin').exists():
+            if request.user.id == user.id or get_principal(request.user).is_admin:
                 user.set_password(new_password)
                 user.save()
                 return Response({'message': 'Password for {} changed'.format(user.username)})
@@ -209,7 +210,7 @@ class GroupViewSet(AuditTrailViewMixin, viewsets.ModelViewSet):
     search_fields = ('name',)
 
     def get_queryset(self):
-        if self.request.user.groups.filter(name='admin').exists():
+        if get_principal(self.request.user).is_admin:
             return Group.objects.all()
         else:
             return self.request.user.groups.all()
@@ -1,8 +1,10 @@
 from __future__ import division
 from pyparsing import (Literal, CaselessLiteral, Word, Combine, Group, Optional,
-                       ZeroOrMore, Forward, nums, alphas, oneOf)
+                       ZeroOrMore, Forward, Regex, nums, alphas, oneOf, ParseException)
+from collections import OrderedDict
 import math
 import operator
+import threading
 
 __author__ = 'Paul McGuire'
 __version__ = '$Revision: 0.0 $'
@@ -46,6 +48,9 @@ class NumericStringParser(object):
                           Optional(point + Optional(Word(nums))) +
                           Optional(e + Word("+-" + nums, nums)))
         ident = Word(alphas, alphas + nums + "_$")
+        # A reference to a field value e.g. {input1}, kept as a single token
+        # so calculations can be compiled once and evaluated many times.
+        field = Regex(r'\{(.+?)\}')
         plus = Literal("+")
         minus = Literal("-")
         mult = Literal("*")
@@ -58,7 +63,8 @@ class NumericStringParser(object):
         pi = CaselessLiteral("PI")
         expr = Forward()
         atom = ((Optional(oneOf("- +")) +
-                 (pi | e | fnumber | ident + lpar + expr + rpar).setParseAction(self.pushFirst))
+                 (pi | e | fnumber | field |
+                  ident + lpar + expr + rpar).setParseAction(self.pushFirst))
                 | Optional(oneOf("- +")) + Group(lpar + expr + rpar)
                 ).setParseAction(self.pushUMinus)
         # by defining exponentiation as "atom [ ^ factor ]..." instead of
@@ -101,7 +107,7 @@ class NumericStringParser(object):
             return math.e  # 2.718281828
         elif op in self.fn:
             return self.fn[op](self.evaluateStack(s))
-        elif op[0].isalpha():
+        elif op[0].isalpha() or op[0] == '{':
             return 0
         else:
             return float(op)
@@ -111,3 +117,296 @@ class NumericStringParser(object):
         self.bnf.parseString(num_string, parseAll)
         val = self.evaluateStack(self.exprStack[:])
         return val
+
+    def buildTree(self, s):
+        """
+        Turn the expression stack into a tree of tuples rather than a value
+
+        Mirrors evaluateStack so a compiled calculation gives the same
+        result as eval would on the interpolated string.
+        """
+        op = s.pop()
+        if op == 'unary -':
+            return ('neg', self.buildTree(s))
+        if op in "+-*/^":
+            op2 = self.buildTree(s)
+            op1 = self.buildTree(s)
+            return ('op', op, op1, op2)
+        elif op == "PI":
+            return ('num', math.pi)
+        elif op == "E":
+            return ('num', math.e)
+        elif op in self.fn:
+            return ('fn', op, self.buildTree(s))
+        elif op[0] == '{':
+            return ('field', op[1:-1])
+        elif op[0].isalpha():
+            return ('num', 0)
+        else:
+            return ('num', float(op))
+
+    def parse(self, num_string, parseAll=True):
+        self.exprStack = []
+        self.bnf.parseString(num_string, parseAll)
+        return self.buildTree(self.exprStack[:])
+
+
+class CompiledCalculation(object):
+    """
+    A calculation parsed once and evaluated against many sets of values
+
+    Field references (e.g. {input1}) are looked up in the values given
+    to evaluate, missing fields count as 0 as they do when the values
+    are interpolated into the calculation string.
+    """
+
+    def __init__(self, calculation, tree, opn, fn):
+        self.calculation = calculation
+        self.tree = tree
+        self.fields = set()
+        self._opn = opn
+        self._fn = fn
+        self._evaluate = self._compile(tree)
+        self._evaluate_columns = self._compile_columns(tree)
+
+    def _compile(self, node):
+        kind = node[0]
+        if kind == 'num':
+            value = node[1]
+            return lambda values: value
+        elif kind == 'field':
+            label = node[1]
+            self.fields.add(label)
+            return lambda values: values[label]
+        elif kind == 'neg':
+            operand = self._compile(node[1])
+            return lambda values: -operand(values)
+        elif kind == 'fn':
+            func = self._fn[node[1]]
+            arg = self._compile(node[2])
+            return lambda values: func(arg(values))
+        func = self._opn[node[1]]
+        op1 = self._compile(node[2])
+        op2 = self._compile(node[3])
+        return lambda values: func(op1(values), op2(values))
+
+    def _compile_columns(self, node):
+        # As _compile but each step operates over a whole column of values
+        # at once. A value that cannot be calculated becomes None and stays
+        # None for the rest of the calculation so one bad row does not
+        # prevent the others being calculated.
+        kind = node[0]
+        if kind == 'num':
+            value = node[1]
+            return lambda columns, size: [value] * size
+        elif kind == 'field':
+            label = node[1]
+            return lambda columns, size: columns[label]
+        elif kind == 'neg':
+            operand = self._compile_columns(node[1])
+            return lambda columns, size: [None if v is None else -v
+                                          for v in operand(columns, size)]
+        elif kind == 'fn':
+            func = self._safe(self._fn[node[1]])
+            arg = self._compile_columns(node[2])
+            return lambda columns, size: [func(v) for v in arg(columns, size)]
+        func = self._safe(self._opn[node[1]])
+        op1 = self._compile_columns(node[2])
+        op2 = self._compile_columns(node[3])
+        return lambda columns, size: [func(a, b) for a, b in zip(op1(columns, size),
+                                                                 op2(columns, size))]
+
+    def _safe(self, func):
+        def apply(*args):
+            if None in args:
+                return None
+            try:
+                return func(*args)
+            except (TypeError, ValueError, ZeroDivisionError, OverflowError):
+                return None
+        return apply
+
+    def _to_number(self, value):
+        if type(value) is not float:
+            value = float(value)
+        return value
+
+    def evaluate(self, values):
+        """
+        Perform the calculation using a dict of field label: value
+
+        Returns None if the calculation cannot be performed, e.g. a
+        field has no numeric value or there is a division by zero.
+        """
+        try:
+            resolved = {f: self._to_number(values.get(f, 0)) for f in self.fields}
+            return self._evaluate(resolved)
+        except (TypeError, ValueError, ZeroDivisionError, OverflowError):
+            return None
+
+    def evaluate_many(self, columns, size):
+        """
+        Perform the calculation over columns of values in one pass
+
+        columns is a dict of field label: list of values, one value per
+        row. Missing fields count as 0. Returns a list of results in row
+        order with None for any row that could not be calculated.
+        """
+        to_number = self._safe(self._to_number)
+        resolved = {}
+        for f in self.fields:
+            column = columns.get(f, None)
+            if column is None:
+                resolved[f] = [0.0] * size
+            else:
+                resolved[f] = [to_number(v) for v in column]
+        return self._evaluate_columns(resolved, size)
+
+    def __str__(self):
+        return self.calculation
+
+
+class CalculationCache(object):
+    """
+    Process wide store of compiled calculations
+
+    Entries are keyed on the ID of the CalculationFieldTemplate and the
+    calculation text itself (which acts as the revision) so an edited
+    calculation, or one altered in submitted task data, is never served
+    stale. Entries for a template are evicted when it is saved/deleted.
+    """
+
+    def __init__(self, max_size=1024):
+        self.max_size = max_size
+        self._compiled = OrderedDict()
+        self._lock = threading.Lock()
+        self._parser = NumericStringParser()
+
+    def get(self, calculation, calculation_id=None):
+        """
+        Get a compiled calculation, compiling it if not already cached
+
+        Returns None if the calculation cannot be parsed.
+        """
+        key = (calculation_id, calculation)
+        with self._lock:
+            try:
+                compiled = self._compiled.pop(key)
+            except KeyError:
+                compiled = self._compile(calculation)
+                if len(self._compiled) >= self.max_size:
+                    self._compiled.popitem(last=False)
+            self._compiled[key] = compiled
+        return compiled
+
+    def _compile(self, calculation):
+        # The parser keeps its stack on the instance so this must only
+        # be called while holding the lock.
+        try:
+            tree = self._parser.parse(calculation)
+        except ParseException:
+            return None
+        return CompiledCalculation(calculation, tree, self._parser.opn, self._parser.fn)
+
+    def evict(self, calculation_id):
+        """
+        Remove all compiled versions of a calculation field
+        """
+        with self._lock:
+            for key in [k for k in self._compiled if k[0] == calculation_id]:
+                del self._compiled[key]
+
+    def clear(self):
+        with self._lock:
+            self._compiled.clear()
+
+
+calculation_cache = CalculationCache()
+
+
+class CalculationGraph(object):
+    """
+    The calculations on a task ordered by the dependencies between them
+
+    A calculation may refer to the label of another calculation as if
+    it was a field, e.g. {calc1}*2. Calculations are evaluated in
+    topological order so any calculation is performed after those it
+    depends on. Calculations that are part of a cycle cannot be ordered
+    and are given a result of None.
+    """
+
+    def __init__(self, calculations):
+        # calculations is a list of (label, CompiledCalculation or None)
+        self.compiled = OrderedDict(calculations)
+        self.dependents = {label: set() for label in self.compiled}
+        depends_on = {}
+        for label, compiled in self.compiled.items():
+            fields = compiled.fields if compiled is not None else set()
+            depends_on[label] = set(f for f in fields if f in self.compiled and f != label)
+            for f in depends_on[label]:
+                self.dependents[f].add(label)
+            if compiled is not None and label in compiled.fields:
+                # Refers to itself so can never be calculated
+                depends_on[label].add(label)
+        self.order, self.cyclic = self._sort(depends_on)
+
+    def _sort(self, depends_on):
+        remaining = {label: len(deps) for label, deps in depends_on.items()}
+        ready = [label for label in self.compiled if remaining[label] == 0]
+        order = []
+        while ready:
+            label = ready.pop(0)
+            order.append(label)
+            for dependent in self.dependents[label]:
+                remaining[dependent] -= 1
+                if remaining[dependent] == 0:
+                    ready.append(dependent)
+        cyclic = [label for label in self.compiled if remaining[label] > 0]
+        return order, cyclic
+
+    def downstream(self, changed):
+        """
+        Get the labels of calculations affected by a change to the given
+        field labels, in the order they should be calculated
+        """
+        changed = set(changed)
+        affected = set()
+        for label, compiled in self.compiled.items():
+            if label in changed or (compiled is not None and compiled.fields & changed):
+                affected.add(label)
+        to_visit = list(affected)
+        while to_visit:
+            for dependent in self.dependents[to_visit.pop()]:
+                if dependent not in affected:
+                    affected.add(dependent)
+                    to_visit.append(dependent)
+        return ([label for label in self.order if label in affected] +
+                [label for label in self.cyclic if label in affected])
+
+    def evaluate(self, values, results=None, only=None):
+        """
+        Perform calculations in dependency order
+
+        values is a dict of field label: value. results is a dict of
+        calculation label: previous result used for any calculation not
+        being performed. If only is given just those calculations are
+        performed. Returns a dict of calculation label: result for the
+        calculations performed.
+        """
+        values = dict(values)
+        if results:
+            values.update({label: r for label, r in results.items() if r is not None})
+        labels = self.order + self.cyclic if only is None else only
+        calculated = {}
+        for label in labels:
+            compiled = self.compiled[label]
+            if compiled is None or label in self.cyclic:
+                result = None
+            else:
+                result = compiled.evaluate(values)
+            calculated[label] = result
+            if result is None:
+                values.pop(label, None)
+            else:
+                values[label] = result
+        return calculated
@@ -0,0 +1,91 @@
+import json
+from urllib.parse import parse_qs
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import transaction
+
+from channels import Group
+from rest_framework_jwt.serializers import VerifyJSONWebTokenSerializer
+
+from lims.permissions.principal import get_principal
+from .models import Run
+
+
+def run_group(run_id):
+    """
+    The group of websockets watching a run
+    """
+    return Group('run-{}'.format(run_id))
+
+
+def send_run_event(run, event, **data):
+    """
+    Push an event for a run to every websocket watching it
+
+    The state of the run is taken now but the event is only sent once
+    the transaction commits, so subscribers never hear of changes that
+    are rolled back. Events carry identifiers only, clients fetch any
+    details they need.
+    """
+    data.update({
+        'event': event,
+        'run': run.id,
+        'current_task': run.current_task,
+        'task_in_progress': run.task_in_progress,
+        'is_active': run.is_active,
+    })
+    text = json.dumps(data, cls=DjangoJSONEncoder)
+    transaction.on_commit(lambda: _send(run.id, text))
+
+
+def _send(run_id, text):
+    # Failing to send must not fail the request that made the change
+    # as clients can always fall back to monitor_task.
+    try:
+        run_group(run_id).send({'text': text})
+    except Exception:
+        pass
+
+
+def _get_user(message):
+    query_string = message.content.get('query_string', '')
+    if isinstance(query_string, bytes):
+        query_string = query_string.decode('utf-8')
+    token = parse_qs(query_string).get('token', [None])[0]
+    if token:
+        serializer = VerifyJSONWebTokenSerializer(data={'token': token})
+        if serializer.is_valid():
+            return serializer.validated_data['user']
+    return None
+
+
+def _can_view_run(user, run_id):
+    try:
+        run = Run.objects.get(pk=run_id)
+    except Run.DoesNotExist:
+        return False
+    # Same rules as ExtendedObjectPermissions for viewing a run
+    principal = get_principal(user)
+    if principal.is_admin:
+        return True
+    return (principal.has_perm('workflows.view_run') and
+            principal.has_perm('workflows.view_run', run))
+
+
+def run_connect(message, run_id):
+    """
+    Subscribe a websocket to the events of a run
+
+    Authenticated with a JWT passed as ?token= as browsers cannot
+    set headers on a websocket.
+    """
+    user = _get_user(message)
+    if user is None or not _can_view_run(user, run_id):
+        message.reply_channel.send({'close': True})
+        return
+    message.reply_channel.send({'accept': True})
+    run_group(run_id).add(message.reply_channel)
+
+
+def run_disconnect(message, run_id):
+    run_group(run_id).discard(message.reply_channel)
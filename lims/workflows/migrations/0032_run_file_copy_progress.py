@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.3 on 2018-03-12 10:02
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('workflows', '0031_stepfieldproperty_measure_not_required'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='run',
+            name='file_copy_status',
+            field=models.CharField(blank=True, choices=[('', 'None'), ('pending', 'Pending'), ('copying', 'Copying'), ('complete', 'Complete'), ('failed', 'Failed')], default='', max_length=20),
+        ),
+        migrations.AddField(
+            model_name='run',
+            name='files_copied',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='run',
+            name='files_to_copy',
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.3 on 2018-03-13 14:20
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def _task_ids(value):
+    ids = []
+    for v in (value or '').split(','):
+        try:
+            ids.append(int(v))
+        except ValueError:
+            pass
+    return ids
+
+
+def make_task_positions(apps, schema_editor):
+    TaskTemplate = apps.get_model('workflows', 'TaskTemplate')
+    Workflow = apps.get_model('workflows', 'Workflow')
+    WorkflowTask = apps.get_model('workflows', 'WorkflowTask')
+    Run = apps.get_model('workflows', 'Run')
+    RunTask = apps.get_model('workflows', 'RunTask')
+    existing = set(TaskTemplate.objects.values_list('id', flat=True))
+    positions = []
+    for workflow_id, order in Workflow.objects.values_list('id', 'order'):
+        for i, task_id in enumerate(_task_ids(order)):
+            if task_id in existing:
+                positions.append(WorkflowTask(workflow_id=workflow_id, task_id=task_id,
+                                              position=i))
+    WorkflowTask.objects.bulk_create(positions)
+    positions = []
+    for run_id, tasks in Run.objects.values_list('id', 'tasks'):
+        for i, task_id in enumerate(_task_ids(tasks)):
+            if task_id in existing:
+                positions.append(RunTask(run_id=run_id, task_id=task_id, position=i))
+    RunTask.objects.bulk_create(positions)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('workflows', '0032_run_file_copy_progress'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RunTask',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('position', models.PositiveIntegerField()),
+                ('run', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='task_positions', to='workflows.Run')),
+                ('task', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='workflows.TaskTemplate')),
+            ],
+            options={
+                'ordering': ['position'],
+                'abstract': False,
+            },
+        ),
+        migrations.CreateModel(
+            name='WorkflowTask',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('position', models.PositiveIntegerField()),
+                ('task', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='workflows.TaskTemplate')),
+                ('workflow', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='task_positions', to='workflows.Workflow')),
+            ],
+            options={
+                'ordering': ['position'],
+                'abstract': False,
+            },
+        ),
+        migrations.AlterUniqueTogether(
+            name='workflowtask',
+            unique_together=set([('workflow', 'position')]),
+        ),
+        migrations.AlterUniqueTogether(
+            name='runtask',
+            unique_together=set([('run', 'position')]),
+        ),
+        migrations.RunPython(make_task_positions, migrations.RunPython.noop),
+    ]
@@ -1,4 +1,6 @@
 from django.db import models
+from django.db.models import Prefetch, Q
+from django.db.models.signals import post_init, post_save
 import reversion
 from django.contrib.auth.models import User
 
@@ -8,38 +10,112 @@ from lims.inventory.models import Item, ItemType, ItemTransfer, AmountMeasure
 from lims.filetemplate.models import FileTemplate
 
 
+def item_type_descendants(item_types):
+    """
+    Get the descendants of many item types in one query
+
+    Returns a dict of item type ID to a list of (id, name) for the type
+    and its descendants in tree order.
+    """
+    item_types = set(item_types)
+    if not item_types:
+        return {}
+    in_trees = Q()
+    for it in item_types:
+        in_trees |= Q(tree_id=it.tree_id, lft__gte=it.lft, rght__lte=it.rght)
+    descendants = list(ItemType.objects.filter(in_trees).order_by('tree_id', 'lft')
+                       .values_list('id', 'name', 'tree_id', 'lft', 'rght'))
+    return {it.id: [(d_id, name) for d_id, name, tree_id, lft, rght in descendants
+                    if tree_id == it.tree_id and lft >= it.lft and rght <= it.rght]
+            for it in item_types}
+
+
+class OrderedTasksMixin(object):
+    """
+    Get tasks from a comma seperated list of task IDs
+
+    The list is mirrored to task position models on save so the
+    tasks can be loaded with prefetch_related along with the
+    workflow/run they belong to.
+    """
+    # The field containing the comma seperated task IDs
+    task_order_field = None
+
+    def get_task_ids(self):
+        value = getattr(self, self.task_order_field)
+        if value:
+            return [int(v) for v in value.split(',')]
+        return []
+
+    def _task_positions(self):
+        if 'task_positions' in getattr(self, '_prefetched_objects_cache', {}):
+            return self.task_positions.all()
+        return self.task_positions.select_related('task')
+
+    def get_tasks(self):
+        """
+        Get an ordered list of tasks
+        """
+        task_ids = self.get_task_ids()
+        if task_ids:
+            tasks = {tp.position: tp.task for tp in self._task_positions()}
+            return [tasks.get(i) for i in range(len(task_ids))]
+        return []
+
+    def get_task_at_index(self, index):
+        """
+        Get a single task at the provided index
+        """
+        task_ids = self.get_task_ids()
+        if task_ids:
+            position = range(len(task_ids))[index]
+            if 'task_positions' in getattr(self, '_prefetched_objects_cache', {}):
+                tasks = {tp.position: tp.task for tp in self.task_positions.all()}
+                return tasks.get(position)
+            task_position = self._task_positions().filter(position=position).first()
+            if task_position:
+                return task_position.task
+        return None
+
+    def load_tasks(self):
+        """
+        Get an ordered list of tasks with all their fields loaded
+        """
+        return TaskTemplate.objects.in_order(self.get_task_ids())
+
+    def sync_task_positions(self):
+        """
+        Rewrite the task positions to match the task ID list
+
+        IDs of tasks that no longer exist are skipped.
+        """
+        task_ids = self.get_task_ids()
+        existing = set(TaskTemplate.objects.filter(pk__in=task_ids).values_list('id', flat=True))
+        position_model = self.task_positions.model
+        owner_field = self.task_positions.field.name
+        self.task_positions.all().delete()
+        position_model.objects.bulk_create([
+            position_model(**{owner_field: self, 'task_id': task_id, 'position': i})
+            for i, task_id in enumerate(task_ids) if task_id in existing])
+        getattr(self, '_prefetched_objects_cache', {}).pop('task_positions', None)
+        self._synced_task_order = getattr(self, self.task_order_field)
+
+
 @reversion.register()
-class Workflow(models.Model):
+class Workflow(OrderedTasksMixin, models.Model):
     name = models.CharField(max_length=50)
     order = models.CommaSeparatedIntegerField(max_length=200, blank=True)
     created_by = models.ForeignKey(User)
     date_created = models.DateTimeField(auto_now_add=True)
 
+    task_order_field = 'order'
+
     class Meta:
         ordering = ['-id']
         permissions = (
             ('view_workflow', 'View workflow',),
         )
 
-    def get_tasks(self):
-        if self.order:
-            order = [int(v) for v in self.order.split(',')]
-            tasks = list(TaskTemplate.objects.filter(pk__in=order))
-            ordered_tasks = []
-            for o in order:
-                ordered_tasks.append(next((obj for obj in tasks if obj.id == o), None))
-            return ordered_tasks
-        return []
-
-    def get_task_at_index(self, index):
-        if self.order:
-            order = [int(v) for v in self.order.split(',')]
-            try:
-                return TaskTemplate.objects.get(pk=order[index])
-            except TaskTemplate.DoesNotExist:
-                return None
-        return None
-
     def __str__(self):
         return self.name
 
@@ -61,7 +137,7 @@ class RunLabware(models.Model):
 
 
 @reversion.register()
-class Run(models.Model):
+class Run(OrderedTasksMixin, models.Model):
     """
     Takes a series of tasks (e.g. from a workflow) and runs products through them
 
@@ -96,39 +172,69 @@ class Run(models.Model):
     date_finished = models.DateTimeField(blank=True, null=True)
     started_by = models.ForeignKey(User)
 
+    # Progress of copying files from equipment at the end of a task
+    FILE_COPY_STATUS = (
+        ('', 'None'),
+        ('pending', 'Pending'),
+        ('copying', 'Copying'),
+        ('complete', 'Complete'),
+        ('failed', 'Failed'),
+    )
+    file_copy_status = models.CharField(max_length=20, choices=FILE_COPY_STATUS,
+                                        blank=True, default='')
+    files_to_copy = models.PositiveIntegerField(default=0)
+    files_copied = models.PositiveIntegerField(default=0)
+
     def get_task_list(self):
         """
         Get list of task IDs
         """
         return [int(v) for v in self.tasks.split(',')]
 
-    def get_tasks(self):
-        """
-        Get an ordered list of tasks for this run
+    task_order_field = 'tasks'
+
+    def get_current_task(self):
         """
-        if self.tasks:
-            task_list = [int(v) for v in self.tasks.split(',')]
-            tasks = list(TaskTemplate.objects.filter(pk__in=task_list))
-            ordered_tasks = []
-            for t in task_list:
-                ordered_tasks.append(next((obj for obj in tasks if obj.id == t), None))
-            return ordered_tasks
-        return []
+        Get the task at current_task
 
-    def get_task_at_index(self, index):
+        The task is kept on the instance so repeated calls while
+        handling a request do not query again.
         """
-        Get a single task at the provided index
+        key = (self.tasks, self.current_task)
+        cached = getattr(self, '_current_task', None)
+        if cached is None or cached[0] != key:
+            cached = (key, self.get_task_at_index(self.current_task))
+            self._current_task = cached
+        return cached[1]
+
+    @staticmethod
+    def load_valid_inputs(runs):
         """
-        if self.tasks:
-            task_list = [int(v) for v in self.tasks.split(',')]
-            try:
-                return TaskTemplate.objects.get(pk=task_list[index])
-            except TaskTemplate.DoesNotExist:
-                return None
-        return None
+        Work out has_valid_inputs for many runs at once
+
+        Uses the prefetched products and linked inventory of the runs
+        so only the item type descendants need to be queried.
+        """
+        tasks = {run.id: run.get_current_task() for run in runs}
+        descendants = item_type_descendants(t.product_input for t in tasks.values()
+                                            if t and t.product_input is not None)
+        for run in runs:
+            task = tasks[run.id]
+            valid = {}
+            if task:
+                for p in run.products.all():
+                    if task.product_input:
+                        input_types = {d_id for d_id, name in descendants[task.product_input.id]}
+                        valid[p.id] = any(i.item_type_id in input_types
+                                          for i in p.linked_inventory.all())
+                    else:
+                        valid[p.id] = True
+            run._valid_inputs = valid
 
     def has_valid_inputs(self):
-        task = self.get_task_at_index(self.current_task)
+        if hasattr(self, '_valid_inputs'):
+            return self._valid_inputs
+        task = self.get_current_task()
         valid = {}
         if task:
             for p in self.products.all():
@@ -159,6 +265,97 @@ class Run(models.Model):
                                                           self.date_finished)
 
 
+class TaskPosition(models.Model):
+    """
+    The position of a task in an ordered list of tasks
+    """
+    task = models.ForeignKey('TaskTemplate', related_name='+')
+    position = models.PositiveIntegerField()
+
+    class Meta:
+        abstract = True
+        ordering = ['position']
+
+
+class WorkflowTask(TaskPosition):
+    workflow = models.ForeignKey(Workflow, related_name='task_positions')
+
+    class Meta(TaskPosition.Meta):
+        unique_together = (('workflow', 'position'),)
+
+
+class RunTask(TaskPosition):
+    run = models.ForeignKey(Run, related_name='task_positions')
+
+    class Meta(TaskPosition.Meta):
+        unique_together = (('run', 'position'),)
+
+
+def recordTaskOrder(sender, instance, **kwargs):
+    """
+    Keep the task order loaded so positions are only synced on change
+    """
+    if instance.pk is not None:
+        instance._synced_task_order = instance.__dict__.get(instance.task_order_field)
+post_init.connect(recordTaskOrder, Workflow)
+post_init.connect(recordTaskOrder, Run)
+
+
+def syncTaskPositions(sender, instance, raw=False, **kwargs):
+    """
+    Rewrite the task positions when the task order has changed
+
+    Raw saves, e.g. reverting to an earlier version, bypass save() and
+    restore an order that was never synced so always rewrite them.
+    """
+    order = getattr(instance, instance.task_order_field)
+    if raw or order != getattr(instance, '_synced_task_order', None):
+        instance.sync_task_positions()
+post_save.connect(syncTaskPositions, Workflow)
+post_save.connect(syncTaskPositions, Run)
+
+
+class TaskTemplateQuerySet(models.QuerySet):
+    """
+    Load tasks with the rows needed to serialize them
+    """
+
+    def with_fields(self):
+        """
+        Fetch related objects and all fields for the tasks together
+
+        The number of queries is fixed no matter how many tasks are
+        being loaded.
+        """
+        measure_and_type = ('measure', 'lookup_type')
+        return self.select_related(
+            'created_by', 'product_input', 'product_input_measure', 'labware'
+        ).prefetch_related(
+            'capable_equipment', 'input_files', 'output_files', 'equipment_files',
+            'calculation_fields',
+            Prefetch('input_fields',
+                     queryset=InputFieldTemplate.objects.select_related(*measure_and_type)),
+            Prefetch('output_fields',
+                     queryset=OutputFieldTemplate.objects.select_related(*measure_and_type)),
+            Prefetch('variable_fields',
+                     queryset=VariableFieldTemplate.objects.select_related('measure')),
+            Prefetch('step_fields', queryset=StepFieldTemplate.objects.prefetch_related(
+                Prefetch('properties',
+                         queryset=StepFieldProperty.objects.select_related('measure')))),
+        )
+
+    def in_order(self, task_ids):
+        """
+        Get the tasks for a list of IDs in the same order
+
+        Fields and the valid product input types are loaded for all
+        tasks at once. Tasks that do not exist are given as None.
+        """
+        tasks = {t.id: t for t in self.with_fields().filter(pk__in=task_ids)}
+        TaskTemplate.load_valid_product_input_types(tasks.values())
+        return [tasks.get(task_id) for task_id in task_ids]
+
+
 @reversion.register()
 class TaskTemplate(models.Model):
 
@@ -189,6 +386,8 @@ class TaskTemplate(models.Model):
     created_by = models.ForeignKey(User)
     date_created = models.DateTimeField(auto_now_add=True)
 
+    objects = TaskTemplateQuerySet.as_manager()
+
     class Meta:
         ordering = ['-id']
         permissions = (
@@ -200,9 +399,23 @@ class TaskTemplate(models.Model):
 
     def valid_product_input_types(self):
         if self.product_input is not None:
+            if hasattr(self, '_valid_product_input_types'):
+                return self._valid_product_input_types
             return [v.name for v in self.product_input.get_descendants(include_self=True)]
         return []
 
+    @staticmethod
+    def load_valid_product_input_types(tasks):
+        """
+        Work out valid_product_input_types for many tasks in one query
+        """
+        descendants = item_type_descendants(t.product_input for t in tasks
+                                            if t.product_input is not None)
+        for t in tasks:
+            if t.product_input is not None:
+                t._valid_product_input_types = [name for d_id, name
+                                                in descendants[t.product_input.id]]
+
     def _flatten_to_values(self, the_dict):
         flat = {}
         for label, value in the_dict.items():
@@ -210,62 +423,65 @@ class TaskTemplate(models.Model):
                 flat[label] = value
         return flat
 
-    def data_to_output_file(self, file_template,
-                            task_data_dict, transfer_data_dict):
-        """
-        Convert validated task data to output file data.
-        """
-        # Take in dict of data
-        # Map fields to field in dict
-        # Raise validation error if not possible???
-        fields = file_template.fields.all()
-
-        # Flatten out fields into a single level with
-        # the rest of the task data.
-        flat_products = {}
-        for product in task_data_dict:
-            # Get non-nested values
-            product_data = self._flatten_to_values(product)
-            product_data.update(self._flatten_to_values(product['data']))
-
-            for fieldset in ['input_fields', 'output_fields', 'step_fields',
-                             'variable_fields', 'calculation_fields']:
-                for field in product['data'][fieldset]:
-                    product_data[field['label']] = field
-            flat_products[product['product_name']] = product_data
-
-        lines = []
+    def _flatten_product(self, product):
+        # Get non-nested values
+        product_data = self._flatten_to_values(product)
+        product_data.update(self._flatten_to_values(product['data']))
+
+        for fieldset in ['input_fields', 'output_fields', 'step_fields',
+                         'variable_fields', 'calculation_fields']:
+            for field in product['data'][fieldset]:
+                product_data[field['label']] = field
+        return product_data
+
+    def _output_lines(self, file_template, task_data, transfer_data):
         if file_template.use_inputs:
             # Associate the data with each individual input for the task
             # If there are 4 products with 5 inputs each the result will
             # be 4*5 lines (20).
-            for product in task_data_dict:
+            for product in task_data:
+                product_data = self._flatten_product(product)
                 for task_input in product['data']['product_input_amounts']:
-                    p = flat_products[product['product_name']].copy()
+                    p = product_data.copy()
                     p['task_input'] = task_input
-                    lines.append(p)
+                    yield p
         elif file_template.total_inputs_only:
             # TODO This code looks broken - it is just cut-and-paste from above
             # and the transfer variable is never used within the loop
-            for transfer in transfer_data_dict:
-                lines.append(transfer)
+            for transfer in transfer_data:
+                yield transfer
         else:
             # List by products so 4 products = 4 lines
-            for product in flat_products.values():
-                lines.append(product)
+            for product in task_data:
+                yield self._flatten_product(product)
+
+    def iter_output_file(self, file_template, task_data, transfer_data):
+        """
+        Generate output file data from validated task data a line at a time
 
-        output = []
-        for l in lines:
+        The task and transfer data can be any iterable so large files
+        can be produced without holding every line in memory.
+        """
+        # Take in dict of data
+        # Map fields to field in dict
+        # Raise validation error if not possible???
+        fields = [(f.name, f.key_to_path()) for f in file_template.fields.all()]
+        for l in self._output_lines(file_template, task_data, transfer_data):
             line_dict = {}
-            for f in fields:
-                key_path = f.key_to_path()
+            for name, key_path in fields:
                 field_value = l
                 for key in key_path:
                     # TODO Handle things better when key does not exist
                     field_value = field_value.get(key, None)
-                line_dict[f.name] = field_value
-            output.append(line_dict)
-        return output
+                line_dict[name] = field_value
+            yield line_dict
+
+    def data_to_output_file(self, file_template,
+                            task_data_dict, transfer_data_dict):
+        """
+        Convert validated task data to output file data.
+        """
+        return list(self.iter_output_file(file_template, task_data_dict, transfer_data_dict))
 
     def __str__(self):
         return self.name
@@ -277,6 +493,8 @@ class CalculationFieldTemplate(models.Model):
     Store a calculation referenceing variables and inputs
     """
     template = models.ForeignKey(TaskTemplate, related_name='calculation_fields')
+    # Shares the task's permissions when PERMISSION_INHERITANCE is on
+    inherit_permissions_from = 'template'
     label = models.CharField(max_length=50)
     description = models.CharField(max_length=200, null=True, blank=True)
 
@@ -305,6 +523,7 @@ class InputFieldTemplate(models.Model):
     Can read amounts from either a calculationor an input file
     """
     template = models.ForeignKey(TaskTemplate, related_name='input_fields')
+    inherit_permissions_from = 'template'
     label = models.CharField(max_length=50)
     description = models.CharField(max_length=200, null=True, blank=True)
     amount = models.FloatField()
@@ -337,6 +556,7 @@ class InputFieldTemplate(models.Model):
 @reversion.register()
 class VariableFieldTemplate(models.Model):
     template = models.ForeignKey(TaskTemplate, related_name='variable_fields')
+    inherit_permissions_from = 'template'
     label = models.CharField(max_length=50)
     description = models.CharField(max_length=200, null=True, blank=True)
     amount = models.FloatField()
@@ -359,6 +579,7 @@ class VariableFieldTemplate(models.Model):
 @reversion.register()
 class OutputFieldTemplate(models.Model):
     template = models.ForeignKey(TaskTemplate, related_name='output_fields')
+    inherit_permissions_from = 'template'
     label = models.CharField(max_length=50)
     description = models.CharField(max_length=200, null=True, blank=True)
     amount = models.FloatField()
@@ -384,6 +605,7 @@ class OutputFieldTemplate(models.Model):
 @reversion.register()
 class StepFieldTemplate(models.Model):
     template = models.ForeignKey(TaskTemplate, related_name='step_fields')
+    inherit_permissions_from = 'template'
     label = models.CharField(max_length=50)
     description = models.CharField(max_length=200, null=True, blank=True)
 
@@ -0,0 +1,268 @@
+from django.db.models import Prefetch, Sum
+from pint import DimensionalityError
+
+from lims.inventory.models import Item, ItemProperty
+from lims.inventory.units import conversion_table
+from .calculation import CalculationGraph, calculation_cache
+from .models import item_type_descendants
+
+
+class MaterialPlanner(object):
+    """
+    Work out the inventory needed to run products through a list of tasks
+
+    Tasks are simulated with the amounts on their templates and nothing
+    is written. Amounts are totalled per inventory item in the measure
+    of the item, and per item type and measure for inputs that are only
+    chosen when the task is started. Outputs of earlier tasks can be
+    used as the product input of later ones.
+
+    Everything is looked up in a fixed number of queries up front. Tasks
+    are expected to be loaded with TaskTemplate.objects.in_order and
+    products with load_products.
+    """
+
+    def __init__(self, tasks, products):
+        self.tasks = [t for t in tasks if t is not None]
+        self.products = list(products)
+        self.errors = []
+        self.items = {}
+        self.item_types = {}
+        # Outputs of the simulated tasks for each product
+        self.outputs = {p.id: [] for p in self.products}
+
+    @staticmethod
+    def load_products(queryset):
+        """
+        Fetch products with the linked inventory used by the planner
+        """
+        return queryset.prefetch_related(
+            Prefetch('linked_inventory',
+                     queryset=Item.objects.select_related('item_type', 'amount_measure')))
+
+    def _convert(self, amount, from_symbol, to_symbol, name):
+        try:
+            return conversion_table.convert(amount, from_symbol, to_symbol)
+        except DimensionalityError:
+            self.errors.append('Cannot convert {} to {} for {}'.format(from_symbol, to_symbol,
+                                                                       name))
+            return None
+
+    def _require_item(self, item, amount, symbol):
+        amount = self._convert(amount, symbol, item.amount_measure.symbol, item.name)
+        if amount is not None:
+            required = self.items.setdefault(item.id, {'item': item, 'required': 0.0})
+            required['required'] += amount
+
+    def _require_item_type(self, item_type, amount, symbol):
+        required = self.item_types.setdefault((item_type.id, symbol),
+                                              {'item_type': item_type, 'required': 0.0})
+        required['required'] += amount
+
+    def _take_output(self, output, amount, symbol):
+        amount = self._convert(amount, symbol, output['measure'], output['name'])
+        if amount is not None:
+            output['required'] += amount
+
+    def _task_values(self, task):
+        """
+        The default values of a task's fields for use in calculations
+        """
+        values = {}
+        for field in task.input_fields.all():
+            values[field.label] = field.amount
+        for step in task.step_fields.all():
+            for prop in step.properties.all():
+                values[prop.label] = prop.amount
+        for field in task.variable_fields.all():
+            values[field.label] = field.amount
+        if task.product_input_amount is not None:
+            values['product_input_amount'] = task.product_input_amount
+        return values
+
+    def _calculate(self, task):
+        """
+        Perform a task's calculations, returning calculation ID: result
+
+        The template values are the same for every product so each
+        calculation is only performed once per task.
+        """
+        calculations = list(task.calculation_fields.all())
+        graph = CalculationGraph([(c.label, calculation_cache.get(c.calculation, c.id))
+                                  for c in calculations])
+        results = graph.evaluate(self._task_values(task))
+        return {c.id: results.get(c.label, None) for c in calculations}
+
+    def _field_amount(self, task, field, results):
+        if field.calculation_used_id is not None:
+            amount = results.get(field.calculation_used_id, None)
+            if amount is None:
+                self.errors.append('Calculation for {} on {} could not be performed'.format(
+                    field.label, task.name))
+            return amount
+        return field.amount
+
+    def _auto_find_items(self):
+        """
+        Find the items for inputs looked up by product identifier and label
+        """
+        task_inputs = set('{}/{}'.format(p.product_identifier, field.label)
+                          for task in self.tasks
+                          for field in task.input_fields.all() if field.auto_find_in_inventory
+                          for p in self.products)
+        item_ids = {}
+        if task_inputs:
+            # Where more than one item matches use the most recent
+            properties = ItemProperty.objects.filter(name='task_input', value__in=task_inputs) \
+                .order_by('item_id').values_list('value', 'item_id')
+            for value, item_id in properties:
+                item_ids[value] = item_id
+        items = Item.objects.filter(id__in=set(item_ids.values())).select_related('amount_measure')
+        items = {i.id: i for i in items}
+        return {value: items[item_id] for value, item_id in item_ids.items()}
+
+    def _product_inputs(self, task, product, input_types):
+        """
+        Require the product input for every matching item of a product
+        """
+        for item in product.linked_inventory.all():
+            if item.item_type_id in input_types:
+                self._require_item(item, task.product_input_amount,
+                                   task.product_input_measure.symbol)
+        for output in self.outputs[product.id]:
+            if output['item_type_id'] in input_types:
+                self._take_output(output, task.product_input_amount,
+                                  task.product_input_measure.symbol)
+
+    def _simulate(self, task, descendants, auto_found):
+        results = self._calculate(task)
+        number_of_products = len(self.products)
+
+        if not task.labware_not_required and task.labware is not None:
+            self._require_item_type(task.labware, task.labware_amount, 'item')
+
+        if task.product_input is not None and task.product_input_amount is not None \
+                and task.product_input_measure is not None:
+            input_types = set(d_id for d_id, name in descendants[task.product_input.id])
+            for product in self.products:
+                self._product_inputs(task, product, input_types)
+
+        for field in task.input_fields.all():
+            amount = self._field_amount(task, field, results)
+            if amount is None:
+                continue
+            if field.auto_find_in_inventory:
+                for product in self.products:
+                    identifier = '{}/{}'.format(product.product_identifier, field.label)
+                    if identifier in auto_found:
+                        self._require_item(auto_found[identifier], amount, field.measure.symbol)
+                    else:
+                        self.errors.append('Item {} does not exist'.format(identifier))
+            else:
+                self._require_item_type(field.lookup_type, amount * number_of_products,
+                                        field.measure.symbol)
+
+        for field in task.output_fields.all():
+            amount = self._field_amount(task, field, results)
+            if amount is None:
+                continue
+            for product in self.products:
+                self.outputs[product.id].append({
+                    'name': '{} {} ({})'.format(product.product_identifier, field.label,
+                                                task.name),
+                    'item_type_id': field.lookup_type_id,
+                    'amount': amount,
+                    'measure': field.measure.symbol,
+                    'required': 0.0,
+                })
+
+    def _item_type_availability(self, descendants):
+        """
+        Total available of each item type (and its descendants) per measure
+        """
+        type_ids = set(d_id for key in self.item_types
+                       for d_id, name in descendants[key[0]])
+        totals = Item.objects.filter(item_type_id__in=type_ids) \
+            .values_list('item_type_id', 'amount_measure__symbol') \
+            .annotate(total=Sum('amount_available')).order_by()
+        available = {}
+        for type_id, symbol, total in totals:
+            available.setdefault(type_id, []).append((symbol, total))
+        return available
+
+    def _report_item_types(self, descendants):
+        totals = self._item_type_availability(descendants)
+        report = []
+        for (type_id, symbol), required in self.item_types.items():
+            available = 0.0
+            for d_id, name in descendants[type_id]:
+                for from_symbol, total in totals.get(d_id, []):
+                    try:
+                        available += conversion_table.convert(total, from_symbol, symbol)
+                    except DimensionalityError:
+                        # Items in a different kind of measure are not usable
+                        pass
+            report.append({
+                'item_type': required['item_type'].name,
+                'measure': symbol,
+                'required': required['required'],
+                'available': available,
+                'shortfall': max(required['required'] - available, 0.0),
+            })
+        return sorted(report, key=lambda r: (r['item_type'], r['measure']))
+
+    def _report_items(self):
+        report = []
+        for required in self.items.values():
+            item = required['item']
+            report.append({
+                'id': item.id,
+                'identifier': item.identifier,
+                'name': item.name,
+                'measure': item.amount_measure.symbol,
+                'required': required['required'],
+                'available': item.amount_available,
+                'shortfall': max(required['required'] - item.amount_available, 0.0),
+            })
+        for outputs in self.outputs.values():
+            for output in outputs:
+                if output['required'] > 0:
+                    report.append({
+                        'id': None,
+                        'identifier': None,
+                        'name': output['name'],
+                        'measure': output['measure'],
+                        'required': output['required'],
+                        'available': output['amount'],
+                        'shortfall': max(output['required'] - output['amount'], 0.0),
+                    })
+        return sorted(report, key=lambda r: r['name'])
+
+    def plan(self):
+        """
+        Simulate the tasks and report the requirements and any shortfalls
+        """
+        types = set()
+        for task in self.tasks:
+            if task.product_input is not None:
+                types.add(task.product_input)
+            if task.labware is not None:
+                types.add(task.labware)
+            types.update(f.lookup_type for f in task.input_fields.all())
+        descendants = item_type_descendants(types)
+        auto_found = self._auto_find_items()
+
+        for task in self.tasks:
+            self._simulate(task, descendants, auto_found)
+
+        items = self._report_items()
+        item_types = self._report_item_types(descendants)
+        short = any(r['shortfall'] > 0 for r in items + item_types)
+        return {
+            'tasks': [{'id': t.id, 'name': t.name} for t in self.tasks],
+            'products': len(self.products),
+            'items': items,
+            'item_types': item_types,
+            'errors': self.errors,
+            'valid': not short and not self.errors,
+        }
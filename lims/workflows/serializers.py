@@ -1,7 +1,4 @@
-import re
-
 from rest_framework import serializers
-from pyparsing import ParseException
 
 from lims.permissions.permissions import SerializerPermissionsMixin
 
@@ -15,7 +12,7 @@ from .models import (Workflow,
                      TaskTemplate, InputFieldTemplate, VariableFieldTemplate,
                      OutputFieldTemplate, CalculationFieldTemplate, StepFieldTemplate,
                      StepFieldProperty)
-from .calculation import NumericStringParser
+from .calculation import CalculationGraph, calculation_cache
 
 
 class WorkflowSerializer(SerializerPermissionsMixin, serializers.ModelSerializer):
@@ -274,33 +271,6 @@ class TaskTemplateSerializer(SerializerPermissionsMixin, serializers.ModelSerial
         self.handle_calculation(rep)
         return rep
 
-    def _replace_fields(self, match):
-        """
-        Replace field names with their correct values
-        """
-        mtch = match.group(1)
-        if mtch in self.flat:
-            return str(self.flat[mtch])
-        return str(0)
-
-    def _perform_calculation(self, calculation):
-        """
-        Parse and perform a calculation using a dict of fields
-
-        Using either a dict of values to field names
-
-        Returns a NaN if the calculation cannot be performed, e.g.
-        incorrect field names.
-        """
-        nsp = NumericStringParser()
-        field_regex = r'\{(.+?)\}'
-        interpolated_calculation = re.sub(field_regex, self._replace_fields, calculation)
-        try:
-            result = nsp.eval(interpolated_calculation)
-        except ParseException:
-            return None
-        return result
-
     def _flatten_values(self, rep):
         flat_values = {}
         for field_type in ['input_fields', 'step_fields', 'variable_fields']:
@@ -321,14 +291,30 @@ class TaskTemplateSerializer(SerializerPermissionsMixin, serializers.ModelSerial
 
         If any data is provided, use that as source for the calculations
         rather than the defaults on the model.
+
+        Calculations are performed in dependency order so one calculation
+        can use the result of another. If a list of changed field labels
+        is given in the context as "changed" only the calculations
+        affected by them are performed, the rest keep their given result.
         """
-        # Flatten fields into named dict/ordered dict
-        # Will need some sort of defer if not completed calculation dependent on other calculation
         if 'calculation_fields' in rep:
-            self.flat = self._flatten_values(rep)
+            flat = self._flatten_values(rep)
+            graph = CalculationGraph([(calc['label'],
+                                       calculation_cache.get(calc['calculation'], calc.get('id')))
+                                      for calc in rep['calculation_fields']])
+            changed = self.context.get('changed', None)
+            if changed is not None:
+                only = graph.downstream(changed)
+                previous = {calc['label']: calc.get('result', None)
+                            for calc in rep['calculation_fields']}
+                results = graph.evaluate(flat, previous, only)
+            else:
+                results = graph.evaluate(flat)
+            self.changed_calculations = []
             for calc in rep['calculation_fields']:
-                result = self._perform_calculation(calc['calculation'])
-                calc['result'] = result
+                if calc['label'] in results:
+                    calc['result'] = results[calc['label']]
+                    self.changed_calculations.append(calc)
         return rep
 
 
@@ -410,11 +396,25 @@ class RunSerializer(SerializerPermissionsMixin, serializers.ModelSerializer):
                                               source='get_tasks')
     validate_inputs = serializers.DictField(source='has_valid_inputs', read_only=True)
     products_list = SimpleProductSerializer(read_only=True, many=True, source='products')
+    product_count = serializers.SerializerMethodField()
+    current_task_name = serializers.SerializerMethodField()
 
     class Meta:
         model = Run
         fields = '__all__'
 
+    def get_product_count(self, obj):
+        # Annotated on the run list
+        if hasattr(obj, 'num_products'):
+            return obj.num_products
+        return obj.products.count()
+
+    def get_current_task_name(self, obj):
+        if hasattr(obj, 'current_task_name'):
+            return obj.current_task_name
+        task = obj.get_current_task()
+        return task.name if task else None
+
 
 class DetailedRunSerializer(serializers.ModelSerializer):
     validate_inputs = serializers.DictField(source='has_valid_inputs')
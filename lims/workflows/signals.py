@@ -1,24 +1,43 @@
+from django.db.models import IntegerField, Value
+from django.db.models.signals import post_save, post_delete
 from django.dispatch import receiver
 
-from .models import TaskTemplate
+from .models import (TaskTemplate, CalculationFieldTemplate, InputFieldTemplate,
+                     VariableFieldTemplate, OutputFieldTemplate, StepFieldTemplate,
+                     StepFieldProperty)
+from .calculation import calculation_cache
+from .task_fields import FIELD_TYPES, evict_task_fields
 from lims.permissions.signals import permissions_removed, permissions_changed
+from lims.permissions.inheritance import parent_field
 from lims.permissions.permissions import ViewPermissionsMixin
 
 
+def _task_fields(task_id):
+    """
+    Get all the fields of every type for a task in one query
+
+    Only the primary key of each field is loaded as that is all
+    that is needed to set permissions. Fields that inherit the task's
+    permissions are left out as they have no copies to change.
+    """
+    models = [model for model, serializer_class in FIELD_TYPES.values()
+              if parent_field(model) is None]
+    if not models:
+        return []
+    querysets = [model.objects.filter(template_id=task_id).order_by()
+                 .annotate(field_type=Value(i, IntegerField())).values_list('id', 'field_type')
+                 for i, model in enumerate(models)]
+    fields = querysets[0].union(*querysets[1:], all=True)
+    return [models[field_type](pk=pk) for pk, field_type in fields]
+
+
 @receiver(permissions_changed, sender=TaskTemplate)
 def change_field_permissions(sender, **kwargs):
     """
     Change all associated fields to match task permissions
     """
-    try:
-        task = TaskTemplate.objects.get(pk=kwargs['id'])
-    except:
-        return
-    field_types = ('input', 'variable', 'step', 'output', 'calculation',)
-    for ft in field_types:
-        fields = getattr(task, ft + '_fields').all()
-        for f in fields:
-            ViewPermissionsMixin().assign_permissions(f, kwargs['permissions'])
+    ViewPermissionsMixin().bulk_assign_permissions(_task_fields(kwargs['id']),
+                                                   kwargs['permissions'])
 
 
 @receiver(permissions_removed, sender=TaskTemplate)
@@ -26,12 +45,44 @@ def remove_field_permissions(sender, **kwargs):
     """
     Change all associated fields to match task permissions
     """
+    ViewPermissionsMixin().bulk_unassign_permissions(_task_fields(kwargs['id']),
+                                                     kwargs['groups'])
+
+
+@receiver(post_save, sender=CalculationFieldTemplate)
+@receiver(post_delete, sender=CalculationFieldTemplate)
+def evict_compiled_calculation(sender, instance, **kwargs):
+    """
+    Drop any compiled versions of a calculation that has changed
+    """
+    calculation_cache.evict(instance.id)
+
+
+@receiver(post_save, sender=InputFieldTemplate)
+@receiver(post_delete, sender=InputFieldTemplate)
+@receiver(post_save, sender=VariableFieldTemplate)
+@receiver(post_delete, sender=VariableFieldTemplate)
+@receiver(post_save, sender=OutputFieldTemplate)
+@receiver(post_delete, sender=OutputFieldTemplate)
+@receiver(post_save, sender=CalculationFieldTemplate)
+@receiver(post_delete, sender=CalculationFieldTemplate)
+@receiver(post_save, sender=StepFieldTemplate)
+@receiver(post_delete, sender=StepFieldTemplate)
+def evict_template_fields(sender, instance, **kwargs):
+    """
+    Drop the cached fields of a template when one of them changes
+    """
+    evict_task_fields(instance.template_id)
+
+
+@receiver(post_save, sender=StepFieldProperty)
+@receiver(post_delete, sender=StepFieldProperty)
+def evict_step_property(sender, instance, **kwargs):
+    """
+    Drop the cached fields of a template when a step property changes
+    """
     try:
-        task = TaskTemplate.objects.get(pk=kwargs['id'])
-    except:
-        return
-    field_types = ('input', 'variable', 'step', 'output', 'calculation',)
-    for ft in field_types:
-        fields = getattr(task, ft + '_fields').all()
-        for f in fields:
-            ViewPermissionsMixin().unassign_permissions(f, kwargs['groups'])
+        evict_task_fields(instance.step.template_id)
+    except StepFieldTemplate.DoesNotExist:
+        # Deleted along with its step
+        pass
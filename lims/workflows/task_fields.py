@@ -0,0 +1,104 @@
+from collections import OrderedDict
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Prefetch
+
+from lims.shared.cache import CacheUnavailable, get_store
+
+from .models import (InputFieldTemplate, VariableFieldTemplate, OutputFieldTemplate,
+                     CalculationFieldTemplate, StepFieldTemplate, StepFieldProperty)
+from .serializers import (InputFieldTemplateSerializer, VariableFieldTemplateSerializer,
+                          OutputFieldTemplateSerializer, CalculationFieldTemplateSerializer,
+                          StepFieldTemplateSerializer)
+
+
+# The kinds of field on a task template, as given by the ?type= param
+FIELD_TYPES = OrderedDict((
+    ('input', (InputFieldTemplate, InputFieldTemplateSerializer)),
+    ('step', (StepFieldTemplate, StepFieldTemplateSerializer)),
+    ('variable', (VariableFieldTemplate, VariableFieldTemplateSerializer)),
+    ('output', (OutputFieldTemplate, OutputFieldTemplateSerializer)),
+    ('calculation', (CalculationFieldTemplate, CalculationFieldTemplateSerializer)),
+))
+
+
+def get_field_type(type_name):
+    """
+    Get the (model, serializer) for a type of field, defaulting to input
+    """
+    return FIELD_TYPES.get((type_name or '').lower(), FIELD_TYPES['input'])
+
+
+_store = None
+
+
+def _cache():
+    # Shared between processes so an eviction is seen by every worker
+    global _store
+    if _store is None:
+        _store = get_store(getattr(settings, 'TASK_FIELD_CACHE_URL', None))
+    return _store
+
+
+def _try_cache(method, *args):
+    # The fields are always loadable from the database so carry on
+    # without the cache if it cannot be reached
+    try:
+        return getattr(_cache(), method)(*args)
+    except CacheUnavailable:
+        return None
+
+
+def _cache_key(template_id):
+    return 'taskfields:{}'.format(template_id)
+
+
+def evict_task_fields(template_id):
+    """
+    Drop the cached fields of a template that has changed
+
+    Dropped again once the change is committed in case another request
+    cached the old fields in the meantime.
+    """
+    keys = [_cache_key(template_id)]
+    _try_cache('delete_many', keys)
+    transaction.on_commit(lambda: _try_cache('delete_many', keys))
+
+
+def _field_queryset(model, template_ids):
+    queryset = model.objects.filter(template_id__in=template_ids)
+    if model is StepFieldTemplate:
+        return queryset.prefetch_related(
+            Prefetch('properties',
+                     queryset=StepFieldProperty.objects.select_related('measure')))
+    if model is CalculationFieldTemplate:
+        return queryset
+    related = ['measure']
+    if model is not VariableFieldTemplate:
+        related.append('lookup_type')
+    return queryset.select_related(*related)
+
+
+def get_task_fields(template_ids):
+    """
+    Get the serialized fields of every type for many templates
+
+    Returns template ID: {field type: [fields]}. Templates are cached
+    until one of their fields changes, the rest are loaded with one
+    query per type of field.
+    """
+    keys = {_cache_key(t_id): t_id for t_id in template_ids}
+    cached = _try_cache('get_many', list(keys.keys())) or {}
+    found = {keys[key]: fields for key, fields in cached.items()}
+    missing = [t_id for t_id in template_ids if t_id not in found]
+    if missing:
+        loaded = {t_id: OrderedDict((ft, []) for ft in FIELD_TYPES) for t_id in missing}
+        for field_type, (model, serializer_class) in FIELD_TYPES.items():
+            fields = list(_field_queryset(model, missing))
+            for field, data in zip(fields, serializer_class(fields, many=True).data):
+                loaded[field.template_id][field_type].append(data)
+        _try_cache('set_many', {_cache_key(t_id): fields for t_id, fields in loaded.items()},
+                   getattr(settings, 'TASK_FIELD_CACHE_TIMEOUT', 3600))
+        found.update(loaded)
+    return found
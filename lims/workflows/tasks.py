@@ -0,0 +1,61 @@
+import shutil
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from celery import shared_task
+from django.conf import settings
+from django.db.models import F
+
+from lims.datastore.models import DataEntry, DataFile
+from lims.drivers.models import CopyFilePath
+from .consumers import send_run_event
+from .models import Run
+
+
+def _copy(from_location, to_location):
+    try:
+        return shutil.copy2(from_location, to_location)
+    except IOError:
+        return None
+
+
+@shared_task
+def copy_run_files(location_ids, interpolate_dict, data_entry_ids, run_id):
+    """
+    Copy the output files of equipment and attach them to data entries
+
+    The copies themselves run across a bounded pool of threads as they
+    spend their time waiting on disk/network. All database work is kept
+    to this thread so progress is recorded as each file completes.
+    """
+    locations = CopyFilePath.objects.filter(id__in=location_ids) \
+        .select_related('driver__equipment')
+    to_copy = [(loc, loc.paths(interpolate_dict)) for loc in locations]
+    run = Run.objects.filter(id=run_id)
+    run.update(file_copy_status='copying', files_to_copy=len(to_copy), files_copied=0)
+
+    data_files = []
+    failed = False
+    workers = max(1, min(settings.FILE_COPY_WORKERS, len(to_copy)))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(_copy, from_location, to_location): (loc, to_location)
+                   for loc, (from_location, to_location) in to_copy}
+        for future in as_completed(futures):
+            loc, to_location = futures[future]
+            file_loc = future.result()
+            if file_loc:
+                data_files.append(loc.data_file(to_location, file_loc))
+                run.update(files_copied=F('files_copied') + 1)
+            else:
+                failed = True
+
+    created = DataFile.objects.bulk_create(data_files)
+    through = DataEntry.data_files.through
+    through.objects.bulk_create([through(dataentry_id=entry_id, datafile_id=df.id)
+                                 for entry_id in data_entry_ids
+                                 for df in created])
+    run.update(file_copy_status='failed' if failed else 'complete')
+    run = run.first()
+    if run:
+        send_run_event(run, 'files_copied', file_copy_status=run.file_copy_status,
+                       files_to_copy=run.files_to_copy, files_copied=run.files_copied)
+    return [df.id for df in created]
@@ -1,21 +1,30 @@
 from django.contrib.auth.models import Permission, Group
 from rest_framework import status
+from guardian.shortcuts import get_perms
+from reversion.models import Version
 from lims.shared.loggedintestcase import LoggedInTestCase
 from .models import Workflow, Run, RunLabware, TaskTemplate, \
     CalculationFieldTemplate, InputFieldTemplate, \
     VariableFieldTemplate, OutputFieldTemplate, StepFieldTemplate, StepFieldProperty
+from django.db import connection
+from django.test import override_settings
+from django.test.utils import CaptureQueriesContext
 from lims.datastore.models import DataEntry
 from lims.filetemplate.models import FileTemplate, FileTemplateField
 from lims.inventory.models import (Location, Item, ItemType, AmountMeasure, ItemTransfer,
                                    ItemProperty)
 from lims.equipment.models import Equipment
-from .views import ViewPermissionsMixin
+from .views import ViewPermissionsMixin, RunViewSet
 from lims.projects.models import Project, Product, ProductStatus
 from lims.shared.models import Organism
 import json
 from lims.inventory.serializers import ItemTransferPreviewSerializer
 from lims.datastore.serializers import DataEntrySerializer
 from lims.drivers.models import CopyFileDriver, CopyFilePath
+from .calculation import NumericStringParser, CalculationGraph, calculation_cache
+from .consumers import run_group
+from .signals import change_field_permissions, remove_field_permissions
+from channels import channel_layers, DEFAULT_CHANNEL_LAYER
 import os
 import filecmp
 import tempfile
@@ -149,6 +158,41 @@ class WorkflowTestCase(LoggedInTestCase):
         self.assertEqual(w.order, '%d,%d,%d' % (self._task3.id, self._task2.id, self._task1.id))
         self.assertEqual(w.get_tasks(), [self._task3, self._task2, self._task1])
 
+    def test_task_positions(self):
+        w = Workflow.objects.get(name="Workflow2")
+        self.assertEqual([tp.task for tp in w.task_positions.all()],
+                         [self._task1, self._task3, self._task4])
+        w.order = '%d,%d' % (self._task4.id, self._task1.id)
+        w.save()
+        self.assertEqual(w.task_positions.count(), 2)
+        self.assertEqual(w.get_tasks(), [self._task4, self._task1])
+        self.assertEqual(w.get_task_at_index(1), self._task1)
+        # Workflow, positions and tasks regardless of number of workflows
+        with self.assertNumQueries(3):
+            tasks = [wf.get_tasks()
+                     for wf in Workflow.objects.prefetch_related('task_positions__task')]
+        self.assertEqual(len(tasks), 3)
+
+    def test_admin_revert_task_order(self):
+        self._asAdmin()
+        w = Workflow.objects.get(name="Workflow1")
+        response = self._client.patch("/workflows/%d/" % w.id,
+                                      {"order": str(self._task3.id)},
+                                      format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        response = self._client.patch("/workflows/%d/" % w.id,
+                                      {"order": '%d,%d' % (self._task2.id, self._task4.id)},
+                                      format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        w = Workflow.objects.get(name="Workflow1")
+        self.assertEqual(w.get_tasks(), [self._task2, self._task4])
+        response = self._client.post("/workflows/%d/revert/?version=0" % w.id, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        w = Workflow.objects.get(name="Workflow1")
+        self.assertEqual(w.order, str(self._task3.id))
+        self.assertEqual(w.get_tasks(), [self._task3])
+        self.assertEqual(w.get_task_at_index(0), self._task3)
+
     def test_access_anonymous(self):
         self._asAnonymous()
         response = self._client.get('/workflows/')
@@ -591,6 +635,42 @@ class WorkflowTestCase(LoggedInTestCase):
         self.assertEqual(t[0]["name"], "TaskTempl1")
         self.assertEqual(t[1]["name"], "TaskTempl2")
 
+    def _workflow_tasks_queries(self, number_of_tasks):
+        child_type = ItemType.objects.create(name="ExampleChild%d" % number_of_tasks,
+                                             parent=self._prodinput)
+        tasks = []
+        for i in range(number_of_tasks):
+            task = TaskTemplate.objects.create(name="Bulk%d" % i,
+                                               product_input=self._prodinput,
+                                               product_input_amount=1,
+                                               product_input_measure=self._millilitre,
+                                               created_by=self._joeBloggs)
+            task.capable_equipment.add(self._equipmentSequencer)
+            InputFieldTemplate.objects.create(template=task, label="input1", amount=1,
+                                              measure=self._millilitre,
+                                              lookup_type=child_type)
+            tasks.append(task)
+        workflow = Workflow.objects.create(name="Bulk%d" % number_of_tasks,
+                                           order=','.join(str(t.id) for t in tasks),
+                                           created_by=self._joeBloggs)
+        ViewPermissionsMixin().assign_permissions(instance=workflow,
+                                                  permissions={"joe_group": "rw"})
+        with CaptureQueriesContext(connection) as queries:
+            response = self._client.get('/workflows/%d/tasks/' % workflow.id)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(response.data["tasks"]), number_of_tasks)
+        valid_types = response.data["tasks"][0]["valid_product_input_types"]
+        self.assertEqual(valid_types[0], "ExampleStuff")
+        self.assertIn(child_type.name, valid_types)
+        with CaptureQueriesContext(connection) as task_queries:
+            tasks = workflow.load_tasks()
+            [t.input_fields.all()[0].measure for t in tasks]
+        return len(queries), len(task_queries)
+
+    def test_workflow_tasks_query_count(self):
+        self._asJoeBloggs()
+        self.assertEqual(self._workflow_tasks_queries(5), self._workflow_tasks_queries(50))
+
 
 class TaskTestCase(LoggedInTestCase):
     def setUp(self):
@@ -1302,6 +1382,57 @@ class TaskTestCase(LoggedInTestCase):
         self.assertEqual(response.data["calculation_fields"][0]["result"], 16.267857142857142)
     """
 
+    def test_recalculate_invalid_changed(self):
+        self._asAdmin()
+        for changed in [5, {"input1": True}, ["input1", 2]]:
+            response = self._client.post("/tasks/%d/recalculate/" % self._task3.id,
+                                         {"changed": changed}, format='json')
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+            self.assertEqual(response.data["message"], "changed must be a list of field labels")
+
+    def test_compiled_calculation(self):
+        compiled = calculation_cache.get("({input1}+{input2})*2/-{variable1}+2^3^2")
+        self.assertEqual(compiled.fields, {"input1", "input2", "variable1"})
+        values = {"input1": "1", "input2": 3, "variable1": 2}
+        self.assertEqual(compiled.evaluate(values),
+                         NumericStringParser().eval("(1+3)*2/-2+2^3^2"))
+        # Missing fields are treated as 0
+        self.assertEqual(compiled.evaluate({"variable1": 1}), 512)
+        self.assertIs(compiled.evaluate({"input1": "abc"}), None)
+        self.assertIs(compiled.evaluate({}), None)
+        self.assertIs(calculation_cache.get("{input1}+"), None)
+
+    def test_compiled_calculation_many(self):
+        compiled = calculation_cache.get("{input1}*2/{variable1}")
+        columns = {"input1": [1, "2", "abc", 4],
+                   "variable1": [1, 2, 2, 0]}
+        self.assertEqual(compiled.evaluate_many(columns, 4), [2.0, 2.0, None, None])
+        self.assertEqual(compiled.evaluate_many({"variable1": [1, 2]}, 2), [0.0, 0.0])
+
+    def test_calculation_graph(self):
+        graph = CalculationGraph([("calc3", calculation_cache.get("{calc2}+{calc1}")),
+                                  ("calc2", calculation_cache.get("{calc1}*2")),
+                                  ("calc1", calculation_cache.get("{input1}+1")),
+                                  ("calc4", calculation_cache.get("{variable1}")),
+                                  ("calc5", calculation_cache.get("{calc5}+1"))])
+        self.assertEqual(graph.order, ["calc1", "calc4", "calc2", "calc3"])
+        self.assertEqual(graph.cyclic, ["calc5"])
+        self.assertEqual(graph.evaluate({"input1": 1, "variable1": 5}),
+                         {"calc1": 2, "calc2": 4, "calc3": 6, "calc4": 5, "calc5": None})
+        self.assertEqual(graph.downstream(["input1"]), ["calc1", "calc2", "calc3"])
+        self.assertEqual(graph.evaluate({"input1": 1}, {"calc1": 10, "calc2": 20},
+                                        graph.downstream(["calc2"])),
+                         {"calc2": 20, "calc3": 30})
+
+    def test_compiled_calculation_evicted_on_change(self):
+        self._setup_test_task_fields()
+        first = calculation_cache.get(self._calcField.calculation, self._calcField.id)
+        self.assertIs(calculation_cache.get(self._calcField.calculation, self._calcField.id),
+                      first)
+        self._calcField.save()
+        self.assertIsNot(calculation_cache.get(self._calcField.calculation, self._calcField.id),
+                         first)
+
     def test_user_listall_taskfield_readonly(self):
         self._setup_test_task_fields()
         # Make Jane temporarily readonly on her task
@@ -1339,6 +1470,81 @@ class TaskTestCase(LoggedInTestCase):
         self.assertEqual(len(t), 1)
         self.assertEqual(t[0]["label"], self._stepField.label)
 
+    def test_task_permissions_set_on_fields(self):
+        self._setup_test_task_fields()
+        fields = [self._inputField1, self._inputField2, self._outputField,
+                  self._stepField, self._calcField]
+        joe_group = Group.objects.get(name="joe_group")
+        with CaptureQueriesContext(connection) as queries:
+            change_field_permissions(sender=TaskTemplate, id=self._task3.id,
+                                     permissions={"joe_group": "rw"})
+        self.assertLess(len(queries), 10)
+        for f in fields:
+            self.assertIn("change_%s" % f._meta.model_name, get_perms(joe_group, f))
+        # Downgrade to read only
+        change_field_permissions(sender=TaskTemplate, id=self._task3.id,
+                                 permissions={"joe_group": "r"})
+        for f in fields:
+            self.assertEqual(get_perms(joe_group, f), ["view_%s" % f._meta.model_name])
+        with CaptureQueriesContext(connection) as queries:
+            remove_field_permissions(sender=TaskTemplate, id=self._task3.id,
+                                     groups=["joe_group"])
+        self.assertLess(len(queries), 10)
+        for f in fields:
+            self.assertEqual(get_perms(joe_group, f), [])
+
+    @override_settings(PERMISSION_INHERITANCE=True)
+    def test_taskfield_permissions_inherited(self):
+        self._setup_test_task_fields()
+        joe_group = Group.objects.get(name="joe_group")
+        self._asJaneDoe()
+        response = self._client.get('/taskfields/?type=%s' % "Step")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        t = response.data["results"]
+        self.assertEqual(len(t), 1)
+        self.assertEqual(t[0]["label"], self._stepField.label)
+        self._asJoeBloggs()
+        response = self._client.get('/taskfields/?type=%s' % "Step")
+        self.assertEqual(len(response.data["results"]), 0)
+        # Sharing the task shares its fields without copying permissions to them
+        ViewPermissionsMixin().assign_permissions(self._task3, {"joe_group": "r"})
+        self.assertEqual(get_perms(joe_group, self._stepField), [])
+        response = self._client.get('/taskfields/?type=%s' % "Step")
+        self.assertEqual(len(response.data["results"]), 1)
+
+    def test_user_all_taskfields(self):
+        self._setup_test_task_fields()
+        self._asJaneDoe()
+        url = '/taskfields/all/?templates=%d' % self._task3.id
+        response = self._client.get(url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        fields = response.data[self._task3.id]
+        self.assertEqual([f["label"] for f in fields["input"]], ["input2", "input1"])
+        self.assertEqual(fields["input"][0]["measure"], "ml")
+        self.assertEqual(fields["step"][0]["properties"][0]["label"], "prop1")
+        self.assertEqual(len(fields["variable"]), 0)
+        self.assertEqual(fields["output"][0]["label"], "output1")
+        self.assertEqual(fields["calculation"][0]["label"], "calc1")
+        # Served from the cache until a field changes
+        with CaptureQueriesContext(connection) as cached:
+            self._client.get(url)
+        self._inputField1.label = "changed"
+        self._inputField1.save()
+        with CaptureQueriesContext(connection) as loaded:
+            response = self._client.get(url)
+        self.assertLess(len(cached), len(loaded))
+        fields = response.data[self._task3.id]
+        self.assertEqual([f["label"] for f in fields["input"]], ["input2", "changed"])
+
+    def test_user_all_taskfields_nonread(self):
+        self._setup_test_task_fields()
+        self._asJoeBloggs()
+        response = self._client.get('/taskfields/all/?templates=%d' % self._task3.id)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data, {})
+        response = self._client.get('/taskfields/all/')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
     def test_admin_listall_taskfield_any(self):
         self._setup_test_task_fields()
         self._asAdmin()
@@ -1917,6 +2123,22 @@ class RunTestCase(LoggedInTestCase):
         runs = response.data
         self.assertEqual(len(runs["results"]), 3)
 
+    def test_user_list_annotated(self):
+        self._asJaneDoe()
+        response = self._client.get('/runs/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        runs = {r["name"]: r for r in response.data["results"]}
+        self.assertEqual(runs["run1"]["product_count"], 2)
+        self.assertEqual(runs["run2"]["product_count"], 0)
+        self.assertEqual(runs["run1"]["current_task_name"], self._task3.name)
+        self.assertEqual(runs["run2"]["current_task_name"], self._task4.name)
+        # The same as when worked out for a single run
+        for run in Run.objects.all():
+            self.assertEqual(runs[run.name]["validate_inputs"],
+                             {str(k): v for k, v in run.has_valid_inputs().items()})
+            self.assertEqual([t["name"] for t in runs[run.name]["tasks_list"]],
+                             [t.name for t in run.get_tasks()])
+
     def test_user_view_own(self):
         self._asJoeBloggs()
         response = self._client.get('/runs/%d/' % self._run1.id)
@@ -2439,6 +2661,42 @@ class RunTestCase(LoggedInTestCase):
             "input_files": []  # array of {filetemplate.name,filehandle}
         }
 
+    def test_get_product_input_items(self):
+        view = RunViewSet()
+        with CaptureQueriesContext(connection) as two_products:
+            items = view._get_product_input_items(self._run1, self._prodinput.name)
+        self.assertEqual(items, {self._joeBloggsProduct: [self._item2, self._item1],
+                                 self._jimBeamProduct: [self._item3]})
+        # The number of queries must not grow with the number of products
+        self._run1.products.add(self._janeDoeProduct)
+        self._run1.exclude = '%d,' % self._item2.id
+        with CaptureQueriesContext(connection) as three_products:
+            items = view._get_product_input_items(self._run1, self._prodinput.name)
+        self.assertEqual(items, {self._joeBloggsProduct: [self._item1],
+                                 self._jimBeamProduct: [self._item3],
+                                 self._janeDoeProduct: [self._item3]})
+        self.assertEqual(len(three_products), len(two_products))
+
+    def test_prefetch_transfers(self):
+        plate = ItemTransfer.objects.create(item=self._item1, amount_taken=1,
+                                            amount_measure=self._millilitre,
+                                            barcode="PL1", coordinates="A1")
+        for i in range(3):
+            ItemTransfer.objects.create(item=self._item1, amount_taken=1,
+                                        amount_measure=self._millilitre)
+        for i in range(2):
+            ItemTransfer.objects.create(item=self._item2, amount_taken=1,
+                                        amount_measure=self._millilitre)
+        view = RunViewSet()
+        view._prefetch_transfers({
+            self._item1: {"barcode": "PL1", "coordinates": "A1"},
+            self._item2: {"barcode": None, "coordinates": None},
+        })
+        # Only the single match is loaded, not every transfer of the items
+        self.assertEqual(list(view._transfers.values()), [plate])
+        self.assertEqual(view._get_transfer(self._item1, "PL1", "A1"), plate)
+        self.assertIsNone(view._get_transfer(self._item2, None, None))
+
     def test_start_task_check(self):
         start_task = self._prepare_start_task()
         self._asJoeBloggs()
@@ -2468,6 +2726,26 @@ class RunTestCase(LoggedInTestCase):
         self.assertEqual(Item.objects.get(id=self._item3.id).amount_available, 30)
         self.assertEqual(Item.objects.get(id=self._itemLW.id).amount_available, 10)
 
+    def test_start_task_check_auto_find_latest(self):
+        item6 = Item.objects.create(name="item_6", item_type=self._prodinput,
+                                    amount_measure=self._millilitre,
+                                    location=self._location,
+                                    amount_available=30,
+                                    added_by=self._joeBloggs,
+                                    identifier="item6")
+        ItemProperty.objects.create(item=item6, name='task_input',
+                                    value="{}/input3".format(self._joeBloggsProduct
+                                                             .product_identifier))
+        start_task = self._prepare_start_task()
+        self._asJoeBloggs()
+        response = self._client.post(
+            "/runs/%d/start_task/?is_check=True" % self._run1.id, data=start_task)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        identifiers = [x["item"]["identifier"] for x in response.data["requirements"]]
+        self.assertIn("item6", identifiers)
+        self.assertNotIn("item4", identifiers)
+        self.assertIn("item5", identifiers)
+
     def test_start_task_insufficient_inventory(self):
         start_task = self._prepare_start_task(product_input_amount=99)
         self._asJoeBloggs()
@@ -2498,6 +2776,71 @@ class RunTestCase(LoggedInTestCase):
         self.assertEqual(Item.objects.get(id=self._item3.id).amount_available, 30)
         self.assertEqual(Item.objects.get(id=self._itemLW.id).amount_available, 10)
 
+    def test_start_task_insufficient_inventory_rolls_back(self):
+        start_task = self._prepare_start_task(product_input_amount=99)
+        self._asJoeBloggs()
+        response = self._client.post(
+            "/runs/%d/start_task/" % self._run1.id, data=start_task)
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        # Equipment is not left marked as in use by a task that did not start
+        self.assertEqual(Equipment.objects.get(id=self._equipmentSequencer.id).status, "idle")
+        self.assertEqual(Run.objects.get(id=self._run1.id).equipment_used, None)
+
+    def test_plan(self):
+        self._asJoeBloggs()
+        response = self._client.get("/runs/%d/plan/" % self._run1.id)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        plan = response.data
+        self.assertEqual([t["name"] for t in plan["tasks"]],
+                         ["TaskTempl3", "TaskTempl2", "TaskTempl1"])
+        self.assertEqual(plan["products"], 2)
+        items = {i["identifier"]: i for i in plan["items"]}
+        # Product input taken by each of the three tasks
+        self.assertEqual(items["i1"]["required"], 3.0)
+        self.assertEqual(items["i3"]["required"], 3.0)
+        self.assertEqual(items["i3"]["shortfall"], 0.0)
+        # Found by product identifier and label
+        self.assertEqual(items["item4"]["required"], 4.0)
+        self.assertEqual(items["item5"]["required"], 4.0)
+        # Outputs of the first task are used by the later tasks
+        outputs = [i for i in plan["items"] if i["id"] is None]
+        self.assertEqual(len(outputs), 2)
+        self.assertEqual(outputs[0]["required"], 2.0)
+        self.assertEqual(outputs[0]["available"], 9.6)
+        item_types = {(t["item_type"], t["measure"]): t for t in plan["item_types"]}
+        self.assertEqual(item_types[("ExampleStuff", "ml")]["required"], 10.0)
+        self.assertEqual(item_types[("ExampleStuff", "ml")]["available"], 130.0)
+        self.assertEqual(item_types[("ExampleLabware", "item")]["shortfall"], 3.0)
+        self.assertIs(plan["valid"], False)
+        # Nothing is changed by planning
+        self.assertEqual(Item.objects.get(id=self._item1.id).amount_available, 10)
+        self.assertEqual(ItemTransfer.objects.count(), 0)
+
+    def test_start_task_twice_conflicts(self):
+        start_task = self._prepare_start_task()
+        self._asJoeBloggs()
+        response = self._client.post(
+            "/runs/%d/start_task/" % self._run1.id, data=start_task)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        uuid = Run.objects.get(id=self._run1.id).task_run_identifier
+        start_task = self._prepare_start_task()
+        response = self._client.post(
+            "/runs/%d/start_task/" % self._run1.id, data=start_task)
+        self.assertEqual(response.status_code, status.HTTP_409_CONFLICT)
+        # Nothing from the second request is kept
+        self.assertEqual(Run.objects.get(id=self._run1.id).task_run_identifier, uuid)
+        self.assertEqual(DataEntry.objects.filter(run=self._run1).count(), 2)
+
+    def test_set_equipment_status(self):
+        view = RunViewSet()
+        self.assertIs(view._set_equipment_status(self._equipmentSequencer, "active", "idle"),
+                      True)
+        # Equipment that is no longer idle cannot be taken again
+        equipment = Equipment.objects.get(id=self._equipmentSequencer.id)
+        self.assertIs(view._set_equipment_status(equipment, "active", "idle"), False)
+        self.assertIs(view._set_equipment_status(equipment, "idle"), True)
+        self.assertEqual(Equipment.objects.get(id=self._equipmentSequencer.id).status, "idle")
+
     def test_start_task(self):
         start_task = self._prepare_start_task()
         self._asJoeBloggs()
@@ -2513,6 +2856,7 @@ class RunTestCase(LoggedInTestCase):
         # check create ItemTransfers per input item
         its = ItemTransfer.objects.filter(run_identifier=uuid)
         self.assertEqual(its.count(), 6)
+        self.assertEqual(run.transfers.filter(run_identifier=uuid).count(), 6)
         # for it in its.all():
         #    self.assertIs(it.transfer_complete, True)
         # check one DataEntry per input product item
@@ -2522,6 +2866,9 @@ class RunTestCase(LoggedInTestCase):
         self.assertEqual(Item.objects.get(id=self._item2.id).amount_available, 13)
         self.assertEqual(Item.objects.get(id=self._item3.id).amount_available, 29)
         self.assertEqual(Item.objects.get(id=self._itemLW.id).amount_available, 9)
+        # Rows written in bulk are still recorded in the audit trail
+        self.assertEqual(Version.objects.get_for_model(DataEntry).count(), 2)
+        self.assertEqual(Version.objects.get_for_model(ItemTransfer).count(), 6)
 
     def test_start_task_input_not_required(self):
         start_task = {"task": json.dumps({
@@ -2796,6 +3143,80 @@ class RunTestCase(LoggedInTestCase):
                                                    "task": "TaskTempl3",
                                                    "run": "run1"})
 
+    def test_get_file_stream(self):
+        start_task = self._prepare_start_task()
+        self._asJoeBloggs()
+        response = self._client.post(
+            "/runs/%d/start_task/" % self._run1.id, data=start_task)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        response = self._client.get(
+            "/runs/%d/get_file/?file_id=%d&stream=true" % (self._run1.id, self._equipTempl1.id))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertIs(response.streaming, True)
+        self.assertEqual(response["Content-Type"], "text/csv")
+        lines = b"".join(response.streaming_content).decode("utf-8").splitlines()
+        # A header followed by a line per product input
+        self.assertEqual(len(lines), 8)
+        header = lines[0].split(",")
+        self.assertIn("product_name", header)
+        self.assertIn("task_input.name", header)
+
+    def test_cancel_task(self):
+        start_task = self._prepare_start_task()
+        self._asJoeBloggs()
+        response = self._client.post(
+            "/runs/%d/start_task/" % self._run1.id, data=start_task)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        uuid = Run.objects.get(id=self._run1.id).task_run_identifier
+        response = self._client.post("/runs/%d/cancel_task/" % self._run1.id)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data["message"], "Task cancelled")
+        run = Run.objects.get(id=self._run1.id)
+        self.assertIs(run.task_in_progress, False)
+        self.assertIs(run.has_started, False)
+        self.assertEqual(ItemTransfer.objects.filter(run_identifier=uuid).count(), 0)
+        self.assertEqual(DataEntry.objects.filter(task_run_identifier=uuid).count(), 0)
+        # Everything taken is returned to the inventory
+        self.assertEqual(Item.objects.get(id=self._item1.id).amount_available, 10)
+        self.assertEqual(Item.objects.get(id=self._item2.id).amount_available, 20)
+        self.assertEqual(Item.objects.get(id=self._item3.id).amount_available, 30)
+        self.assertEqual(Item.objects.get(id=self._itemLW.id).amount_available, 10)
+
+    def _next_run_event(self):
+        channel, message = channel_layers[DEFAULT_CHANNEL_LAYER].receive(["test-run-events"])
+        self.assertEqual(channel, "test-run-events")
+        return json.loads(message["text"])
+
+    def test_run_events(self):
+        run_group(self._run1.id).add("test-run-events")
+        start_task = self._prepare_start_task()
+        self._asJoeBloggs()
+        response = self._client.post(
+            "/runs/%d/start_task/" % self._run1.id, data=start_task)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        run = Run.objects.get(id=self._run1.id)
+        # Nothing is sent until the transaction commits
+        channel, message = channel_layers[DEFAULT_CHANNEL_LAYER].receive(["test-run-events"])
+        self.assertIsNone(channel)
+        self._runOnCommit()
+        event = self._next_run_event()
+        self.assertEqual(event["event"], "task_started")
+        self.assertEqual(event["run"], self._run1.id)
+        self.assertIs(event["task_in_progress"], True)
+        self.assertEqual(event["task_run_identifier"], str(run.task_run_identifier))
+        uuid = run.task_run_identifier
+        self.assertEqual(set(event["data_entries"]), set(
+            DataEntry.objects.filter(task_run_identifier=uuid).values_list('id', flat=True)))
+        self.assertEqual(set(event["transfers"]), set(
+            ItemTransfer.objects.filter(run_identifier=uuid).values_list('id', flat=True)))
+        response = self._client.post("/runs/%d/cancel_task/" % self._run1.id)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self._runOnCommit()
+        event = self._next_run_event()
+        self.assertEqual(event["event"], "task_cancelled")
+        self.assertIs(event["task_in_progress"], False)
+        run_group(self._run1.id).discard("test-run-events")
+
     def test_finish_task_inactive(self):
         # Get status and check data response (without starting task first)
         self._asJoeBloggs()
@@ -2826,6 +3247,10 @@ class RunTestCase(LoggedInTestCase):
             "/runs/%d/finish_task/" % self._run1.id,
             {"failures": self._joeBloggsProduct.id}, format='json')
         self.assertEqual(response.status_code, status.HTTP_200_OK)
+        # Completed transfers are recorded in the audit trail
+        taken = [v for v in Version.objects.get_for_model(ItemTransfer)
+                 if v.field_dict['has_taken']]
+        self.assertEqual(len(taken), 6)
         # Check new Run because of failure
         run = Run.objects.get(id=self._run1.id)  # Yes, really, must reload here
         new_name = '{} (failed)'.format(run.name)
@@ -2869,13 +3294,24 @@ class RunTestCase(LoggedInTestCase):
         self.assertEqual(output.created_from.count(), 1)
         self.assertEqual(output.created_from.all()[0], self._item3)
         self.assertIn(output, e.product.linked_inventory.all())
-        # Check filepath copy from equipment
+        # Check permissions cloned from the project
+        self.assertEqual(set(get_perms(Group.objects.get(name="jane_group"), output)),
+                         {"add_item", "change_item", "delete_item", "view_item"})
+        self.assertEqual(get_perms(Group.objects.get(name="joe_group"), output), [])
+        # Check filepath copy from equipment, queued once the request commits
+        self.assertEqual(response.data["file_copy_status"], "pending")
+        self.assertEqual(e.data_files.count(), 0)
+        self._runOnCommit()
+        run = Run.objects.get(id=self._run1.id)
         self.assertEqual(e.data_files.count(), 1)
         df = e.data_files.all()[0]
         self.assertEqual(df.file_name, os.path.basename(real_to_path))
         self.assertEqual(df.location, real_to_path)
         self.assertEqual(df.equipment, self._equipmentSequencer)
         self.assertIs(filecmp.cmp(os.path.join(real_from_path), os.path.join(real_to_path)), True)
+        self.assertEqual(run.file_copy_status, "complete")
+        self.assertEqual(run.files_to_copy, 1)
+        self.assertEqual(run.files_copied, 1)
         # Clean up
         os.remove(real_from_path)
         os.remove(real_to_path)
@@ -2888,6 +3324,8 @@ class RunTestCase(LoggedInTestCase):
         self.assertEqual(runresp["name"], "run1")
         self.assertIs(runresp["task_in_progress"], False)
         self.assertEqual(len(runresp["transfers"]), 6)
+        self.assertIs(ItemTransfer.objects.filter(run_identifier=rtri,
+                                                  has_taken=False).exists(), False)
         self.assertEqual(runresp["started_by"], "Joe Bloggs")
         self.assertIs(runresp["is_active"], True)
         self.assertIs(runresp["has_started"], True)
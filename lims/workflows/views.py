@@ -2,13 +2,13 @@ from io import TextIOWrapper
 import json
 import copy
 import uuid
-import re
 
-from pint import UnitRegistry, UndefinedUnitError
-from pyparsing import ParseException
-
-from django.core.exceptions import ObjectDoesNotExist, MultipleObjectsReturned
+from django.core.exceptions import ObjectDoesNotExist
 
+from django.db import transaction
+from django.db.models import Count, IntegerField, Max, OuterRef, Prefetch, Q, Subquery
+from django.db.models.functions import Coalesce
+from django.http import StreamingHttpResponse
 from django.utils import timezone
 from guardian.shortcuts import get_group_perms
 
@@ -17,7 +17,7 @@ import django_filters
 from rest_framework import viewsets
 from rest_framework import serializers
 from rest_framework.response import Response
-from rest_framework.decorators import detail_route
+from rest_framework.decorators import detail_route, list_route
 from rest_framework.parsers import FormParser, MultiPartParser
 from rest_framework.validators import ValidationError
 from rest_framework.filters import (OrderingFilter,
@@ -31,37 +31,38 @@ from lims.shared.filters import ListFilter
 from lims.permissions.permissions import (ViewPermissionsMixin,
                                           ExtendedObjectPermissions,
                                           ExtendedObjectPermissionsFilter)
+from lims.permissions.principal import get_principal
 
+from lims.shared.exceptions import Conflict
 from lims.shared.mixins import StatsViewMixin, AuditTrailViewMixin
+from lims.shared.signals import send_post_save
+from lims.shared.streaming import csv_rows, iterate_in_chunks
 from lims.filetemplate.models import FileTemplate
 from lims.inventory.models import (Item, ItemTransfer, AmountMeasure, Location,
-                                   ItemType)
+                                   ItemType, ItemProperty)
 from lims.inventory.serializers import ItemTransferPreviewSerializer
-# Disable flake8 on this line as we need the templates to be imported but
-# they do not appear to be used (selected from globals)
-from .models import (Workflow,  # noqa
-                     Run, RunLabware,  # noqa
-                     TaskTemplate, InputFieldTemplate, OutputFieldTemplate,  # noqa
-                     StepFieldTemplate, VariableFieldTemplate,  # noqa
-                     CalculationFieldTemplate)  # noqa
-from .serializers import (WorkflowSerializer, SimpleTaskTemplateSerializer,  # noqa
-                          TaskTemplateSerializer,  # noqa
-                          TaskTemplateNoProductInputSerializer,  # noqa
-                          TaskValuesSerializer,  # noqa
-                          TaskValuesNoProductInputSerializer,  # noqa
-                          RunSerializer,  # noqa
-                          DetailedRunSerializer,  # noqa
-                          InputFieldTemplateSerializer,  # noqa
-                          OutputFieldTemplateSerializer,  # noqa
-                          VariableFieldTemplateSerializer,  # noqa
-                          VariableFieldValueSerializer,  # noqa
-                          StepFieldTemplateSerializer,  # noqa
-                          CalculationFieldTemplateSerializer,  # noqa
-                          RecalculateTaskTemplateSerializer)  # noqa
+from lims.inventory.units import conversion_table, measured
+from .models import (Workflow, WorkflowTask,
+                     Run, RunTask,
+                     TaskTemplate)
+from .serializers import (WorkflowSerializer, SimpleTaskTemplateSerializer,
+                          TaskTemplateSerializer,
+                          TaskTemplateNoProductInputSerializer,
+                          TaskValuesSerializer,
+                          TaskValuesNoProductInputSerializer,
+                          RunSerializer,
+                          DetailedRunSerializer,
+                          RecalculateTaskTemplateSerializer)
 from lims.datastore.models import DataEntry
 from lims.datastore.serializers import DataEntrySerializer
+from lims.drivers.models import CopyFilePath
 from lims.equipment.models import Equipment
-from .calculation import NumericStringParser
+from lims.projects.models import Product
+from .calculation import calculation_cache
+from .tasks import copy_run_files
+from .consumers import send_run_event
+from .planner import MaterialPlanner
+from .task_fields import get_field_type, get_task_fields
 
 
 class WorkflowViewSet(AuditTrailViewMixin, ViewPermissionsMixin, viewsets.ModelViewSet):
@@ -72,7 +73,8 @@ class WorkflowViewSet(AuditTrailViewMixin, ViewPermissionsMixin, viewsets.ModelV
 
     - _search_: search workflow name and created_by
     """
-    queryset = Workflow.objects.all()
+    queryset = Workflow.objects.prefetch_related(
+        Prefetch('task_positions', queryset=WorkflowTask.objects.select_related('task')))
     serializer_class = WorkflowSerializer
     search_fields = ('name', 'created_by__username',)
     permission_classes = (ExtendedObjectPermissions,)
@@ -89,12 +91,8 @@ class WorkflowViewSet(AuditTrailViewMixin, ViewPermissionsMixin, viewsets.ModelV
         workflow = self.get_object()
         serializer = self.get_serializer(workflow)
         result = serializer.data
-        tasklist = []
-        tasks = self.get_object().get_tasks()
-        for t in tasks:
-            serializer_task = SimpleTaskTemplateSerializer(t)
-            tasklist.append(serializer_task.data)
-        result['tasks'] = tasklist
+        tasks = [t for t in workflow.load_tasks() if t is not None]
+        result['tasks'] = SimpleTaskTemplateSerializer(tasks, many=True).data
         return Response(result)
 
     @detail_route()
@@ -110,8 +108,8 @@ class WorkflowViewSet(AuditTrailViewMixin, ViewPermissionsMixin, viewsets.ModelV
         position = request.query_params.get('position', None)
         if position:
             try:
-                taskId = workflow.order.split(',')[int(position)]
-                task = TaskTemplate.objects.get(pk=taskId)
+                task_id = workflow.get_task_ids()[int(position)]
+                task = TaskTemplate.objects.with_fields().get(pk=task_id)
                 serializer = TaskTemplateSerializer(task)
                 result = serializer.data
             except IndexError:
@@ -121,6 +119,32 @@ class WorkflowViewSet(AuditTrailViewMixin, ViewPermissionsMixin, viewsets.ModelV
             return Response(result)
         return Response({'message': 'Please provide a task position'}, status=400)
 
+    @detail_route()
+    def plan(self, request, pk=None):
+        """
+        Work out the inventory needed to run products through the workflow
+
+        Nothing is changed, the tasks are simulated using the amounts on
+        their templates.
+
+        ### query_params
+
+        - _products_ (**required**): Comma seperated list of product IDs
+        """
+        workflow = self.get_object()
+        product_ids = request.query_params.get('products', None)
+        if not product_ids:
+            return Response({'message': 'Please provide a list of products'}, status=400)
+        try:
+            product_ids = [int(p) for p in product_ids.split(',') if p != '']
+        except ValueError:
+            return Response({'message': 'Invalid product IDs'}, status=400)
+        # Only plan for products the user is allowed to see
+        products = ExtendedObjectPermissionsFilter().filter_queryset(
+            request, Product.objects.filter(id__in=product_ids), self)
+        planner = MaterialPlanner(workflow.load_tasks(), MaterialPlanner.load_products(products))
+        return Response(planner.plan())
+
 
 class RunFilterSet(django_filters.FilterSet):
     run_active = django_filters.BooleanFilter(name='date_finished', lookup_expr='isnull')
@@ -139,7 +163,8 @@ class RunViewSet(AuditTrailViewMixin, ViewPermissionsMixin, StatsViewMixin, view
     """
     List all runs, active only be default
     """
-    queryset = Run.objects.all()
+    queryset = Run.objects.prefetch_related(
+        Prefetch('task_positions', queryset=RunTask.objects.select_related('task')))
     serializer_class = RunSerializer
     permission_classes = (ExtendedObjectPermissions,)
     filter_backends = (SearchFilter, DjangoFilterBackend,
@@ -158,6 +183,46 @@ class RunViewSet(AuditTrailViewMixin, ViewPermissionsMixin, StatsViewMixin, view
             return DetailedRunSerializer
         return self.serializer_class
 
+    def get_queryset(self):
+        """
+        Load everything shown in the run list in a fixed number of queries
+        """
+        queryset = super().get_queryset()
+        if self.action == 'list':
+            current_task = RunTask.objects.filter(run=OuterRef('pk'),
+                                                  position=OuterRef('current_task'))
+            # A subquery rather than a join so the other rows are not grouped
+            num_products = Run.products.through.objects.filter(run=OuterRef('pk')) \
+                .values('run').annotate(count=Count('product')).values('count')
+            products = Product.objects.select_related('product_type').prefetch_related(
+                'runs', Prefetch('linked_inventory',
+                                 queryset=Item.objects.select_related('item_type')))
+            task_positions = RunTask.objects.select_related(
+                'task__product_input', 'task__created_by').prefetch_related(
+                'task__capable_equipment')
+            queryset = queryset.select_related('started_by', 'equipment_used').annotate(
+                num_products=Coalesce(Subquery(num_products[:1], output_field=IntegerField()),
+                                      0),
+                current_task_name=Subquery(current_task.values('task__name')[:1]),
+            ).prefetch_related(None).prefetch_related(
+                'labware', 'transfers',
+                Prefetch('products', queryset=products),
+                Prefetch('task_positions', queryset=task_positions))
+        return queryset
+
+    def list(self, request, *args, **kwargs):
+        queryset = self.filter_queryset(self.get_queryset())
+        page = self.paginate_queryset(queryset)
+        runs = page if page is not None else list(queryset)
+        # Work out the valid inputs/product input types for the runs together
+        Run.load_valid_inputs(runs)
+        TaskTemplate.load_valid_product_input_types(
+            [t for run in runs for t in run.get_tasks() if t is not None])
+        serializer = self.get_serializer(runs, many=True)
+        if page is not None:
+            return self.get_paginated_response(serializer.data)
+        return Response(serializer.data)
+
     def perform_create(self, serializer):
         # TODO:
         # Check tasks permissions valid
@@ -166,27 +231,30 @@ class RunViewSet(AuditTrailViewMixin, ViewPermissionsMixin, StatsViewMixin, view
         instance = serializer.save(started_by=self.request.user)
         self.assign_permissions(instance, permissions)
 
-    def _get_product_input_items(self, input_type):
+    def _get_product_input_items(self, run, input_type):
         """
         Get input items from products in the run
+
+        The item type and its descendants are resolved once and the
+        matching linked items for every product fetched in one query.
         """
-        run = self.get_object()
         excludes = []
         if run.exclude:
             excludes = [v for v in run.exclude.split(',') if v != '']
-        task_input_items = {}
-        for p in run.products.all():
-            if input_type:
-                input_type_mdl = ItemType.objects.get(name=input_type)
-                # Get all decendents of the item type
-                with_children = input_type_mdl.get_descendants(include_self=True)
-                # Get list of names of types
-                itn = [t.name for t in with_children]
-                items_picked = p.linked_inventory.filter(item_type__name__in=itn) \
-                    .exclude(id__in=excludes)
-                task_input_items[p] = list(items_picked)
-            else:
-                task_input_items[p] = []
+        products = list(run.products.all())
+        task_input_items = {p: [] for p in products}
+        if input_type and products:
+            input_type_mdl = ItemType.objects.get(name=input_type)
+            # Get all decendents of the item type
+            with_children = input_type_mdl.get_descendants(include_self=True)
+            products_by_id = {p.id: p for p in products}
+            links = Product.linked_inventory.through.objects \
+                .filter(product__in=products, item__item_type__in=with_children) \
+                .exclude(item_id__in=excludes) \
+                .select_related('item') \
+                .order_by('-item_id')
+            for link in links:
+                task_input_items[products_by_id[link.product_id]].append(link.item)
         return task_input_items
 
     def _generate_data_dict(self, input_items, task_data):
@@ -213,35 +281,6 @@ class RunViewSet(AuditTrailViewMixin, ViewPermissionsMixin, StatsViewMixin, view
                 data_items[key]['product_inputs'][itm.id] = itm_data
         return data_items
 
-    def _replace_fields(self, values):
-        """
-        Replace field names with their correct values
-        """
-        def match_value(match):
-            mtch = match.group(1)
-            if mtch in values:
-                return str(values[mtch])
-            return str(0)
-        return match_value
-
-    def _calculate_value(self, calculation, values):
-        """
-        Parse and perform a calculation using a dict of fields
-
-        Using either a dict of values to field names
-
-        Returns a NaN if the calculation cannot be performed, e.g.
-        incorrect field names.
-        """
-        nsp = NumericStringParser()
-        field_regex = r'\{(.+?)\}'
-        interpolated_calculation = re.sub(field_regex, self._replace_fields(values), calculation)
-        try:
-            result = nsp.eval(interpolated_calculation)
-        except ParseException:
-            return None
-        return result
-
     def _flatten_values(self, rep):
         """
         Take a dict of task data and reduce to field label: value
@@ -262,23 +301,41 @@ class RunViewSet(AuditTrailViewMixin, ViewPermissionsMixin, StatsViewMixin, view
     def _perform_calculations(self, task_data):
         """
         Alter fields based on calculations.
+
+        Values for every product are gathered into columns so that each
+        calculation is evaluated once across the whole run rather than
+        once per product.
         """
-        # Operate on each product entry and values for the fields
+        rows = []
+        # (calculation ID, calculation) -> [(row, field), ...]
+        targets = {}
         for pid, product_data in task_data.items():
             # First, index any calculations to refer to later
             calculations = {c['id']: c for c in product_data['calculation_fields']}
             # Flatten data to a dict
-            to_values = self._flatten_values(product_data)
+            row = len(rows)
+            rows.append(self._flatten_values(product_data))
             # Look through each field for calculations
             for field_type in ['input_fields', 'step_fields', 'variable_fields', 'output_fields']:
                 if field_type in product_data:
                     for field in product_data[field_type]:
                         if 'calculation_used' in field and field['calculation_used'] is not None:
                             # Look up calculations from list
-                            calc = calculations[field['calculation_used']]['calculation']
-                            # Return the calculated value
-                            result = self._calculate_value(calc, to_values)
-                            field['amount'] = result
+                            calc_id = field['calculation_used']
+                            calc = calculations[calc_id]['calculation']
+                            targets.setdefault((calc_id, calc), []).append((row, field))
+        for (calc_id, calc), fields in targets.items():
+            compiled = calculation_cache.get(calc, calc_id)
+            if compiled is None:
+                for row, field in fields:
+                    field['amount'] = None
+                continue
+            used_rows = sorted(set(row for row, field in fields))
+            columns = {label: [rows[r].get(label, 0) for r in used_rows]
+                       for label in compiled.fields}
+            results = dict(zip(used_rows, compiled.evaluate_many(columns, len(used_rows))))
+            for row, field in fields:
+                field['amount'] = results[row]
         return task_data
 
     def _update_data_items_from_file(self, file_data, data_items):
@@ -303,25 +360,84 @@ class RunViewSet(AuditTrailViewMixin, ViewPermissionsMixin, StatsViewMixin, view
                     raise ValidationError(message)
         return data_items
 
-    def _as_measured_value(self, amount, measure):
+    def _prefetch_inventory(self, data_items, task_data):
         """
-        Convert if possible to a value with units
+        Fetch all items and measures referenced by the task data
+
+        Items are looked up by ID and by task_input property in a few
+        set based queries and kept for the rest of the task to use.
         """
-        if type(amount) is not float:
-            amount = float(amount)
-        try:
-            value = amount * self.ureg(measure)
-        except UndefinedUnitError:
-            value = amount * self.ureg.count
-        return value
+        item_ids = set()
+        task_inputs = set()
+        if task_data.validated_data.get('labware_not_required', False) is not True:
+            item_ids.add(task_data.validated_data.get('labware_identifier', None))
+        for key, item in data_items.items():
+            for field in item['input_fields']:
+                if field['auto_find_in_inventory']:
+                    task_inputs.add('{}/{}'.format(key, field['label']))
+                else:
+                    item_ids.add(field.get('inventory_identifier', None))
+            item_ids.update(item['product_inputs'].keys())
+
+        # Where more than one item matches use the most recent as the
+        # items would be ordered by -id
+        self._task_input_items = {}
+        if task_inputs:
+            properties = ItemProperty.objects.filter(name='task_input', value__in=task_inputs) \
+                .order_by('item_id').values_list('value', 'item_id')
+            for value, item_id in properties:
+                self._task_input_items[value] = item_id
+        item_ids.update(self._task_input_items.values())
+
+        valid_ids = set()
+        for identifier in item_ids:
+            try:
+                valid_ids.add(int(identifier))
+            except (TypeError, ValueError):
+                pass
+        self._inventory = {i.id: i for i in
+                           Item.objects.filter(id__in=valid_ids).select_related('amount_measure')}
+        self._measures = {m.symbol: m for m in AmountMeasure.objects.all()}
+
+    def _prefetch_transfers(self, sum_item_amounts):
+        """
+        Fetch any existing transfers that could be used for the items
+
+        Only a transfer that is the single match for an item, barcode and
+        coordinates is used, so matches are counted in the database and
+        just those that are single are loaded.
+        """
+        self._transfers = {}
+        query = Q()
+        for item, required in sum_item_amounts.items():
+            # None matches a null barcode/coordinates as ItemTransfer.objects.get would
+            query |= Q(item_id=item.id, barcode=required.get('barcode', None),
+                       coordinates=required.get('coordinates', None))
+        if sum_item_amounts:
+            matches = ItemTransfer.objects.filter(query) \
+                .values('item_id', 'barcode', 'coordinates') \
+                .annotate(matching=Count('id'), transfer_id=Max('id')).order_by()
+            single = [m['transfer_id'] for m in matches if m['matching'] == 1]
+            transfers = ItemTransfer.objects.filter(id__in=single) \
+                .select_related('amount_measure')
+            self._transfers = {(t.item_id, t.barcode, t.coordinates): t for t in transfers}
+
+    def _get_transfer(self, item, barcode, coordinates):
+        """
+        Get the one existing transfer matching item, barcode and coordinates
+        """
+        transfer = self._transfers.get((item.id, barcode, coordinates), None)
+        if transfer is not None:
+            transfer.item = item
+        return transfer
 
     def _get_from_inventory(self, identifier):
         """
         Get an item from the inventory based on identifier
         """
         try:
-            item = Item.objects.get(id=identifier)
-        except Item.DoesNotExist:
+            item = self._inventory[int(identifier)]
+        except (KeyError, TypeError, ValueError):
             message = {'message': 'Item {} does not exist !'.format(identifier)}
             raise serializers.ValidationError(message)
         return item
@@ -329,19 +445,23 @@ class RunViewSet(AuditTrailViewMixin, ViewPermissionsMixin, StatsViewMixin, view
     def _update_amounts(self, item, amount, store, field):
         """
         Referenced update of an amount indexed by identifier
+
+        Totals are kept in the measure of the first amount added.
         """
         if item not in store:
-            store[item] = {'amount': amount,
+            store[item] = {'amount': amount['amount'],
+                           'measure': amount['measure'],
                            'barcode': field.get('destination_barcode', None),
                            'coordinates': field.get('destination_coordinates', None)}
         else:
-            store[item]['amount'] += amount
+            store[item]['amount'] += conversion_table.convert(
+                amount['amount'], amount['measure'], store[item]['measure'])
 
     def _update_item_amounts(self, field, key, data_item_amounts, sum_item_amounts):
         """
         Referenced update of item amounts + sum item amounts
         """
-        amount = self._as_measured_value(field['amount'], field['measure'])
+        amount = {'amount': float(field['amount']), 'measure': field['measure']}
         item = self._get_from_inventory(field['inventory_identifier'])
         data_item_amounts[key][item] = amount
         self._update_amounts(item, amount, sum_item_amounts, field)
@@ -359,11 +479,12 @@ class RunViewSet(AuditTrailViewMixin, ViewPermissionsMixin, StatsViewMixin, view
             labware_item = self._get_from_inventory(labware_identifier)
             labware_required = task_data.validated_data['labware_amount']
             labware_barcode = task_data.validated_data.get('labware_barcode', None)
-            labware_symbol = None
+            labware_symbol = 'item'
             if labware_item.amount_measure is not None:
                 labware_symbol = labware_item.amount_measure.symbol
             sum_item_amounts[labware_item] = {
-                    'amount': self._as_measured_value(labware_required, labware_symbol),
+                    'amount': float(labware_required),
+                    'measure': labware_symbol,
                     'barcode': labware_barcode,
             }
 
@@ -374,13 +495,10 @@ class RunViewSet(AuditTrailViewMixin, ViewPermissionsMixin, StatsViewMixin, view
                 if field['auto_find_in_inventory']:
                     identifier = '{}/{}'.format(key, field['label'])
                     try:
-                        lookup_item = Item.objects.filter(properties__name='task_input',
-                                                          properties__value=identifier)[0]
-                    except:
+                        field['inventory_identifier'] = self._task_input_items[identifier]
+                    except KeyError:
                         raise serializers.ValidationError({'message':
                                                           'Item does not exist!'})
-                    else:
-                        field['inventory_identifier'] = lookup_item.id
                 self._update_item_amounts(field, key, data_item_amounts, sum_item_amounts)
 
             for identifier, field in item['product_inputs'].items():
@@ -396,22 +514,21 @@ class RunViewSet(AuditTrailViewMixin, ViewPermissionsMixin, StatsViewMixin, view
         error_items = []
         valid_amounts = True
         for item, required in sum_item_amounts.items():
-            available = self._as_measured_value(item.amount_available,
-                                                item.amount_measure.symbol)
+            available = item.amount_available
+            symbol = item.amount_measure.symbol
             # Lookup transfers to see if one make sense for this
             # Only if a barcode is supplied, as this inidcates a plate may already exist
             if required.get('barcode', None):
-                try:
-                    transfer = ItemTransfer.objects.get(item=item,
-                                                        barcode=required.get('barcode', None),
-                                                        coordinates=required.get('coordinates',
-                                                                                 None))
-                    available = self._as_measured_value(transfer.amount_taken,
-                                                        transfer.amount_measure.symbol)
-                except ItemTransfer.DoesNotExist:
-                    pass
-            if available < required['amount']:
-                missing = (available - required['amount']) * -1
+                transfer = self._get_transfer(item, required.get('barcode', None),
+                                              required.get('coordinates', None))
+                if transfer is not None:
+                    available = transfer.amount_taken
+                    symbol = transfer.amount_measure.symbol
+            required_amount = conversion_table.convert(required['amount'],
+                                                       required['measure'], symbol)
+            if available < required_amount:
+                # With units only for the message
+                missing = measured(required_amount - available, symbol)
                 # Needs changing to reflext identifier is no longer a required field
                 # as may just be name/barcode now
                 message = 'Inventory item {0} ({1}) is short of amount by {2:.2f}'.format(
@@ -428,23 +545,20 @@ class RunViewSet(AuditTrailViewMixin, ViewPermissionsMixin, StatsViewMixin, view
         transfers = []
         for item, amount in sum_item_amounts.items():
             try:
-                amount_symbol = '{:~}'.format(amount['amount']).split(' ')[1]
-                measure = AmountMeasure.objects.get(symbol=amount_symbol)
-                amount['amount'] = amount['amount'].magnitude
-            except:
-                measure = AmountMeasure.objects.get(symbol='item')
+                measure = self._measures[amount['measure']]
+            except KeyError:
+                measure = self._measures['item']
 
             # Look up to see if there is a matching ItemTransfer already and then
             # use this instead
-            try:
-                transfer = ItemTransfer.objects.get(item=item,
-                                                    barcode=amount.get('barcode', None),
-                                                    coordinates=amount.get('coordinates', None))
+            transfer = self._get_transfer(item, amount.get('barcode', None),
+                                          amount.get('coordinates', None))
+            if transfer is not None:
                 # At this point need to subtract amount from available in existing
                 # transfer! Need to mark in some way not completed though so can put
                 # back if the trasnfer is cancelled
                 transfer.amount_to_take = amount['amount']
-            except (ObjectDoesNotExist, MultipleObjectsReturned):
+            else:
                 transfer = ItemTransfer(
                     item=item,
                     barcode=amount.get('barcode', None),
@@ -462,8 +576,8 @@ class RunViewSet(AuditTrailViewMixin, ViewPermissionsMixin, StatsViewMixin, view
             output.append({
                 'name': item.name,
                 'identifier': item.id,
-                'amount': amount.magnitude,
-                'measure': '{:~}'.format(amount).split(' ')[1],
+                'amount': amount['amount'],
+                'measure': amount['measure'],
             })
         return output
 
@@ -498,15 +612,12 @@ class RunViewSet(AuditTrailViewMixin, ViewPermissionsMixin, StatsViewMixin, view
         # is_repeat = request.query_params.get('is_repeat', False)
 
         if serialized_task.is_valid(raise_exception=True):
-            # Init a unit registry for later use
-            self.ureg = UnitRegistry()
-
             run = self.get_object()
-            task = run.get_task_at_index(run.current_task)
+            task = run.get_current_task()
 
             # Get items from products
             product_type = serialized_task.validated_data.get('product_input', None)
-            product_input_items = self._get_product_input_items(product_type)
+            product_input_items = self._get_product_input_items(run, product_type)
 
             # Process task data against input_items
             data_items = self._generate_data_dict(product_input_items,
@@ -517,8 +628,11 @@ class RunViewSet(AuditTrailViewMixin, ViewPermissionsMixin, StatsViewMixin, view
             # Perform calculations here!
             data_items = self._perform_calculations(data_items)
 
+            # Fetch everything needed from the inventory up front
+            self._prefetch_inventory(data_items, serialized_task)
             product_item_amounts, sum_item_amounts = self._get_item_amounts(data_items,
                                                                             serialized_task)
+            self._prefetch_transfers(sum_item_amounts)
             valid_amounts, errors, error_items = self._check_input_amounts(sum_item_amounts)
 
             # Check if a transfer already exists with given barcode/well??
@@ -548,48 +662,62 @@ class RunViewSet(AuditTrailViewMixin, ViewPermissionsMixin, StatsViewMixin, view
                     check_output['requirements'].append(st.data)
                 return Response(check_output)
             else:
-                if task.capable_equipment.count() > 0:
-                    if equipment.status != 'idle':
-                        raise serializers.ValidationError({'message':
-                                                          'Equipment is currently in use'})
-                    equipment.status = 'active'
-                    equipment.save()
-                    run.equipment_used = equipment
-
-                if not valid_amounts:
-                    raise ValidationError({'message': '\n'.join(errors)})
-                task_run_identifier = uuid.uuid4()
-                # driver_output = self._do_driver_actions(data_items)
-                # Generate DataItem for inputs
-                for product in run.products.all():
-                    prod_amounts = product_item_amounts[product.product_identifier]
-                    data_items[product.product_identifier]['product_input_amounts'] = \
-                        self._serialize_item_amounts(prod_amounts)
-                    entry = DataEntry(
-                        run=run,
-                        task_run_identifier=task_run_identifier,
-                        product=product,
-                        created_by=self.request.user,
-                        state='active',
-                        data=data_items[product.product_identifier],
-                        task=task)
-                    entry.save()
-
-                # TODO: RunLabware creation
-                # Link labeware barcode -> transfer
-                # At this point transfers have the amount taken but are not complete
-                # until task finished
-                for t in transfers:
-                    t.run_identifier = task_run_identifier
-                    t.do_transfer(self.ureg)
-                    t.save()
-                    run.transfers.add(t)
-
-                # Update run with new details
-                run.task_in_progress = True
-                run.has_started = True
-                run.task_run_identifier = task_run_identifier
-                run.save()
+                # Everything is written in one transaction so a failure part
+                # way through does not leave inventory or equipment altered
+                with transaction.atomic():
+                    self._lock_run(run)
+                    if run.task_in_progress:
+                        raise Conflict('Task has already been started')
+                    if not valid_amounts:
+                        raise ValidationError({'message': '\n'.join(errors)})
+
+                    if task.capable_equipment.count() > 0:
+                        if equipment.status != 'idle':
+                            raise serializers.ValidationError({'message':
+                                                              'Equipment is currently in use'})
+                        # Only one request can take idle equipment
+                        if not self._set_equipment_status(equipment, 'active', 'idle'):
+                            raise Conflict('Equipment is currently in use')
+                        run.equipment_used = equipment
+
+                    task_run_identifier = uuid.uuid4()
+                    # driver_output = self._do_driver_actions(data_items)
+                    # Generate DataItem for inputs
+                    entries = []
+                    for product in run.products.all():
+                        prod_amounts = product_item_amounts[product.product_identifier]
+                        data_items[product.product_identifier]['product_input_amounts'] = \
+                            self._serialize_item_amounts(prod_amounts)
+                        entries.append(DataEntry(
+                            run=run,
+                            task_run_identifier=task_run_identifier,
+                            product=product,
+                            created_by=self.request.user,
+                            state='active',
+                            data=data_items[product.product_identifier],
+                            task=task))
+                    DataEntry.objects.bulk_create(entries)
+                    send_post_save(DataEntry, entries, created=True)
+
+                    # TODO: RunLabware creation
+                    # Link labeware barcode -> transfer
+                    # At this point transfers have the amount taken but are not complete
+                    # until task finished
+                    for t in transfers:
+                        t.run_identifier = task_run_identifier
+                    ItemTransfer.do_transfers(transfers)
+                    run.transfers.add(*transfers)
+
+                    # Update run with new details
+                    run.task_in_progress = True
+                    run.has_started = True
+                    run.task_run_identifier = task_run_identifier
+                    run.save(update_fields=['equipment_used', 'task_in_progress',
+                                            'has_started', 'task_run_identifier'])
+                send_run_event(run, 'task_started',
+                               task_run_identifier=task_run_identifier,
+                               data_entries=[e.id for e in entries],
+                               transfers=[t.id for t in transfers])
                 return Response({'message': 'Task started successfully'})
 
     @detail_route(methods=["POST"])
@@ -600,30 +728,29 @@ class RunViewSet(AuditTrailViewMixin, ViewPermissionsMixin, StatsViewMixin, view
         run = self.get_object()
 
         if run.task_in_progress:
-            ureg = UnitRegistry()
-            # Get any transfers for this task
-            transfers_for_this_task = run.transfers.filter(run_identifier=run.task_run_identifier)
-            data_entries = DataEntry.objects.filter(task_run_identifier=run.task_run_identifier)
-
-            if run.equipment_used:
-                equipment = run.equipment_used
-                equipment.status = 'idle'
-                equipment.save()
-                run.equipment_used = None
-
-            # Transfer all the things taken back into the inventory
-            for t in transfers_for_this_task:
-                t.is_addition = True
-                t.do_transfer(ureg)
-            # Once transfers made delete them
-            # TODO: DO NOT delete transfers marked as has_taken!!
-            transfers_for_this_task.delete()
-            # Trash the data entries now as they're irrelevant
-            data_entries.delete()
-            # No longer active
-            run.task_in_progress = False
-            run.has_started = False
-            run.save()
+            with transaction.atomic():
+                self._lock_run(run)
+                # Get any transfers for this task
+                transfers_for_this_task = run.transfers.filter(
+                    run_identifier=run.task_run_identifier)
+                data_entries = DataEntry.objects.filter(
+                    task_run_identifier=run.task_run_identifier)
+
+                if run.equipment_used:
+                    self._set_equipment_status(run.equipment_used, 'idle')
+                    run.equipment_used = None
+
+                # Transfer all the things taken back into the inventory
+                # then delete the transfers
+                # TODO: DO NOT delete transfers marked as has_taken!!
+                transfers_for_this_task.cancel()
+                # Trash the data entries now as they're irrelevant
+                data_entries.delete()
+                # No longer active
+                run.task_in_progress = False
+                run.has_started = False
+                run.save(update_fields=['equipment_used', 'task_in_progress', 'has_started'])
+            send_run_event(run, 'task_cancelled', task_run_identifier=run.task_run_identifier)
             return Response({'message': 'Task cancelled'})
         return Response({'message': 'Task not in progress so cannot be cancelled'}, status=400)
 
@@ -650,7 +777,7 @@ class RunViewSet(AuditTrailViewMixin, ViewPermissionsMixin, StatsViewMixin, view
         run = self.get_object()
 
         if run.task_in_progress and run.is_active:
-            task = run.get_task_at_index(run.current_task)
+            task = run.get_current_task()
             transfers = run.transfers.filter(run_identifier=run.task_run_identifier)
             serialized_transfers = ItemTransferPreviewSerializer(transfers, many=True)
             # Get current data for each product
@@ -680,10 +807,19 @@ class RunViewSet(AuditTrailViewMixin, ViewPermissionsMixin, StatsViewMixin, view
 
     @detail_route(methods=['GET'], renderer_classes=(CSVRenderer,))
     def get_file(self, request, pk=None):
+        """
+        Get the data for an equipment file for the current task
+
+        ### query_params
+
+        - _file_id_ (**required**): The ID of the equipment file template
+        - _stream_: Stream the file as CSV, one line at a time
+        """
         file_id = request.query_params.get('file_id', None)
+        stream = request.query_params.get('stream', False)
 
         run = self.get_object()
-        task = run.get_task_at_index(run.current_task)
+        task = run.get_current_task()
 
         try:
             file_template = task.equipment_files.get(pk=file_id)
@@ -694,6 +830,20 @@ class RunViewSet(AuditTrailViewMixin, ViewPermissionsMixin, StatsViewMixin, view
             transfers = run.transfers.filter(run_identifier=run.task_run_identifier)
             serialized_transfers = ItemTransferPreviewSerializer(transfers, many=True)
             data_entries = DataEntry.objects.filter(task_run_identifier=run.task_run_identifier)
+            if stream:
+                data_entries = data_entries.select_related('run', 'created_by', 'task',
+                                                           'product')
+
+                def output_data():
+                    serialized_data_entries = iterate_in_chunks(
+                        data_entries, DataEntrySerializer, prefetch=('data_files',))
+                    return task.iter_output_file(file_template,
+                                                 serialized_data_entries,
+                                                 serialized_transfers.data)
+                response = StreamingHttpResponse(csv_rows(output_data), content_type='text/csv')
+                response['Content-Disposition'] = \
+                    'attachment; filename="{}.csv"'.format(file_template.name)
+                return response
             serialized_data_entries = DataEntrySerializer(data_entries, many=True)
             output_data = task.data_to_output_file(file_template,
                                                    serialized_data_entries.data,
@@ -702,8 +852,46 @@ class RunViewSet(AuditTrailViewMixin, ViewPermissionsMixin, StatsViewMixin, view
         # Return a 204 as there is no task to get files for
         return Response(status=204)
 
-    def _copy_files(self, data_entries):
-        task = self.get_object().get_task_at_index(self.get_object().current_task)
+    def _lock_run(self, run):
+        """
+        Lock the run until the end of the transaction
+
+        Raises Conflict if another request has changed the state of the
+        task since the run was read.
+        """
+        fields = ('task_in_progress', 'is_active', 'current_task', 'task_run_identifier')
+        locked = Run.objects.select_for_update().filter(pk=run.pk).values_list(*fields).first()
+        if locked != tuple(getattr(run, f) for f in fields):
+            raise Conflict('The task has been changed by someone else, please reload')
+
+    def _set_equipment_status(self, equipment, status, from_status=None):
+        """
+        Set the status of equipment with a single update
+
+        If from_status is given the status is only changed if it is still
+        from_status, e.g. so only one run can start using the equipment.
+        """
+        updated = Equipment.objects.filter(pk=equipment.pk)
+        if from_status is not None:
+            updated = updated.filter(status=from_status)
+        if updated.update(status=status) == 0:
+            return False
+        equipment.status = status
+        send_post_save(Equipment, [equipment], update_fields={'status'})
+        return True
+
+    def _copy_files(self, run, data_entries):
+        """
+        Mark the run as waiting on files to copy from equipment
+
+        Returns the arguments for copy_run_files or None if there
+        is nothing to copy. The copy is run in the background once
+        the task has been finished.
+        """
+        data_entries = list(data_entries)
+        if not data_entries:
+            return None
+        task = run.get_current_task()
         # If no choice default to the first entry in the equipment
         # for use on
         equipment_choice = data_entries[0].data.get('equipment_choice', None)
@@ -711,17 +899,86 @@ class RunViewSet(AuditTrailViewMixin, ViewPermissionsMixin, StatsViewMixin, view
             equipment = task.capable_equipment.get(name=equipment_choice)
         except:
             # Well we can't do anything so just return
-            return
-        for file_to_copy in equipment.files_to_copy.filter(is_enabled=True):
-            interpolate_dict = {
-                'run_identifier': str(data_entries[0].task_run_identifier),
-            }
-            for loc in file_to_copy.locations.all():
-                file_store = loc.copy(interpolate_dict)
-                if file_store:
-                    for d in data_entries:
-                        d.data_files.add(file_store)
-                        d.save()
+            return None
+        location_ids = list(CopyFilePath.objects.filter(
+            driver__equipment=equipment,
+            driver__is_enabled=True).values_list('id', flat=True))
+        if not location_ids:
+            return None
+        interpolate_dict = {
+            'run_identifier': str(data_entries[0].task_run_identifier),
+        }
+        run.file_copy_status = 'pending'
+        run.files_to_copy = len(location_ids)
+        run.files_copied = 0
+        return (location_ids, interpolate_dict, [d.id for d in data_entries], run.id)
+
+    def _create_output_items(self, entries, user):
+        """
+        Create inventory items for the outputs of each data entry
+
+        Reference data is looked up once, items are created in a single
+        insert and their links and permissions in one insert each.
+        """
+        entries = list(entries.select_related('product', 'product__project', 'run'))
+        measures = {}
+        item_types = {}
+        location = None
+        outputs = []
+        for e in entries:
+            for output in e.data['output_fields']:
+                if output['measure'] not in measures:
+                    measures[output['measure']] = AmountMeasure.objects.get(
+                        symbol=output['measure'])
+                if output['lookup_type'] not in item_types:
+                    item_types[output['lookup_type']] = ItemType.objects.get(
+                        name=output['lookup_type'])
+                if location is None:
+                    location = Location.objects.get(name='Lab')
+                output_name = '{} {} {}'.format(e.product.product_identifier,
+                                                e.product.name,
+                                                output['label'])
+                identifier = '{}/{}/{}'.format(e.product.product_identifier,
+                                               e.run.id, e.run.name)
+                new_item = Item(
+                    name=output_name,
+                    identifier=identifier,
+                    item_type=item_types[output['lookup_type']],
+                    location=location,
+                    amount_available=output['amount'],
+                    amount_measure=measures[output['measure']],
+                    added_by=user,
+                )
+                # As Item.save would, which bulk_create does not call
+                if new_item.amount_available > 0:
+                    new_item.in_inventory = True
+                outputs.append((e, new_item))
+        if not outputs:
+            return []
+
+        new_items = Item.objects.bulk_create([new_item for e, new_item in outputs])
+        send_post_save(Item, new_items, created=True)
+
+        # Get permissions from project for item
+        self.bulk_clone_group_permissions([(e.product.project, new_item)
+                                           for e, new_item in outputs])
+
+        input_ids = set()
+        for e in entries:
+            input_ids.update(int(i) for i in e.data['product_inputs'])
+        existing_ids = set(Item.objects.filter(id__in=input_ids).values_list('id', flat=True))
+        created_from = []
+        linked_inventory = []
+        for e, new_item in outputs:
+            product_input_ids = set(int(i) for i in e.data['product_inputs'])
+            for item_id in product_input_ids & existing_ids:
+                created_from.append(Item.created_from.through(from_item_id=new_item.id,
+                                                              to_item_id=item_id))
+            linked_inventory.append(Product.linked_inventory.through(product_id=e.product.id,
+                                                                     item_id=new_item.id))
+        Item.created_from.through.objects.bulk_create(created_from)
+        Product.linked_inventory.through.objects.bulk_create(linked_inventory)
+        return new_items
 
     @detail_route(methods=['POST'])
     def finish_task(self, request, pk=None):
@@ -738,120 +995,118 @@ class RunViewSet(AuditTrailViewMixin, ViewPermissionsMixin, StatsViewMixin, view
         run = self.get_object()
 
         if run.task_in_progress and run.is_active:
-
-            # Now the task is complete any transfers can be marked as complete
-            transfers = run.transfers.filter(run_identifier=run.task_run_identifier)
-            for t in transfers:
-                # We've finished so you can't put it back now
-                # At this point it may or may not have everthing taken
-                t.do_complete()
-
-            all_entries = DataEntry.objects.filter(
-                task_run_identifier=run.task_run_identifier,
-                product__in=run.products.all())
-
-            # Handle filepath copy stuff
-            self._copy_files(all_entries)
-
             failed_products = []
             if product_failures:
-                # If failures create new run based on current
-                # and move failed products to it
                 failure_ids = str(product_failures).split(',')
                 failed_products = run.products.filter(id__in=failure_ids)
                 if failed_products.count() != len(failed_products):
                     return Response({'message': 'Invalid Id\'s for failed products!'}, status=400)
-                new_name = '{} (failed)'.format(run.name)
 
-                # Set the task to a different task if needs to be earlier
-                # Tasks are zero indexed but labelled as 1 indexed so subtract 1
-                if restart_task_at is not None:
-                    set_task_as = int(restart_task_at)
-                else:
-                    set_task_as = run.current_task
-
-                new_run = Run(
-                    name=new_name,
-                    tasks=run.tasks,
-                    current_task=set_task_as,
-                    has_started=True,
-                    started_by=request.user)
-                new_run.save()
-                new_run.products.add(*failed_products)
-
-                # Update data entries state to failed
-                # This variable exists for line length purposes :P
-                rtri = run.task_run_identifier
-                failed_entries = DataEntry.objects.filter(task_run_identifier=rtri,
-                                                          product__in=failed_products)
-                failed_entries.update(state='failed', notes=notes)
-
-                # Remove the failed products from the current run
-                run.products.remove(*failed_products)
-
-            # Exclude failed products
-            entries = all_entries.exclude(product__in=failed_products)
-
-            # find and mark dataentry complete!
-            entries.update(state='succeeded')
-
-            # mark labware inactive
-            active_labware = run.labware.filter(is_active=True)
-            active_labware.update(is_active=False)
-
-            # Create ouputs from the task
-            runindex = 0
-            for e in entries:
-                for index, output in enumerate(e.data['output_fields']):
-                    output_name = '{} {} {}'.format(e.product.product_identifier,
-                                                    e.product.name,
-                                                    output['label'])
-                    measure = AmountMeasure.objects.get(symbol=output['measure'])
-                    identifier = '{}/{}/{}'.format(e.product.product_identifier,
-                                                   e.run.id, e.run.name)
-                    runindex += 1
-                    location = Location.objects.get(name='Lab')
-                    item_type = ItemType.objects.get(name=output['lookup_type'])
-                    new_item = Item(
-                        name=output_name,
-                        identifier=identifier,
-                        item_type=item_type,
-                        location=location,
-                        amount_available=output['amount'],
-                        amount_measure=measure,
-                        added_by=request.user,
-                    )
-                    new_item.save()
-                    # Get permissions from project for item
-                    self.clone_group_permissions(e.product.project, new_item)
-
-                    product_input_ids = [p for p in e.data['product_inputs']]
-                    product_items = Item.objects.filter(id__in=product_input_ids)
-                    new_item.created_from.add(*product_items)
-
-                    e.product.linked_inventory.add(new_item)
-                    e.save()
-
-            run.task_in_progress = False
-            if run.equipment_used:
-                equipment = run.equipment_used
-                equipment.status = 'idle'
-                equipment.save()
-                run.equipment_used = None
-
-            # advance task by one OR end if no more tasks
-            if run.current_task == len(run.get_task_list()) - 1:
-                run.is_active = False
-                run.date_finished = timezone.now()
-            else:
-                run.current_task += 1
+            with transaction.atomic():
+                self._lock_run(run)
+                # Now the task is complete any transfers can be marked as complete
+                # We've finished so you can't put it back now
+                # At this point it may or may not have everthing taken
+                run.transfers.filter(run_identifier=run.task_run_identifier).complete()
+
+                all_entries = DataEntry.objects.filter(
+                    task_run_identifier=run.task_run_identifier,
+                    product__in=run.products.all())
+
+                # Handle filepath copy stuff
+                copy_args = self._copy_files(run, all_entries)
+
+                if product_failures:
+                    # If failures create new run based on current
+                    # and move failed products to it
+                    new_name = '{} (failed)'.format(run.name)
 
-            run.save()
+                    # Set the task to a different task if needs to be earlier
+                    # Tasks are zero indexed but labelled as 1 indexed so subtract 1
+                    if restart_task_at is not None:
+                        set_task_as = int(restart_task_at)
+                    else:
+                        set_task_as = run.current_task
+
+                    new_run = Run(
+                        name=new_name,
+                        tasks=run.tasks,
+                        current_task=set_task_as,
+                        has_started=True,
+                        started_by=request.user)
+                    new_run.save()
+                    new_run.products.add(*failed_products)
+
+                    # Update data entries state to failed
+                    # This variable exists for line length purposes :P
+                    rtri = run.task_run_identifier
+                    failed_entries = DataEntry.objects.filter(task_run_identifier=rtri,
+                                                              product__in=failed_products)
+                    failed_entries.update(state='failed', notes=notes)
+
+                    # Remove the failed products from the current run
+                    run.products.remove(*failed_products)
+
+                # Exclude failed products
+                entries = all_entries.exclude(product__in=failed_products)
+
+                # find and mark dataentry complete!
+                entries.update(state='succeeded')
+
+                # mark labware inactive
+                active_labware = run.labware.filter(is_active=True)
+                active_labware.update(is_active=False)
+
+                # Create ouputs from the task
+                self._create_output_items(entries, request.user)
+
+                run.task_in_progress = False
+                if run.equipment_used:
+                    self._set_equipment_status(run.equipment_used, 'idle')
+                    run.equipment_used = None
+
+                # advance task by one OR end if no more tasks
+                if run.current_task == len(run.get_task_list()) - 1:
+                    run.is_active = False
+                    run.date_finished = timezone.now()
+                else:
+                    run.current_task += 1
+
+                run.save(update_fields=['task_in_progress', 'equipment_used', 'is_active',
+                                        'date_finished', 'current_task', 'file_copy_status',
+                                        'files_to_copy', 'files_copied'])
+            send_run_event(run, 'task_finished',
+                           task_run_identifier=run.task_run_identifier,
+                           succeeded=list(entries.values_list('id', flat=True)),
+                           failed=list(DataEntry.objects.filter(
+                               task_run_identifier=run.task_run_identifier,
+                               state='failed').values_list('id', flat=True)),
+                           failed_run=new_run.id if product_failures else None)
+            if copy_args:
+                # Only queue the copy once the outputs it attaches files to exist
+                transaction.on_commit(lambda: copy_run_files.delay(*copy_args))
             serializer = RunSerializer(run)
             return Response(serializer.data)
         # Return a 204 as there is no task to monitor
         return Response(status=204)
 
+    @detail_route()
+    def plan(self, request, pk=None):
+        """
+        Work out the inventory needed for the remaining tasks of the run
+
+        Nothing is changed, the tasks are simulated using the amounts on
+        their templates. A task in progress has already taken its inputs
+        so is not included.
+        """
+        run = self.get_object()
+        start_at = run.current_task + 1 if run.task_in_progress else run.current_task
+        if not run.is_active:
+            start_at = len(run.get_task_ids())
+        tasks = TaskTemplate.objects.in_order(run.get_task_ids()[start_at:])
+        planner = MaterialPlanner(tasks, MaterialPlanner.load_products(run.products.all()))
+        return Response(planner.plan())
+
     @detail_route(methods=['POST'])
     def workflow_from_run(self, request, pk=None):
         """
@@ -890,7 +1145,7 @@ class TaskViewSet(AuditTrailViewMixin, ViewPermissionsMixin, viewsets.ModelViewS
     """
     Provide a list of TaskTemplates available
     """
-    queryset = TaskTemplate.objects.all()
+    queryset = TaskTemplate.objects.with_fields()
     serializer_class = TaskTemplateSerializer
     permission_classes = (ExtendedObjectPermissions,)
     filter_backends = (SearchFilter, DjangoFilterBackend,
@@ -912,13 +1167,29 @@ class TaskViewSet(AuditTrailViewMixin, ViewPermissionsMixin, viewsets.ModelViewS
     def recalculate(self, request, pk=None):
         """
         Given task data recalculate and return task.
+
+        If a list of changed field labels is supplied as "changed" only
+        the calculations affected by those fields are performed and
+        returned.
         """
         obj = self.get_object()
         task_data = request.data
         if task_data:
-            serializer = RecalculateTaskTemplateSerializer(data=task_data)
+            changed = task_data.get('changed', None)
+            if isinstance(changed, str):
+                changed = [c for c in changed.split(',') if c != '']
+            elif changed is not None and (not isinstance(changed, list) or
+                                          not all(isinstance(c, str) for c in changed)):
+                return Response({'message': 'changed must be a list of field labels'},
+                                status=400)
+            serializer = RecalculateTaskTemplateSerializer(data=task_data,
+                                                           context={'changed': changed})
             if serializer.is_valid(raise_exception=True):
-                return Response(serializer.data)  # Raw data, not objects
+                data = serializer.data  # Raw data, not objects
+                if changed is not None:
+                    return Response({'id': data['id'],
+                                     'calculation_fields': serializer.changed_calculations})
+                return Response(data)
         serializer = TaskTemplateSerializer(obj)
         if serializer.is_valid(raise_exception=True):
             return Response(serializer.data)  # Raw data, not objects
@@ -934,33 +1205,46 @@ class TaskFieldViewSet(AuditTrailViewMixin, ViewPermissionsMixin, viewsets.Model
                        OrderingFilter, ExtendedObjectPermissionsFilter,)
 
     def get_serializer_class(self):
-        try:
-            type_name = self.request.query_params.get('type', '').title()
-            if type_name:
-                serializer_name = type_name + 'FieldTemplateSerializer'
-                serializer_class = globals()[serializer_name]
-                return serializer_class
-        except:
-            pass
-        return InputFieldTemplateSerializer
+        model, serializer_class = get_field_type(self.request.query_params.get('type', None))
+        return serializer_class
 
     def get_queryset(self):
         """
         Pick the type of field so it can be properly serialized.
         """
-        type_name = self.request.query_params.get('type', '').title()
-        if type_name:
-            object_name = type_name + 'FieldTemplate'
-            object_class = globals()[object_name]
-            return object_class.objects.all()
-        return InputFieldTemplate.objects.all()
+        model, serializer_class = get_field_type(self.request.query_params.get('type', None))
+        return model.objects.all()
+
+    @list_route()
+    def all(self, request):
+        """
+        Get every type of field for one or more task templates at once
+
+        Returns a dict of template ID to a dict of field type
+        (input, step, variable, output, calculation) to fields.
+
+        ### query_params
+
+        - _templates_ (**required**): Comma seperated list of task template IDs
+        """
+        template_ids = request.query_params.get('templates', None)
+        if not template_ids:
+            return Response({'message': 'Please provide a list of task templates'}, status=400)
+        try:
+            template_ids = [int(t) for t in template_ids.split(',') if t != '']
+        except ValueError:
+            return Response({'message': 'Invalid task template IDs'}, status=400)
+        # Fields share the permissions of their template
+        templates = ExtendedObjectPermissionsFilter().filter_queryset(
+            request, TaskTemplate.objects.filter(id__in=template_ids), self)
+        return Response(get_task_fields(list(templates.values_list('id', flat=True))))
 
     def perform_create(self, serializer):
         task_template = serializer.validated_data['template']
-        if ('view_tasktemplate' in get_group_perms(self.request.user, task_template)
-                or self.request.user.groups.filter(name='admin').exists()):
-            if ('change_tasktemplate' in get_group_perms(self.request.user, task_template)
-                    or self.request.user.groups.filter(name='admin').exists()):
+        is_admin = get_principal(self.request.user).is_admin
+        perms = [] if is_admin else get_group_perms(self.request.user, task_template)
+        if 'view_tasktemplate' in perms or is_admin:
+            if 'change_tasktemplate' in perms or is_admin:
                 instance = serializer.save()
                 self.clone_group_permissions(instance.template, instance)
             else: